@@ -0,0 +1,62 @@
+"""
+Synthetic blueprints for benchmarks.
+
+A generated blueprint is a chain: instruction i waits for conditions_per_instruction topics, and its Action publishes the topics of
+instruction i + 1. Every execution therefore runs each instruction exactly once, in order.
+"""
+from typing import Dict, List, Type
+
+from blue.base import Action, Adapter, Event
+
+
+class ChainAdapter(Adapter):
+    def adapt(self, context, events):
+        return dict(event_count=len(events))
+
+
+class ChainAction(Action):
+    next_topics: List[str] = []
+
+    def act(self, input):
+        if self.next_topics:
+            self.event_bus.publish_many([Event(topic, metadata=dict(blueprint_execution_id=self._metadata['blueprint_execution_id']))
+                                         for topic in self.next_topics])
+
+
+def condition_topics(instruction_index, conditions_per_instruction) -> List[str]:
+    if instruction_index == 0:
+        return ['start'] + [f'start_{k}' for k in range(1, conditions_per_instruction)]
+    return [f'step_{instruction_index}_{k}' for k in range(conditions_per_instruction)]
+
+
+def chain_actions(instruction_count, conditions_per_instruction) -> List[Type[ChainAction]]:
+    actions = []
+    for i in range(instruction_count):
+        next_topics = condition_topics(i + 1, conditions_per_instruction) if i + 1 < instruction_count else []
+        actions.append(type(f'ChainAction{i}', (ChainAction,), dict(next_topics=next_topics)))
+    return actions
+
+
+def chain_namespace_config(instruction_count, conditions_per_instruction) -> Dict:
+    return {'namespace': {'action': chain_actions(instruction_count, conditions_per_instruction), 'adapter': [ChainAdapter]}}
+
+
+def chain_blueprint_definition(instruction_count, conditions_per_instruction, name='benchmark_chain') -> Dict:
+    return {
+        'name': name,
+        'instructions': [
+            {
+                'conditions': condition_topics(i, conditions_per_instruction),
+                'outcome': {'action': f'ChainAction{i}', 'adapter': 'ChainAdapter'},
+                'termination_conditions': ['cancelled'],
+                'emits': condition_topics(i + 1, conditions_per_instruction) if i + 1 < instruction_count else [],
+            }
+            for i in range(instruction_count)
+        ]
+    }
+
+
+def extra_start_events(blueprint_execution_id, conditions_per_instruction) -> List[Event]:
+    # 'start' is the boot event; the remaining conditions of the first instruction are published right after the execution starts
+    return [Event(topic, metadata=dict(blueprint_execution_id=blueprint_execution_id))
+            for topic in condition_topics(0, conditions_per_instruction)[1:]]
@@ -0,0 +1,222 @@
+"""
+Throughput and latency of BlueprintExecutor over synthetic chain blueprints.
+
+    python -m benchmarks.executor --backends inmemory,pgqueue --executions 100,1000 --instructions 1,5 --conditions 1,3 \\
+        --save benchmarks/baselines/local.json
+    python -m benchmarks.executor --compare benchmarks/baselines/local.json
+
+The persistent backends need a local Postgres (--db-*). The SQS backed store uses --sqs-endpoint-url (e.g. ElasticMQ or
+moto_server) and falls back to moto's in-process mock when it is not given.
+"""
+import argparse
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+from blue.base import Event, BlueprintInstructionState
+from blue.blueprint import BlueprintManager
+from blue.execution import BlueprintExecutionManager, BlueprintExecutor, ExecutorRunStatus, RequeueBackoff
+from blue.impl.inmemory import InMemoryEventBus, InMemoryBlueprintInstructionExecutionStore
+
+from benchmarks.blueprints import chain_namespace_config, chain_blueprint_definition, extra_start_events
+
+BACKENDS = ('inmemory', 'persistent', 'pgqueue')
+
+
+class MeasuredExecutor(BlueprintExecutor):
+
+    def __init__(self, *args, expected_steps, deadline, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.expected_steps = expected_steps
+        self.deadline = deadline
+        self.completed_steps = 0
+        self.step_latencies = []
+
+    def _process_instruction(self, instruction_state: BlueprintInstructionState) -> Optional[ExecutorRunStatus]:
+        started_at = time.perf_counter()
+        run_status = super()._process_instruction(instruction_state)
+        self.step_latencies.append(time.perf_counter() - started_at)
+        return run_status
+
+    def _report_rundata(self, instruction_state: Optional[BlueprintInstructionState], run_status: ExecutorRunStatus):
+        if run_status == ExecutorRunStatus.OUTCOME_ACTION_SUCCESS:
+            self.completed_steps += 1
+        if self.completed_steps >= self.expected_steps or time.perf_counter() > self.deadline:
+            self.stop()
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+@contextlib.contextmanager
+def backend(name, blueprint_manager, args):
+    if name == 'inmemory':
+        yield InMemoryEventBus(dict()), InMemoryBlueprintInstructionExecutionStore(blueprint_manager, dict())
+        return
+
+    from blue.impl.persistent import PersistentEventBus, PersistentBlueprintInstructionExecutionStore, \
+        PostgresQueueBlueprintInstructionExecutionStore, EventModel
+    config = {
+        'db': dict(host=args.db_host, port=args.db_port, database=args.db_name, user=args.db_user, password=args.db_password),
+        'sqs': dict(prefix='benchmark_', wait_time_seconds=0, region_name=args.sqs_region, endpoint_url=args.sqs_endpoint_url),
+    }
+    with contextlib.ExitStack() as stack:
+        if name == 'persistent' and not args.sqs_endpoint_url:
+            from moto import mock_sqs
+            os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+            os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+            stack.enter_context(mock_sqs())
+        store_class = PersistentBlueprintInstructionExecutionStore if name == 'persistent' else PostgresQueueBlueprintInstructionExecutionStore
+        event_bus = PersistentEventBus(config)
+        store = store_class(blueprint_manager, config)
+        try:
+            yield event_bus, store
+        finally:
+            store.remove_effects()
+            event_bus.db.drop_tables([EventModel], safe=True)
+
+
+def run_scenario(backend_name, execution_count, instruction_count, conditions_per_instruction, args) -> Dict:
+    blueprint_manager = BlueprintManager(chain_namespace_config(instruction_count, conditions_per_instruction))
+    blueprint_definition = chain_blueprint_definition(instruction_count, conditions_per_instruction)
+    blueprint_manager.add_blueprint(blueprint_definition)
+    blueprint = blueprint_manager.live_blueprints_by_name[blueprint_definition['name']]
+    expected_steps = execution_count * instruction_count
+
+    with backend(backend_name, blueprint_manager, args) as (event_bus, store):
+        manager = BlueprintExecutionManager(event_bus, store)
+        started_at = time.perf_counter()
+        blueprint_executions = manager.start_executions(blueprint, [(Event('start'), {}) for _ in range(execution_count)])
+        event_bus.publish_many([event for each in blueprint_executions
+                                for event in extra_start_events(each.execution_id, conditions_per_instruction)])
+        start_seconds = time.perf_counter() - started_at
+
+        # Persistent stores see instructions before their conditions are published, so requeue backoff would dominate the run
+        requeue_backoff = RequeueBackoff(base_delay=args.requeue_delay, maximum_delay=args.requeue_delay, jitter=0)
+        executor = MeasuredExecutor(manager, blueprint_manager, 'benchmark', no_sleep=True, batch_size=args.batch_size,
+                                    requeue_backoff=requeue_backoff, expected_steps=expected_steps, deadline=time.perf_counter() + args.timeout)
+        started_at = time.perf_counter()
+        executor.run()
+        run_seconds = time.perf_counter() - started_at
+
+    latencies = sorted(executor.step_latencies)
+    return dict(
+        scenario=f'{backend_name}/e{execution_count}/i{instruction_count}/c{conditions_per_instruction}',
+        backend=backend_name,
+        executions=execution_count,
+        instructions=instruction_count,
+        conditions=conditions_per_instruction,
+        batch_size=args.batch_size,
+        completed=executor.completed_steps == expected_steps,
+        steps=len(latencies),
+        start_seconds=round(start_seconds, 4),
+        run_seconds=round(run_seconds, 4),
+        throughput=round(executor.completed_steps / run_seconds, 1) if run_seconds else None,
+        p50_ms=round(percentile(latencies, 0.5) * 1000, 3),
+        p99_ms=round(percentile(latencies, 0.99) * 1000, 3),
+    )
+
+
+def measure_peak_memory(backend_name, execution_count, instruction_count, conditions_per_instruction, args) -> int:
+    # A separate pass, since tracing allocations distorts the timings
+    tracemalloc.start()
+    try:
+        run_scenario(backend_name, execution_count, instruction_count, conditions_per_instruction, args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(args) -> List[Dict]:
+    results = []
+    for backend_name, execution_count, instruction_count, conditions_per_instruction in itertools.product(
+            args.backends, args.executions, args.instructions, args.conditions):
+        result = run_scenario(backend_name, execution_count, instruction_count, conditions_per_instruction, args)
+        if args.memory:
+            result['peak_memory_kb'] = measure_peak_memory(backend_name, execution_count, instruction_count, conditions_per_instruction,
+                                                           args) // 1024
+        print(format_result(result), flush=True)
+        results.append(result)
+    return results
+
+
+def format_result(result: Dict) -> str:
+    memory = f"{result['peak_memory_kb']:>10}kb" if 'peak_memory_kb' in result else ''
+    status = '' if result['completed'] else ' (incomplete)'
+    return (f"{result['scenario']:<32}{result['throughput']:>12}/s  p50 {result['p50_ms']:>8}ms  p99 {result['p99_ms']:>8}ms  "
+            f"start {result['start_seconds']:>8}s{memory}{status}")
+
+
+def environment() -> Dict:
+    return dict(isotime=datetime.datetime.now().isoformat(), python=sys.version.split()[0], platform=platform.platform(),
+                machine=platform.machine(), cpu_count=os.cpu_count())
+
+
+def compare(results: List[Dict], baseline: Dict, tolerance: float) -> List[str]:
+    baseline_by_scenario = {result['scenario']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        previous = baseline_by_scenario.get(result['scenario'])
+        if not previous or not previous['throughput'] or not result['throughput']:
+            continue
+        throughput_change = result['throughput'] / previous['throughput'] - 1
+        p99_change = result['p99_ms'] / previous['p99_ms'] - 1 if previous['p99_ms'] else 0
+        print(f"{result['scenario']:<32}throughput {throughput_change:+.1%}  p99 {p99_change:+.1%}")
+        if throughput_change < -tolerance or p99_change > tolerance:
+            regressions.append(result['scenario'])
+    return regressions
+
+
+def _int_list(value):
+    return [int(each) for each in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', type=lambda value: value.split(','), default=['inmemory'], help=f'Comma separated, any of {BACKENDS}')
+    parser.add_argument('--executions', type=_int_list, default=[100, 1000])
+    parser.add_argument('--instructions', type=_int_list, default=[1, 5])
+    parser.add_argument('--conditions', type=_int_list, default=[1, 3])
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--requeue-delay', type=float, default=0, help='Requeue delay for instructions whose conditions are not met yet')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds after which a scenario is cut short and marked incomplete')
+    parser.add_argument('--memory', action='store_true', help='Also measure peak traced memory in a separate pass')
+    parser.add_argument('--save', help='Write results and environment to this JSON file')
+    parser.add_argument('--compare', help='Compare against a JSON file written by --save.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative throughput or p99 change that counts as a regression')
+    parser.add_argument('--db-host', default='localhost')
+    parser.add_argument('--db-port', type=int, default=5432)
+    parser.add_argument('--db-name', default='bluedata')
+    parser.add_argument('--db-user', default='postgres')
+    parser.add_argument('--db-password', default='postgres')
+    parser.add_argument('--sqs-endpoint-url', default=None)
+    parser.add_argument('--sqs-region', default=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
+    args = parser.parse_args(argv)
+    unknown_backends = set(args.backends) - set(BACKENDS)
+    if unknown_backends:
+        parser.error(f'Unknown backends {sorted(unknown_backends)}')
+
+    results = run(args)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(environment=environment(), results=results), f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Regressions beyond {args.tolerance:.0%}: {regressions}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
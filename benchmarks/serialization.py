@@ -0,0 +1,71 @@
+"""
+Compares blue.serialization codecs against superjson.
+
+    python -m benchmarks.serialization [--number N]
+"""
+import argparse
+import json
+import timeit
+
+from blue.base import Action, Adapter, BlueprintInstruction, BlueprintInstructionOutcome, BlueprintInstructionState, Event, Blueprint, \
+    BlueprintExecution
+from blue.serialization import Serializer, JsonCodec, get_codec
+from blue.util import superjson
+
+
+class BenchAction(Action):
+    def act(self, input):
+        pass
+
+
+class BenchAdapter(Adapter):
+    def adapt(self, context, events):
+        pass
+
+
+def sample_objects(instruction_count=10):
+    instructions = [BlueprintInstruction([f'condition_{i}', 'shared'], BlueprintInstructionOutcome(BenchAction, BenchAdapter), ['timeout'])
+                    for i in range(instruction_count)]
+    blueprint = Blueprint('bench', instructions, 'abcdef012345')
+    inline_state = BlueprintInstructionState(instructions[0], 'execution-1')
+    reference_state = BlueprintInstructionState(instructions[0], 'execution-1', blueprint_name='bench', blueprint_version='abcdef012345',
+                                                 instruction_index=0)
+    event = Event('deposit_status', metadata=dict(blueprint_execution_id='execution-1'), body=dict(amount='1.5', currency='btc', confirmations=3))
+    execution = BlueprintExecution('execution-1', dict(order_id='ABC123'), blueprint,
+                                   [BlueprintInstructionState(instruction, 'execution-1') for instruction in instructions])
+    return dict(inline_state=inline_state, reference_state=reference_state, event=event, execution=execution)
+
+
+def candidates():
+    serializers = {'serializer[json]': Serializer(JsonCodec())}
+    try:
+        serializers['serializer[orjson]'] = Serializer(get_codec('orjson'))
+    except ImportError:
+        pass
+    yield 'superjson', superjson, json.loads
+    for name, serializer in serializers.items():
+        yield name, serializer.dumps, serializer.loads
+
+
+def run(number):
+    results = []
+    for object_name, obj in sample_objects().items():
+        for name, dumps, loads in candidates():
+            encoded = dumps(obj)
+            dumps_us = timeit.timeit(lambda: dumps(obj), number=number) / number * 1e6
+            loads_us = timeit.timeit(lambda: loads(encoded), number=number) / number * 1e6
+            results.append(dict(object=object_name, serializer=name, dumps_us=round(dumps_us, 2), loads_us=round(loads_us, 2), size=len(encoded)))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args(argv)
+    print(f"{'object':<16}{'serializer':<22}{'dumps us':>10}{'loads us':>10}{'bytes':>8}")
+    for result in run(args.number):
+        print(f"{result['object']:<16}{result['serializer']:<22}{result['dumps_us']:>10}{result['loads_us']:>10}{result['size']:>8}")
+
+
+if __name__ == '__main__':
+    main()
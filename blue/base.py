@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from enum import auto
-from typing import Optional, Dict, Type, List
+from typing import Optional, Dict, Type, List, Callable, Tuple
 
 from dataclasses import dataclass, field, asdict
 from blue.util import AutoNameEnum, generate_random_id
@@ -17,26 +18,61 @@ class Event:
     topic: str
     metadata: Optional[Dict] = field(default_factory=dict)
     body: Optional[Dict] = field(default_factory=dict)
+    # Position in the EventBus's append-only log, assigned on publish
+    sequence: Optional[int] = field(default=None, compare=False)
 
 
 class EventBus(ABC):
     def __init__(self, config):
-        pass
+        self._listeners = []
+
+    def add_listener(self, listener: Callable[[Event], None]):
+        self._listeners.append(listener)
+
+    def _notify_listeners(self, event: Event):
+        for listener in self._listeners:
+            listener(event)
 
     @abstractmethod
     def publish(self, event: Event):
         pass
 
+    def publish_many(self, events: List[Event]):
+        for event in events:
+            self.publish(event)
+
+    def forget_execution(self, blueprint_execution_id):
+        pass
+
     @abstractmethod
     def get_event(self, topic, blueprint_execution_id) -> Event:
         pass
 
+    def get_events(self, topics: List[str], blueprint_execution_id) -> Dict[str, Event]:
+        event_by_topic = {}
+        for topic in topics:
+            event = self.get_event(topic, blueprint_execution_id)
+            if event:
+                event_by_topic[topic] = event
+        return event_by_topic
+
+    def get_event_history(self, topic, blueprint_execution_id, limit=None) -> List[Event]:
+        # Oldest first. Buses that keep only the latest event return just that one.
+        event = self.get_event(topic, blueprint_execution_id)
+        return [event] if event else []
+
 
 class Action(ABC):
     def __init__(self, event_bus: EventBus, metadata: Dict = None):
         self._metadata = metadata
         self.event_bus = event_bus
 
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
     @abstractmethod
     def act(self, input):
         pass
@@ -46,6 +82,12 @@ class Adapter(ABC):
     def __init__(self, metadata: Dict = None):
         self._metadata = metadata
 
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
     @abstractmethod
     def adapt(self, context, events):
         pass
@@ -61,6 +103,9 @@ class InstructionStatus(AutoNameEnum):
     END = auto()
 
 
+TERMINAL_INSTRUCTION_STATUSES = (InstructionStatus.SUCCESS, InstructionStatus.FAILED, InstructionStatus.END)
+
+
 @dataclass
 class BlueprintInstructionOutcome:
     action: Type[Action]
@@ -72,6 +117,14 @@ class BlueprintInstruction:
     conditions: List[str]
     outcome: BlueprintInstructionOutcome
     termination_conditions: Optional[List[str]] = field(default_factory=list)
+    # Topics the outcome's Action publishes. Only used to compile the blueprint's dependency graph.
+    emits: List[str] = field(default_factory=list)
+
+
+@dataclass
+class Lease:
+    # Whatever the store needs to extend or release the claim, e.g. an SQS receipt handle
+    token: Optional[str] = None
 
 
 @dataclass
@@ -80,12 +133,24 @@ class BlueprintInstructionState:
     blueprint_execution_id: str
     status: InstructionStatus = InstructionStatus.IDLE
     id_: str = field(default_factory=generate_random_id)
+    blueprint_name: Optional[str] = None
+    blueprint_version: Optional[str] = None
+    instruction_index: Optional[int] = None
+    attempts: int = 0
+    lease: Optional[Lease] = field(default=None, compare=False, repr=False)
+
+    @property
+    def instruction_reference(self) -> Optional[Tuple[str, str, int]]:
+        if self.blueprint_name is None or self.blueprint_version is None or self.instruction_index is None:
+            return
+        return self.blueprint_name, self.blueprint_version, self.instruction_index
 
 
 @dataclass
 class Blueprint:
     name: str
     instructions: List[BlueprintInstruction]
+    version: Optional[str] = None
 
 
 @dataclass
@@ -97,8 +162,19 @@ class BlueprintExecution:
 
 
 class BlueprintInstructionExecutionStore(ABC):
+    # Seconds a claimed instruction stays invisible to other workers. None means claims never expire.
+    lease_timeout: Optional[float] = None
+
     def __init__(self, manager, config=None):
         self.manager = manager
+        self._execution_finished_listeners = []
+
+    def add_execution_finished_listener(self, listener: Callable[[str], None]):
+        self._execution_finished_listeners.append(listener)
+
+    def _notify_execution_finished(self, blueprint_execution_id):
+        for listener in self._execution_finished_listeners:
+            listener(blueprint_execution_id)
 
     @abstractmethod
     def _store_blueprint_execution(self, blueprint_execution: BlueprintExecution):
@@ -108,10 +184,17 @@ class BlueprintInstructionExecutionStore(ABC):
     def _store_instruction_state(self, instr_state: BlueprintInstructionState):
         pass
 
+    def _store_instruction_states(self, instr_states: List[BlueprintInstructionState]):
+        for instr_state in instr_states:
+            self._store_instruction_state(instr_state)
+
     def store(self, blueprint_execution: BlueprintExecution):
         self._store_blueprint_execution(blueprint_execution)
-        for instr_state in blueprint_execution.instructions_states:
-            self._store_instruction_state(instr_state)
+        self._store_instruction_states(blueprint_execution.instructions_states)
+
+    def store_many(self, blueprint_executions: List[BlueprintExecution]):
+        for blueprint_execution in blueprint_executions:
+            self.store(blueprint_execution)
 
     def get_instruction_to_process(self, worker_id=None) -> Optional[BlueprintInstructionState]:
         instruction_state = self._get_instruction_to_process(worker_id)
@@ -120,22 +203,57 @@ class BlueprintInstructionExecutionStore(ABC):
         self._set_status_for_instruction(instruction_state, InstructionStatus.PROCESSING)
         return instruction_state
 
+    def get_instructions_to_process(self, worker_id=None, max_count=1) -> List[BlueprintInstructionState]:
+        instruction_states = self._get_instructions_to_process(worker_id, max_count)
+        for instruction_state in instruction_states:
+            self._set_status_for_instruction(instruction_state, InstructionStatus.PROCESSING)
+        return instruction_states
+
     def acknowledge_success(self, instruction_state: BlueprintInstructionState):
         self._set_status_for_instruction(instruction_state, InstructionStatus.SUCCESS)
+        self._release_lease(instruction_state)
+
+    def requeue(self, instruction_state: BlueprintInstructionState, delay: float = None):
+        self._requeue_instruction(instruction_state, delay or 0)
+        self._release_lease(instruction_state)
 
-    def requeue(self, instruction_state: BlueprintInstructionState):
+    def _requeue_instruction(self, instruction_state: BlueprintInstructionState, delay: float):
         self._set_status_for_instruction(instruction_state, InstructionStatus.IDLE)
 
     def report_failure(self, instruction_state: BlueprintInstructionState):
         self._set_status_for_instruction(instruction_state, InstructionStatus.FAILED)
+        self._release_lease(instruction_state)
 
     def end(self, instruction_state: BlueprintInstructionState):
         self._set_status_for_instruction(instruction_state, InstructionStatus.END)
+        self._release_lease(instruction_state)
+
+    def materialize(self, instruction_states: List[BlueprintInstructionState]):
+        # Stores instruction states created after their execution started. Must ignore states that are already stored.
+        self._store_instruction_states(instruction_states)
+
+    def get_execution_blueprint(self, blueprint_execution_id) -> Optional[Blueprint]:
+        pass
+
+    def extend_lease(self, instruction_state: BlueprintInstructionState):
+        pass
+
+    def _release_lease(self, instruction_state: BlueprintInstructionState):
+        instruction_state.lease = None
 
     @abstractmethod
     def _get_instruction_to_process(self, worker_id) -> Optional[BlueprintInstructionState]:
         pass
 
+    def _get_instructions_to_process(self, worker_id, max_count) -> List[BlueprintInstructionState]:
+        instruction_states = []
+        while len(instruction_states) < max_count:
+            instruction_state = self._get_instruction_to_process(worker_id)
+            if not instruction_state:
+                break
+            instruction_states.append(instruction_state)
+        return instruction_states
+
     @abstractmethod
     def _set_status_for_instruction(self, instruction_state: BlueprintInstructionState, status: InstructionStatus):
         pass
@@ -143,3 +261,66 @@ class BlueprintInstructionExecutionStore(ABC):
     @abstractmethod
     def get_execution_context_from_id(self, blueprint_execution_id) -> Dict:
         pass
+
+    def on_event_published(self, event: Event):
+        pass
+
+    @contextmanager
+    def worker_context(self):
+        yield
+
+
+# ------- ASYNC BASE -------- #
+
+class AsyncEventBus(ABC):
+
+    @abstractmethod
+    async def publish(self, event: Event):
+        pass
+
+    async def publish_many(self, events: List[Event]):
+        for event in events:
+            await self.publish(event)
+
+    @abstractmethod
+    async def get_event(self, topic, blueprint_execution_id) -> Event:
+        pass
+
+    async def get_events(self, topics: List[str], blueprint_execution_id) -> Dict[str, Event]:
+        event_by_topic = {}
+        for topic in topics:
+            event = await self.get_event(topic, blueprint_execution_id)
+            if event:
+                event_by_topic[topic] = event
+        return event_by_topic
+
+    async def get_event_history(self, topic, blueprint_execution_id, limit=None) -> List[Event]:
+        event = await self.get_event(topic, blueprint_execution_id)
+        return [event] if event else []
+
+
+class AsyncBlueprintInstructionExecutionStore(ABC):
+
+    @abstractmethod
+    async def get_instructions_to_process(self, worker_id=None, max_count=1) -> List[BlueprintInstructionState]:
+        pass
+
+    @abstractmethod
+    async def acknowledge_success(self, instruction_state: BlueprintInstructionState):
+        pass
+
+    @abstractmethod
+    async def requeue(self, instruction_state: BlueprintInstructionState, delay: float = None):
+        pass
+
+    @abstractmethod
+    async def report_failure(self, instruction_state: BlueprintInstructionState):
+        pass
+
+    @abstractmethod
+    async def end(self, instruction_state: BlueprintInstructionState):
+        pass
+
+    @abstractmethod
+    async def get_execution_context_from_id(self, blueprint_execution_id) -> Dict:
+        pass
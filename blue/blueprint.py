@@ -1,21 +1,84 @@
-from typing import Dict
+import hashlib
+import logging
+from typing import Dict, List, Set
 
-from dataclasses import asdict
+from dataclasses import asdict, dataclass, field
 
 from blue.base import BlueError, BlueprintInstructionOutcome, BlueprintInstruction, Blueprint
+from blue.components import ComponentSpec, SCOPES
+from blue.util import blue_json_dumps
+
+log = logging.getLogger(__name__)
 
 
 class InvalidBlueprintDefinition(BlueError):
     pass
 
 
+class UnknownBlueprintVersion(BlueError):
+    pass
+
+
+@dataclass
+class BlueprintDependencyGraph:
+    """
+    Which instructions of a blueprint wait for topics that other instructions emit.
+
+    Eager instructions only wait for external topics, e.g. the boot event, and are materialized when an execution starts. Lazy
+    instructions are materialized the first time one of their internal condition topics is published.
+    """
+    internal_topics: Set[str]
+    eager_instruction_indexes: List[int]
+    lazy_instruction_indexes_by_topic: Dict[str, List[int]] = field(default_factory=dict)
+    unreachable_instruction_indexes: List[int] = field(default_factory=list)
+
+    @classmethod
+    def compile(cls, blueprint: Blueprint) -> 'BlueprintDependencyGraph':
+        internal_topics = {topic for instruction in blueprint.instructions for topic in instruction.emits}
+        eager_instruction_indexes = []
+        lazy_instruction_indexes_by_topic = {}
+        for index, instruction in enumerate(blueprint.instructions):
+            internal_conditions = [topic for topic in dict.fromkeys(instruction.conditions) if topic in internal_topics]
+            if not internal_conditions:
+                eager_instruction_indexes.append(index)
+            for topic in internal_conditions:
+                lazy_instruction_indexes_by_topic.setdefault(topic, []).append(index)
+
+        # An instruction can fire once every internal condition is emitted by an instruction that can fire itself
+        reachable_indexes = set()
+        reachable_topics = set()
+        changed = True
+        while changed:
+            changed = False
+            for index, instruction in enumerate(blueprint.instructions):
+                if index in reachable_indexes:
+                    continue
+                if all(topic in reachable_topics or topic not in internal_topics for topic in instruction.conditions):
+                    reachable_indexes.add(index)
+                    reachable_topics.update(instruction.emits)
+                    changed = True
+        unreachable_instruction_indexes = [index for index in range(len(blueprint.instructions)) if index not in reachable_indexes]
+        return cls(internal_topics, eager_instruction_indexes, lazy_instruction_indexes_by_topic, unreachable_instruction_indexes)
+
+    @property
+    def pending_instruction_indexes(self) -> List[int]:
+        # Lazy instructions that can still fire when an execution starts. The execution is not finished while any is left to materialize.
+        lazy_indexes = {index for indexes in self.lazy_instruction_indexes_by_topic.values() for index in indexes}
+        return sorted(lazy_indexes - set(self.unreachable_instruction_indexes))
+
+
 class BlueprintManager:
     instruction_outcome_attribute_names = ['action', 'adapter']
 
     def __init__(self, config):
         self.namespace = BlueprintManager.parse_config(config)
+        self.component_specs = BlueprintManager.parse_component_specs(config)
         self.config = config
         self.live_blueprints_by_name = {}
+        self.blueprints_by_name_by_version = {}
+        self.dependency_graphs_by_name_by_version = {}
+        # Topics that materialize a lazy instruction in any known blueprint. Any other topic can skip the lookup of its execution.
+        self.lazy_trigger_topics = set()
 
     @staticmethod
     def parse_config(config):
@@ -26,11 +89,34 @@ class BlueprintManager:
             if each not in config['namespace']:
                 raise InvalidBlueprintDefinition(f"Namespace must have key '{each}'")
             for cls in config['namespace'][each]:
+                if isinstance(cls, dict):
+                    cls = cls['component']
                 if each not in namespace:
                     namespace[each] = {}
                 namespace[each][cls.__qualname__] = cls
         return namespace
 
+    @staticmethod
+    def parse_component_specs(config):
+        # Components are listed either as classes or as dict(component=cls, scope=..., pool_size=...)
+        component_specs = {}
+        for each in BlueprintManager.instruction_outcome_attribute_names:
+            for declaration in config['namespace'][each]:
+                if not isinstance(declaration, dict):
+                    continue
+                if 'component' not in declaration:
+                    raise InvalidBlueprintDefinition(f"Component declaration must have key 'component': {declaration}")
+                try:
+                    spec = ComponentSpec(**{key: value for key, value in declaration.items() if key != 'component'})
+                except TypeError:
+                    raise InvalidBlueprintDefinition(f"Component declaration only takes keys 'component', 'scope' and 'pool_size': {declaration}")
+                if spec.scope not in SCOPES:
+                    raise InvalidBlueprintDefinition(f"Unknown scope {spec.scope} for {declaration['component']}. Must be one of {SCOPES}")
+                if spec.pool_size < 1:
+                    raise InvalidBlueprintDefinition(f"pool_size must be positive: {declaration}")
+                component_specs[declaration['component']] = spec
+        return component_specs
+
     def _validate_blueprint_definition(self, blueprint_definition):
         if not blueprint_definition:
             raise InvalidBlueprintDefinition(f"Blueprint definition seems to be empty")
@@ -56,6 +142,9 @@ class BlueprintManager:
                 if not component_object:
                     raise InvalidBlueprintDefinition(
                         f"As per configured namespace {self.config}, no component is defined for attribute_name={outcome_attribute_name} componenet_name={component_name}")
+            emits = instruction.get('emits', [])
+            if not isinstance(emits, list) or not all(isinstance(topic, str) for topic in emits):
+                raise InvalidBlueprintDefinition(f"Instruction 'emits' must be a list of topics: {instruction}")
 
     def objectify_instruction(self, instruction_definition: Dict, safe=False) -> BlueprintInstruction:
         def _objectify(attribute, component_name):
@@ -68,15 +157,31 @@ class BlueprintManager:
         instruction_dict = dict(conditions=instruction_definition['conditions'], outcome=outcome)
         if instruction_definition.get('termination_conditions'):
             instruction_dict.update(dict(termination_conditions=instruction_definition['termination_conditions']))
+        if instruction_definition.get('emits'):
+            instruction_dict.update(dict(emits=instruction_definition['emits']))
 
         return BlueprintInstruction(**instruction_dict)
 
-    def _convert_blueprint_definition_to_object(self, blueprint_definition) -> Blueprint:
+    @staticmethod
+    def compute_blueprint_version(blueprint_definition) -> str:
+        canonical_definition = blue_json_dumps(blueprint_definition, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(canonical_definition.encode('utf-8')).hexdigest()[:12]
+
+    def _convert_blueprint_definition_to_object(self, blueprint_definition, version=None) -> Blueprint:
         instructions = []
         for definition in blueprint_definition['instructions']:
             instruction: BlueprintInstruction = self.objectify_instruction(definition)
             instructions.append(instruction)
-        return Blueprint(blueprint_definition['name'], instructions)
+        return Blueprint(blueprint_definition['name'], instructions, version or self.compute_blueprint_version(blueprint_definition))
+
+    def _register_blueprint(self, blueprint: Blueprint):
+        self.blueprints_by_name_by_version.setdefault(blueprint.name, {})[blueprint.version] = blueprint
+        dependency_graph = BlueprintDependencyGraph.compile(blueprint)
+        self.dependency_graphs_by_name_by_version.setdefault(blueprint.name, {})[blueprint.version] = dependency_graph
+        self.lazy_trigger_topics.update(dependency_graph.lazy_instruction_indexes_by_topic)
+        if dependency_graph.unreachable_instruction_indexes:
+            log.warning(f"Blueprint {blueprint.name} version {blueprint.version}: instructions {dependency_graph.unreachable_instruction_indexes} "
+                        f"wait for topics that no reachable instruction emits and can never fire")
 
     def add_blueprint(self, blueprint_definition):
         self._validate_blueprint_definition(blueprint_definition)
@@ -86,3 +191,31 @@ class BlueprintManager:
         if preexisting_blueprint:
             raise InvalidBlueprintDefinition(f"Blueprint with name {blueprint.name} is already added: {preexisting_blueprint}")
         self.live_blueprints_by_name[blueprint.name] = blueprint
+        self._register_blueprint(blueprint)
+
+    def add_blueprint_version(self, blueprint_definition, version) -> Blueprint:
+        # Makes an older (e.g. pre-deploy) version resolvable for in-flight executions without making it live
+        existing_blueprint = self.blueprints_by_name_by_version.get(blueprint_definition['name'], {}).get(version)
+        if existing_blueprint:
+            return existing_blueprint
+        self._validate_blueprint_definition(blueprint_definition)
+        blueprint = self._convert_blueprint_definition_to_object(blueprint_definition, version)
+        self._register_blueprint(blueprint)
+        return blueprint
+
+    def get_blueprint(self, name, version) -> Blueprint:
+        blueprint = self.blueprints_by_name_by_version.get(name, {}).get(version)
+        if not blueprint:
+            raise UnknownBlueprintVersion(f"Blueprint {name} with version {version} is not known to this BlueprintManager")
+        return blueprint
+
+    def get_instruction(self, blueprint_name, blueprint_version, instruction_index) -> BlueprintInstruction:
+        return self.get_blueprint(blueprint_name, blueprint_version).instructions[instruction_index]
+
+    def get_dependency_graph(self, blueprint: Blueprint) -> BlueprintDependencyGraph:
+        if self.blueprints_by_name_by_version.get(blueprint.name, {}).get(blueprint.version) is blueprint:
+            return self.dependency_graphs_by_name_by_version[blueprint.name][blueprint.version]
+        # Built by hand instead of through add_blueprint
+        dependency_graph = BlueprintDependencyGraph.compile(blueprint)
+        self.lazy_trigger_topics.update(dependency_graph.lazy_instruction_indexes_by_topic)
+        return dependency_graph
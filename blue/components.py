@@ -0,0 +1,141 @@
+import functools
+import inspect
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Dict, Callable, Optional, FrozenSet
+
+from dataclasses import dataclass
+
+from blue.base import Action, EventBus
+
+log = logging.getLogger(__name__)
+
+SCOPE_PROTOTYPE = 'prototype'
+SCOPE_SINGLETON = 'singleton'
+SCOPE_POOLED = 'pooled'
+SCOPES = (SCOPE_PROTOTYPE, SCOPE_SINGLETON, SCOPE_POOLED)
+
+
+@dataclass(frozen=True)
+class ComponentSpec:
+    scope: str = SCOPE_PROTOTYPE
+    pool_size: int = 4
+
+
+PROTOTYPE = ComponentSpec()
+
+
+@functools.lru_cache(maxsize=None)
+def _keyword_parameters(function) -> Optional[FrozenSet[str]]:
+    parameters = inspect.signature(function).parameters.values()
+    if any(parameter.kind == parameter.VAR_KEYWORD for parameter in parameters):
+        return None
+    return frozenset(parameter.name for parameter in parameters if parameter.kind in (parameter.POSITIONAL_OR_KEYWORD, parameter.KEYWORD_ONLY))
+
+
+def call_kwargs(method, **kwargs) -> Dict:
+    # Per-call values such as metadata are only passed to act/adapt implementations that declare them
+    accepted = _keyword_parameters(getattr(method, '__func__', method))
+    if accepted is None:
+        return kwargs
+    return {name: value for name, value in kwargs.items() if name in accepted}
+
+
+class _ComponentPool:
+    def __init__(self, create: Callable, size):
+        self._create = create
+        self._size = size
+        self._created = []
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def get(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._created) < self._size:
+                component = self._create()
+                self._created.append(component)
+                return component
+        # Every instance is busy
+        return self._idle.get()
+
+    def put(self, component):
+        self._idle.put(component)
+
+    def created(self):
+        with self._lock:
+            return list(self._created)
+
+
+class ComponentProvider:
+    """
+    Hands out Action and Adapter instances to one executor according to the scope they are declared with in the namespace config.
+
+    Prototype components are created, set up and torn down around every call. Singleton and pooled components are created and set up
+    on first use and torn down by close().
+    """
+
+    def __init__(self, component_specs: Dict[type, ComponentSpec], event_bus: EventBus):
+        self.component_specs = component_specs
+        self.event_bus = event_bus
+        self._singletons = {}
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _create(self, component_class):
+        component = component_class(self.event_bus) if issubclass(component_class, Action) else component_class()
+        component.setup()
+        return component
+
+    def _singleton(self, component_class):
+        with self._lock:
+            if component_class not in self._singletons:
+                self._singletons[component_class] = self._create(component_class)
+            return self._singletons[component_class]
+
+    def _pool(self, component_class, size) -> _ComponentPool:
+        with self._lock:
+            if component_class not in self._pools:
+                self._pools[component_class] = _ComponentPool(functools.partial(self._create, component_class), size)
+            return self._pools[component_class]
+
+    def checkout(self, component_class, create_prototype: Callable):
+        spec = self.component_specs.get(component_class, PROTOTYPE)
+        if spec.scope == SCOPE_SINGLETON:
+            return self._singleton(component_class)
+        if spec.scope == SCOPE_POOLED:
+            return self._pool(component_class, spec.pool_size).get()
+        component = create_prototype()
+        component.setup()
+        return component
+
+    def checkin(self, component_class, component):
+        spec = self.component_specs.get(component_class, PROTOTYPE)
+        if spec.scope == SCOPE_POOLED:
+            self._pool(component_class, spec.pool_size).put(component)
+        elif spec.scope == SCOPE_PROTOTYPE:
+            component.teardown()
+
+    @contextmanager
+    def acquire(self, component_class, create_prototype: Callable):
+        component = self.checkout(component_class, create_prototype)
+        try:
+            yield component
+        finally:
+            self.checkin(component_class, component)
+
+    def close(self):
+        with self._lock:
+            components = list(self._singletons.values()) + [each for pool in self._pools.values() for each in pool.created()]
+            self._singletons.clear()
+            self._pools.clear()
+        for component in components:
+            try:
+                component.teardown()
+            except Exception:
+                log.exception(f"Could not tear down {type(component).__name__}")
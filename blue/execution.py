@@ -1,7 +1,15 @@
+import asyncio
+import functools
+import inspect
 import logging
+import random
+import threading
 import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, asynccontextmanager
+from concurrent import futures
 from enum import auto
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional, Tuple
 
 import time
 
@@ -9,11 +17,15 @@ import datetime
 from dataclasses import asdict
 
 from blue.base import BlueError, BlueprintInstructionExecutionStore, EventBus, Event, BlueprintInstructionOutcome, InstructionStatus, BlueprintInstructionState, \
-    Blueprint, BlueprintExecution
+    Blueprint, BlueprintExecution, AsyncEventBus, AsyncBlueprintInstructionExecutionStore
 
 from blue.base import Action, Adapter
 from blue.blueprint import BlueprintManager
-from blue.util import AutoNameEnum
+from blue.components import ComponentProvider, call_kwargs
+from blue.impl.offload import OffloadedEventBus, OffloadedBlueprintInstructionExecutionStore
+from blue.metrics import MetricsSink, NullMetricsSink
+from blue.tracing import Tracer, Span, TracingEventBus, TRACE_METADATA_KEY, current_span, inject, latest_span_context
+from blue.util import AutoNameEnum, LRUCache
 
 log = logging.getLogger(__name__)
 
@@ -23,25 +35,88 @@ class NoActionRequired(BlueError):
 
 
 class BlueprintExecutionManager:
+    MATERIALIZED_INSTRUCTION_CACHE_SIZE = 10000
 
-    def __init__(self, event_bus: EventBus, execution_store: BlueprintInstructionExecutionStore):
+    def __init__(self, event_bus: EventBus, execution_store: BlueprintInstructionExecutionStore, tracer: Tracer = None):
         self.event_bus = event_bus
         self.execution_store = execution_store
-
-    def start_execution(self, blueprint: Blueprint, boot_event: Event, execution_context: Dict):
+        self.blueprint_manager: BlueprintManager = execution_store.manager
+        self.tracer = tracer
+        self._materialized_instruction_ids = LRUCache(self.MATERIALIZED_INSTRUCTION_CACHE_SIZE)
+        # Lazy instructions have to be stored before the store hears about the topic they wait for
+        self.event_bus.add_listener(self._materialize_lazy_instructions)
+        self.event_bus.add_listener(self.execution_store.on_event_published)
+        self.execution_store.add_execution_finished_listener(self.event_bus.forget_execution)
+
+    @staticmethod
+    def _build_instruction_state(blueprint: Blueprint, blueprint_execution_id, index) -> BlueprintInstructionState:
+        # Ids are derived from the position in the blueprint, so materializing the same instruction twice is detectable
+        return BlueprintInstructionState(blueprint.instructions[index], blueprint_execution_id, id_=f'{blueprint_execution_id}:{index}',
+                                         blueprint_name=blueprint.name, blueprint_version=blueprint.version, instruction_index=index)
+
+    def _build_execution(self, blueprint: Blueprint, boot_event: Event, execution_context: Dict) -> BlueprintExecution:
         blueprint_execution_id = str(uuid.uuid4())
         boot_event.metadata['blueprint_execution_id'] = blueprint_execution_id
 
-        instructions_states = []
-        for instruction in blueprint.instructions:
-            instruction_state = BlueprintInstructionState(instruction, blueprint_execution_id)
-            instructions_states.append(instruction_state)
+        instructions_states = [self._build_instruction_state(blueprint, blueprint_execution_id, index)
+                               for index in self.blueprint_manager.get_dependency_graph(blueprint).eager_instruction_indexes]
 
-        blueprint_execution = BlueprintExecution(blueprint_execution_id, execution_context, blueprint, instructions_states)
+        return BlueprintExecution(blueprint_execution_id, execution_context, blueprint, instructions_states)
+
+    def _materialize_lazy_instructions(self, event: Event):
+        # Checked first, so that publishes which cannot materialize anything cost no store lookup
+        if event.topic not in self.blueprint_manager.lazy_trigger_topics:
+            return
+        blueprint_execution_id = event.metadata.get('blueprint_execution_id')
+        if not blueprint_execution_id:
+            return
+        blueprint = self.execution_store.get_execution_blueprint(blueprint_execution_id)
+        if not blueprint:
+            return
+        indexes = self.blueprint_manager.get_dependency_graph(blueprint).lazy_instruction_indexes_by_topic.get(event.topic)
+        if not indexes:
+            return
+        instruction_states = [self._build_instruction_state(blueprint, blueprint_execution_id, index) for index in indexes]
+        instruction_states = [each for each in instruction_states if self._materialized_instruction_ids.get(each.id_) is None]
+        if not instruction_states:
+            return
+        log.info(f"Materializing instructions {[each.instruction_index for each in instruction_states]} of execution {blueprint_execution_id} "
+                 f"on topic {event.topic}")
+        self.execution_store.materialize(instruction_states)
+        for instruction_state in instruction_states:
+            self._materialized_instruction_ids.put(instruction_state.id_, True)
+
+    def _start_trace(self, blueprint_execution: BlueprintExecution, boot_event: Event) -> Optional[Span]:
+        # The root span covers storing the execution; every instruction span descends from it through the boot event
+        if not self.tracer:
+            return
+        span = self.tracer.start_trace('start_execution', dict(blueprint=blueprint_execution.blueprint.name,
+                                                               blueprint_execution_id=blueprint_execution.execution_id))
+        inject(boot_event, span.context)
+        return span
+
+    def _finish_traces(self, spans: List[Optional[Span]]):
+        for span in spans:
+            if span:
+                self.tracer.finish(span)
+
+    def start_execution(self, blueprint: Blueprint, boot_event: Event, execution_context: Dict):
+        blueprint_execution = self._build_execution(blueprint, boot_event, execution_context)
+        span = self._start_trace(blueprint_execution, boot_event)
         self.execution_store.store(blueprint_execution)
         self.event_bus.publish(boot_event)
+        self._finish_traces([span])
         return blueprint_execution
 
+    def start_executions(self, blueprint: Blueprint, boot_events_with_contexts: List[Tuple[Event, Dict]]) -> List[BlueprintExecution]:
+        blueprint_executions = [self._build_execution(blueprint, boot_event, execution_context) for boot_event, execution_context in boot_events_with_contexts]
+        spans = [self._start_trace(blueprint_execution, boot_event)
+                 for blueprint_execution, (boot_event, _) in zip(blueprint_executions, boot_events_with_contexts)]
+        self.execution_store.store_many(blueprint_executions)
+        self.event_bus.publish_many([boot_event for boot_event, _ in boot_events_with_contexts])
+        self._finish_traces(spans)
+        return blueprint_executions
+
 
 class ExecutorRunStatus(AutoNameEnum):
     NO_INSTRUCTION = auto()
@@ -52,12 +127,115 @@ class ExecutorRunStatus(AutoNameEnum):
     OUTCOME_ACTION_FAILED = auto()
 
 
+PHASE_DEQUEUE = 'dequeue'
+PHASE_EVENT_FETCH = 'event_fetch'
+PHASE_TERMINATION_CHECK = 'termination_check'
+PHASE_CONDITION_CHECK = 'condition_check'
+PHASE_CONTEXT_FETCH = 'context_fetch'
+PHASE_ADAPTER = 'adapter'
+PHASE_ACTION = 'action'
+PHASE_ACK = 'ack'
+
+
+class IdleStrategy(ABC):
+
+    @abstractmethod
+    def next_interval(self, found_work: bool) -> float:
+        pass
+
+
+class NoSleepIdleStrategy(IdleStrategy):
+
+    def next_interval(self, found_work: bool) -> float:
+        return 0
+
+
+class FixedIntervalIdleStrategy(IdleStrategy):
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def next_interval(self, found_work: bool) -> float:
+        return self.interval
+
+
+class BackoffIdleStrategy(IdleStrategy):
+    DEFAULT_INITIAL_INTERVAL = 0.1
+    DEFAULT_MULTIPLIER = 2
+
+    def __init__(self, maximum_interval, initial_interval=DEFAULT_INITIAL_INTERVAL, multiplier=DEFAULT_MULTIPLIER):
+        self.maximum_interval = maximum_interval
+        self.initial_interval = initial_interval
+        self.multiplier = multiplier
+        self._next_interval = initial_interval
+
+    def next_interval(self, found_work: bool) -> float:
+        if found_work:
+            self._next_interval = self.initial_interval
+            return 0
+        interval = self._next_interval
+        self._next_interval = min(self._next_interval * self.multiplier, self.maximum_interval)
+        return interval
+
+
+class RequeueBackoff:
+    DEFAULT_BASE_DELAY = 1
+    DEFAULT_MULTIPLIER = 2
+    DEFAULT_MAXIMUM_DELAY = 900
+    DEFAULT_JITTER = 0.5
+
+    def __init__(self, base_delay=DEFAULT_BASE_DELAY, multiplier=DEFAULT_MULTIPLIER, maximum_delay=DEFAULT_MAXIMUM_DELAY, jitter=DEFAULT_JITTER):
+        self.base_delay = base_delay
+        self.multiplier = multiplier
+        self.maximum_delay = maximum_delay
+        self.jitter = jitter
+
+    def delay_for(self, attempts: int) -> float:
+        delay = min(self.base_delay * self.multiplier ** max(attempts - 1, 0), self.maximum_delay)
+        # Jitter spreads out instructions that were requeued together, e.g. everything waiting on the same deposit poll
+        return delay * (1 - self.jitter * random.random())
+
+
+class LeaseHeartbeat:
+    """
+    Keeps extending an instruction state's lease while its outcome runs, so a slow Action is not handed to a second worker.
+    """
+    HEARTBEATS_PER_LEASE = 3
+
+    def __init__(self, execution_store: BlueprintInstructionExecutionStore, instruction_state: BlueprintInstructionState):
+        self.execution_store = execution_store
+        self.instruction_state = instruction_state
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.execution_store.lease_timeout and self.instruction_state.lease:
+            interval = self.execution_store.lease_timeout / self.HEARTBEATS_PER_LEASE
+            self._thread = threading.Thread(target=self._run, args=(interval,), name=f"heartbeat-{self.instruction_state.id_}", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                with self.execution_store.worker_context():
+                    self.execution_store.extend_lease(self.instruction_state)
+            except Exception:
+                log.exception(f"Could not extend lease of instruction_state {self.instruction_state.id_}")
+
+
 class BlueprintExecutor:
     DEFAULT_WORKER_ID = "unnamed"
     DEFAULT_LOOP_INTERVAL = 5
 
     def __init__(self, execution_manager: BlueprintExecutionManager, blueprint_manager: BlueprintManager, worker_id=None, max_iteration_count=None,
-                 no_sleep=False, rundata_callback=None):
+                 no_sleep=False, rundata_callback=None, batch_size=1, idle_strategy: IdleStrategy = None, requeue_backoff: RequeueBackoff = None,
+                 metrics: MetricsSink = None, tracer: Tracer = None):
         self.execution_store: BlueprintInstructionExecutionStore = execution_manager.execution_store
         self.event_bus: EventBus = execution_manager.event_bus
         self.blueprint_manager = blueprint_manager
@@ -65,34 +243,52 @@ class BlueprintExecutor:
         self.iteration_count = 0
         self.max_iteration_count = max_iteration_count
         self.no_sleep = no_sleep
+        self.idle_strategy = idle_strategy or self._default_idle_strategy()
+        self.requeue_backoff = requeue_backoff or RequeueBackoff()
+        self.metrics: MetricsSink = metrics or NullMetricsSink()
+        self.tracer: Optional[Tracer] = tracer or execution_manager.tracer
         self.rundata_callback = rundata_callback
+        self.batch_size = batch_size
+        self.components = ComponentProvider(blueprint_manager.component_specs, self.event_bus)
+        self._stop_requested = threading.Event()
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            self.components.close()
+
+    def _run(self):
         log.info('Starting BlueprintExecutor')
         while True:
 
             self.iteration_count += 1
-            instruction_state: BlueprintInstructionState = self.execution_store.get_instruction_to_process(self.worker_id)
-            if not instruction_state:
-                run_status = ExecutorRunStatus.NO_INSTRUCTION
+            with self._timed_phase(PHASE_DEQUEUE):
+                instruction_states: List[BlueprintInstructionState] = self.execution_store.get_instructions_to_process(self.worker_id, self.batch_size)
+            if not instruction_states:
                 log.info("No Blueprint Execution Instruction State found from execution_store")
-            else:
+                self._report_rundata(None, ExecutorRunStatus.NO_INSTRUCTION)
+
+            for instruction_state in instruction_states:
                 run_status: ExecutorRunStatus = self._process_instruction(instruction_state)
+                self._report_rundata(instruction_state, run_status)
 
-            rundata = {
-                'isotime': datetime.datetime.now().isoformat(),
-                'instruction_state': instruction_state,
-                'worker_id': self.worker_id,
-                'run_status': run_status.value,
-            }
+            if self._reached_max_iterations() or self._stop_requested.is_set():
+                break
+            self._sleep(bool(instruction_states))
 
-            log.info(f"BlueprintExecutor RUNDATA={rundata}")
-            if self.rundata_callback:
-                self.rundata_callback(rundata)
+    def _report_rundata(self, instruction_state: Optional[BlueprintInstructionState], run_status: ExecutorRunStatus):
+        rundata = {
+            'isotime': datetime.datetime.now().isoformat(),
+            'instruction_state': instruction_state,
+            'worker_id': self.worker_id,
+            'run_status': run_status.value,
+        }
 
-            if self._reached_max_iterations():
-                break
-            self._sleep()
+        log.info(f"BlueprintExecutor RUNDATA={rundata}")
+        self.metrics.increment('blue_executor_instructions_total', dict(self._metric_labels(instruction_state), run_status=run_status.value))
+        if self.rundata_callback:
+            self.rundata_callback(rundata)
 
     def _reached_max_iterations(self):
         if self.max_iteration_count and self.iteration_count >= self.max_iteration_count:
@@ -100,69 +296,395 @@ class BlueprintExecutor:
             return True
         return False
 
-    def _sleep(self):
+    def _default_idle_strategy(self) -> IdleStrategy:
         if self.no_sleep:
+            return NoSleepIdleStrategy()
+        return BackoffIdleStrategy(self.DEFAULT_LOOP_INTERVAL)
+
+    def _sleep(self, found_work=False):
+        t = self.idle_strategy.next_interval(found_work)
+        if not t:
             return
-        t = self.DEFAULT_LOOP_INTERVAL
         log.info(f'Sleeping for {t} seconds')
-        time.sleep(t)
-
-    def _check_conditions(self, conditions, blueprint_execution_id):
-        events = []
-        for event_topic in conditions:
-            event: Event = self.event_bus.get_event(event_topic, blueprint_execution_id)
-            if not event:
-                continue
-            events.append(event)
-        return events
+        self._stop_requested.wait(t)
+
+    def stop(self):
+        log.info(f"Stop requested for BlueprintExecutor {self.worker_id}. Finishing in-flight instructions.")
+        self._stop_requested.set()
+
+    @staticmethod
+    def _metric_labels(instruction_state: Optional[BlueprintInstructionState]) -> Dict[str, str]:
+        if not instruction_state:
+            return dict(blueprint='', action='')
+        return dict(blueprint=instruction_state.blueprint_name or '', action=instruction_state.instruction.outcome.action.__name__)
+
+    @contextmanager
+    def _timed_phase(self, phase, instruction_state: BlueprintInstructionState = None):
+        started_at = time.perf_counter()
+        timing = {}
+        try:
+            yield timing
+        finally:
+            timing['seconds'] = time.perf_counter() - started_at
+            self.metrics.observe('blue_executor_phase_seconds', timing['seconds'], dict(self._metric_labels(instruction_state), phase=phase))
+            self._record_phase_on_span(current_span(), phase, timing['seconds'])
+
+    @staticmethod
+    def _record_phase_on_span(span: Optional[Span], phase, seconds):
+        if span:
+            span.attributes.setdefault('phase_ms', {})[phase] = round(seconds * 1000, 3)
+
+    @contextmanager
+    def _instruction_span(self, instruction_state: BlueprintInstructionState, event_by_topic: Dict[str, Event], started_at, fetch_seconds):
+        if not self.tracer:
+            yield None
+            return
+        span = self.tracer.start_span('process_instruction', latest_span_context(event_by_topic.values()), start_time=started_at, attributes=dict(
+            self._metric_labels(instruction_state), blueprint_execution_id=instruction_state.blueprint_execution_id,
+            instruction_state_id=instruction_state.id_, attempts=instruction_state.attempts, worker_id=self.worker_id))
+        self._record_phase_on_span(span, PHASE_EVENT_FETCH, fetch_seconds)
+        token = self.tracer.activate(span)
+        try:
+            yield span
+        finally:
+            self.tracer.deactivate(token)
+            self.tracer.finish(span)
+
+    def _action_event_bus_and_metadata(self, instruction_state: BlueprintInstructionState) -> Tuple[EventBus, Dict]:
+        metadata = dict(blueprint_execution_id=instruction_state.blueprint_execution_id, instruction_state=instruction_state.id_)
+        span = current_span()
+        if not span:
+            return self.event_bus, metadata
+        metadata[TRACE_METADATA_KEY] = span.context.to_metadata()
+        return TracingEventBus(self.event_bus, span.context), metadata
+
+    def _requeue_delay(self, instruction_state: BlueprintInstructionState) -> float:
+        delay = self.requeue_backoff.delay_for(instruction_state.attempts)
+        log.info(f"Requeueing instruction_state {instruction_state.id_} after {instruction_state.attempts} attempts with delay {delay:.2f}s")
+        return delay
+
+    def _fetch_events(self, instruction_state: BlueprintInstructionState) -> Dict[str, Event]:
+        return self.event_bus.get_events(self._watched_topics(instruction_state), instruction_state.blueprint_execution_id)
+
+    @staticmethod
+    def _watched_topics(instruction_state: BlueprintInstructionState) -> List[str]:
+        instruction = instruction_state.instruction
+        return list(dict.fromkeys(instruction.conditions + instruction.termination_conditions))
+
+    @staticmethod
+    def _select_events(topics, event_by_topic: Dict[str, Event]) -> List[Event]:
+        return [event_by_topic[topic] for topic in topics if topic in event_by_topic]
 
     def _execute_outcome(self, instruction_state: BlueprintInstructionState, events: List[Event]):
         outcome = instruction_state.instruction.outcome
-        blueprint_execution_id = instruction_state.blueprint_execution_id
-        execution_context = self.execution_store.get_execution_context_from_id(instruction_state.blueprint_execution_id)
-        log.info(
-            f"Found events {events}. Executing Outcome - Action {outcome.action} with Adapter {outcome.adapter} in context {execution_context}")
-
-        adapter_instance: Adapter = outcome.adapter()
-        adapter_result = adapter_instance.adapt(execution_context, events)
+        with self._timed_phase(PHASE_CONTEXT_FETCH, instruction_state):
+            execution_context = self.execution_store.get_execution_context_from_id(instruction_state.blueprint_execution_id)
+        event_bus, metadata = self._prepare_outcome(instruction_state, events, execution_context)
+        with self._timed_phase(PHASE_ADAPTER, instruction_state):
+            with self.components.acquire(outcome.adapter, outcome.adapter) as adapter_instance:
+                adapter_result = adapter_instance.adapt(execution_context, events, **call_kwargs(adapter_instance.adapt, metadata=metadata,
+                                                                                                   event_bus=event_bus))
         log.info(f"Adapter result - {adapter_result}")
 
-        metadata = dict(blueprint_execution_id=blueprint_execution_id, instruction_state=instruction_state.id_)
-        action_instance: Action = outcome.action(self.event_bus, metadata=metadata)
-        action_result = action_instance.act(adapter_result)
+        with self._timed_phase(PHASE_ACTION, instruction_state):
+            with self.components.acquire(outcome.action, self._action_prototype(outcome, event_bus, metadata)) as action_instance:
+                action_result = action_instance.act(adapter_result, **call_kwargs(action_instance.act, metadata=metadata, event_bus=event_bus))
         log.info(f"Action result - {action_result}")
         return action_result
 
-    def _check_termination_conditions(self, instruction_state: BlueprintInstructionState):
-        if not instruction_state.instruction.termination_conditions:
+    def _prepare_outcome(self, instruction_state: BlueprintInstructionState, events: List[Event], execution_context: Dict) -> Tuple[EventBus, Dict]:
+        outcome = instruction_state.instruction.outcome
+        log.info(
+            f"Found events {events}. Executing Outcome - Action {outcome.action} with Adapter {outcome.adapter} in context {execution_context}")
+        return self._action_event_bus_and_metadata(instruction_state)
+
+    @staticmethod
+    def _action_prototype(outcome, event_bus: EventBus, metadata: Dict) -> Callable:
+        return functools.partial(outcome.action, event_bus, metadata=metadata)
+
+    def _termination_conditions_met(self, instruction_state: BlueprintInstructionState, event_by_topic: Dict[str, Event]):
+        termination_conditions = instruction_state.instruction.termination_conditions
+        if not termination_conditions:
             return False
-        events: List[Event] = self._check_conditions(instruction_state.instruction.termination_conditions, instruction_state.blueprint_execution_id)
-        if len(events) == len(instruction_state.instruction.conditions):
+        events: List[Event] = self._select_events(termination_conditions, event_by_topic)
+        if len(events) == len(termination_conditions):
             log.info(f"Met terminal condition because of events={events}. Ending InstructionState.")
-            self.execution_store.end(instruction_state)
             return True
         return False
 
-    def _process_instruction(self, instruction_state: BlueprintInstructionState) -> Optional[ExecutorRunStatus]:
-        log.info(f"Processing BlueprintInstruction {instruction_state}")
-        if self._check_termination_conditions(instruction_state):
-            return ExecutorRunStatus.TERMINATION_CONDITIONS_MET
-
-        events = self._check_conditions(instruction_state.instruction.conditions, instruction_state.blueprint_execution_id)
+    def _conditions_met(self, instruction_state: BlueprintInstructionState, events: List[Event]):
         if len(events) != len(instruction_state.instruction.conditions):
             log.info(f"Could not find all necessary events to execute outcome. Found: {events} Required: {instruction_state.instruction.conditions}. Skipping.")
-            self.execution_store.requeue(instruction_state)
-            return ExecutorRunStatus.CONDITIONS_NOT_MET
-        try:
-            self._execute_outcome(instruction_state, events)
-        except NoActionRequired:
+            return False
+        return True
+
+    def _process_instruction(self, instruction_state: BlueprintInstructionState) -> Optional[ExecutorRunStatus]:
+        log.info(f"Processing BlueprintInstruction {instruction_state}")
+        started_at = time.time()
+        with self._timed_phase(PHASE_EVENT_FETCH, instruction_state) as fetch_timing:
+            event_by_topic = self._fetch_events(instruction_state)
+        with self._instruction_span(instruction_state, event_by_topic, started_at, fetch_timing['seconds']) as span:
+            run_status = self._process_fetched_instruction(instruction_state, event_by_topic)
+            if span:
+                span.set_attribute('run_status', run_status.value)
+        return run_status
+
+    def _check_conditions(self, instruction_state: BlueprintInstructionState,
+                          event_by_topic: Dict[str, Event]) -> Tuple[Optional[ExecutorRunStatus], List[Event]]:
+        # Returns the run status if the outcome must not be executed, and otherwise the events to execute it with
+        with self._timed_phase(PHASE_TERMINATION_CHECK, instruction_state):
+            termination_conditions_met = self._termination_conditions_met(instruction_state, event_by_topic)
+        if termination_conditions_met:
+            return ExecutorRunStatus.TERMINATION_CONDITIONS_MET, []
+
+        with self._timed_phase(PHASE_CONDITION_CHECK, instruction_state):
+            events = self._select_events(instruction_state.instruction.conditions, event_by_topic)
+            conditions_met = self._conditions_met(instruction_state, events)
+        if not conditions_met:
+            return ExecutorRunStatus.CONDITIONS_NOT_MET, events
+        return None, events
+
+    @staticmethod
+    def _outcome_failure_run_status(error: Exception) -> ExecutorRunStatus:
+        # Only called from an except block, so that log.exception has the traceback
+        if isinstance(error, NoActionRequired):
             log.info("Received NoActionRequired")
-            self.execution_store.requeue(instruction_state)
             return ExecutorRunStatus.OUTCOME_ADAPTER_REJECT
+        log.exception("Unexpected Exception")
+        return ExecutorRunStatus.OUTCOME_ACTION_FAILED
+
+    def _acknowledge(self, execution_store, instruction_state: BlueprintInstructionState, run_status: ExecutorRunStatus):
+        # execution_store is either the sync or the async store. The async one returns an awaitable for the caller to await.
+        if run_status == ExecutorRunStatus.TERMINATION_CONDITIONS_MET:
+            return execution_store.end(instruction_state)
+        if run_status in (ExecutorRunStatus.CONDITIONS_NOT_MET, ExecutorRunStatus.OUTCOME_ADAPTER_REJECT):
+            return execution_store.requeue(instruction_state, self._requeue_delay(instruction_state))
+        if run_status == ExecutorRunStatus.OUTCOME_ACTION_FAILED:
+            return execution_store.report_failure(instruction_state)
+        return execution_store.acknowledge_success(instruction_state)
+
+    def _process_fetched_instruction(self, instruction_state: BlueprintInstructionState, event_by_topic: Dict[str, Event]) -> ExecutorRunStatus:
+        run_status, events = self._check_conditions(instruction_state, event_by_topic)
+        if not run_status:
+            try:
+                with LeaseHeartbeat(self.execution_store, instruction_state):
+                    self._execute_outcome(instruction_state, events)
+            except Exception as e:
+                run_status = self._outcome_failure_run_status(e)
+            else:
+                run_status = ExecutorRunStatus.OUTCOME_ACTION_SUCCESS
+        with self._timed_phase(PHASE_ACK, instruction_state):
+            self._acknowledge(self.execution_store, instruction_state, run_status)
+        return run_status
+
+
+class ThreadedBlueprintExecutor(BlueprintExecutor):
+    DEFAULT_MAX_WORKERS = 8
+
+    def __init__(self, execution_manager: BlueprintExecutionManager, blueprint_manager: BlueprintManager, worker_id=None, max_iteration_count=None,
+                 no_sleep=False, rundata_callback=None, max_workers=None, idle_strategy: IdleStrategy = None,
+                 requeue_backoff: RequeueBackoff = None, metrics: MetricsSink = None, tracer: Tracer = None):
+        super().__init__(execution_manager, blueprint_manager, worker_id=worker_id, max_iteration_count=max_iteration_count, no_sleep=no_sleep,
+                         rundata_callback=rundata_callback, idle_strategy=idle_strategy, requeue_backoff=requeue_backoff, metrics=metrics,
+                         tracer=tracer)
+        self.max_workers = max_workers or self.DEFAULT_MAX_WORKERS
+        self._rundata_lock = threading.Lock()
+
+    def _run(self):
+        log.info(f'Starting ThreadedBlueprintExecutor with {self.max_workers} threads')
+        in_flight = set()
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                if len(in_flight) >= self.max_workers:
+                    _, in_flight = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                in_flight = {future for future in in_flight if not future.done()}
+
+                self.iteration_count += 1
+                free_slots = self.max_workers - len(in_flight)
+                with self._timed_phase(PHASE_DEQUEUE):
+                    instruction_states = self.execution_store.get_instructions_to_process(self.worker_id, free_slots)
+                if not instruction_states:
+                    log.info("No Blueprint Execution Instruction State found from execution_store")
+                    self._report_rundata(None, ExecutorRunStatus.NO_INSTRUCTION)
+
+                for instruction_state in instruction_states:
+                    in_flight.add(pool.submit(self._process_and_report, instruction_state))
+
+                if self._reached_max_iterations() or self._stop_requested.is_set():
+                    break
+                self._sleep(bool(instruction_states))
+            # Leaving the pool's context waits for in-flight instructions to finish
+
+    def _process_and_report(self, instruction_state: BlueprintInstructionState):
+        try:
+            with self.execution_store.worker_context():
+                run_status: ExecutorRunStatus = self._process_instruction(instruction_state)
         except Exception:
-            log.exception("Unexpected Exception")
-            self.execution_store.report_failure(instruction_state)
-            return ExecutorRunStatus.OUTCOME_ACTION_FAILED
-        else:
-            self.execution_store.acknowledge_success(instruction_state)
-            return ExecutorRunStatus.OUTCOME_ACTION_SUCCESS
+            log.exception(f"Unexpected Exception while processing {instruction_state}")
+            raise
+        self._report_rundata(instruction_state, run_status)
+
+    def _report_rundata(self, instruction_state: Optional[BlueprintInstructionState], run_status: ExecutorRunStatus):
+        with self._rundata_lock:
+            super()._report_rundata(instruction_state, run_status)
+
+
+class AsyncBlueprintExecutor(BlueprintExecutor):
+    DEFAULT_MAX_CONCURRENCY = 100
+
+    def __init__(self, execution_manager: BlueprintExecutionManager, blueprint_manager: BlueprintManager, worker_id=None, max_iteration_count=None,
+                 no_sleep=False, rundata_callback=None, max_concurrency=None, async_event_bus: AsyncEventBus = None,
+                 async_execution_store: AsyncBlueprintInstructionExecutionStore = None, idle_strategy: IdleStrategy = None,
+                 requeue_backoff: RequeueBackoff = None, metrics: MetricsSink = None, tracer: Tracer = None):
+        super().__init__(execution_manager, blueprint_manager, worker_id=worker_id, max_iteration_count=max_iteration_count, no_sleep=no_sleep,
+                         rundata_callback=rundata_callback, idle_strategy=idle_strategy, requeue_backoff=requeue_backoff, metrics=metrics,
+                         tracer=tracer)
+        self.max_concurrency = max_concurrency or self.DEFAULT_MAX_CONCURRENCY
+        # Offloaders created here are shut down when run() returns; ones passed in belong to the caller
+        self._owned_offloaders = []
+        if not async_event_bus:
+            async_event_bus = OffloadedEventBus(self.event_bus, worker_context=self.execution_store.worker_context)
+            self._owned_offloaders.append(async_event_bus)
+        if not async_execution_store:
+            async_execution_store = OffloadedBlueprintInstructionExecutionStore(self.execution_store)
+            self._owned_offloaders.append(async_execution_store)
+        self.async_event_bus: AsyncEventBus = async_event_bus
+        self.async_execution_store: AsyncBlueprintInstructionExecutionStore = async_execution_store
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.run_async())
+            if hasattr(loop, 'shutdown_default_executor'):
+                loop.run_until_complete(loop.shutdown_default_executor())
+        finally:
+            loop.close()
+            for offloader in self._owned_offloaders:
+                offloader.shutdown()
+
+    def stop(self):
+        super().stop()
+        # Wakes up an idle backoff in progress instead of letting it run out
+        loop, wakeup = self._loop, self._wakeup
+        if loop and wakeup:
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                pass
+
+    async def run_async(self):
+        log.info(f'Starting AsyncBlueprintExecutor with max_concurrency={self.max_concurrency}')
+        self._loop = asyncio.get_event_loop()
+        self._wakeup = asyncio.Event()
+        if self._stop_requested.is_set():
+            self._wakeup.set()
+        in_flight = set()
+        while True:
+            if len(in_flight) >= self.max_concurrency:
+                _, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            in_flight = {task for task in in_flight if not task.done()}
+
+            self.iteration_count += 1
+            free_slots = self.max_concurrency - len(in_flight)
+            with self._timed_phase(PHASE_DEQUEUE):
+                instruction_states = await self.async_execution_store.get_instructions_to_process(self.worker_id, free_slots)
+            if not instruction_states:
+                log.info("No Blueprint Execution Instruction State found from execution_store")
+                self._report_rundata(None, ExecutorRunStatus.NO_INSTRUCTION)
+
+            for instruction_state in instruction_states:
+                in_flight.add(asyncio.ensure_future(self._process_and_report_async(instruction_state)))
+
+            if self._reached_max_iterations() or self._stop_requested.is_set():
+                break
+            await self._sleep_async(bool(instruction_states))
+
+        if in_flight:
+            await asyncio.wait(in_flight)
+
+    async def _sleep_async(self, found_work=False):
+        t = self.idle_strategy.next_interval(found_work)
+        if t:
+            log.info(f'Sleeping for {t} seconds')
+        # Always yield so that in-flight instructions make progress between dequeues
+        if not t:
+            await asyncio.sleep(0)
+            return
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), t)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _process_and_report_async(self, instruction_state: BlueprintInstructionState):
+        try:
+            run_status: ExecutorRunStatus = await self._process_instruction_async(instruction_state)
+        except Exception:
+            log.exception(f"Unexpected Exception while processing {instruction_state}")
+            raise
+        self._report_rundata(instruction_state, run_status)
+
+    async def _call(self, fn, *args, **kwargs):
+        if inspect.iscoroutinefunction(fn):
+            return await fn(*args, **kwargs)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(self._in_worker_context, fn, *args, **kwargs))
+
+    def _in_worker_context(self, fn, *args, **kwargs):
+        # Sync Actions may publish through a persistent EventBus, which needs a connection of its own in this thread
+        with self.execution_store.worker_context():
+            return fn(*args, **kwargs)
+
+    async def _execute_outcome_async(self, instruction_state: BlueprintInstructionState, events: List[Event]):
+        outcome = instruction_state.instruction.outcome
+        with self._timed_phase(PHASE_CONTEXT_FETCH, instruction_state):
+            execution_context = await self.async_execution_store.get_execution_context_from_id(instruction_state.blueprint_execution_id)
+        event_bus, metadata = self._prepare_outcome(instruction_state, events, execution_context)
+        with self._timed_phase(PHASE_ADAPTER, instruction_state):
+            async with self._acquire_component_async(outcome.adapter, outcome.adapter) as adapter_instance:
+                adapter_result = await self._call(adapter_instance.adapt, execution_context, events,
+                                                  **call_kwargs(adapter_instance.adapt, metadata=metadata, event_bus=event_bus))
+        log.info(f"Adapter result - {adapter_result}")
+
+        with self._timed_phase(PHASE_ACTION, instruction_state):
+            async with self._acquire_component_async(outcome.action, self._action_prototype(outcome, event_bus, metadata)) as action_instance:
+                action_result = await self._call(action_instance.act, adapter_result, **call_kwargs(action_instance.act, metadata=metadata,
+                                                                                                     event_bus=event_bus))
+        log.info(f"Action result - {action_result}")
+        return action_result
+
+    @asynccontextmanager
+    async def _acquire_component_async(self, component_class, create_prototype):
+        # Checking out may block on a busy pool or run a component's setup, so it happens off the event loop
+        component = await self._call(self.components.checkout, component_class, create_prototype)
+        try:
+            yield component
+        finally:
+            await self._call(self.components.checkin, component_class, component)
+
+    async def _process_instruction_async(self, instruction_state: BlueprintInstructionState) -> Optional[ExecutorRunStatus]:
+        log.info(f"Processing BlueprintInstruction {instruction_state}")
+        started_at = time.time()
+        with self._timed_phase(PHASE_EVENT_FETCH, instruction_state) as fetch_timing:
+            event_by_topic = await self.async_event_bus.get_events(self._watched_topics(instruction_state), instruction_state.blueprint_execution_id)
+        with self._instruction_span(instruction_state, event_by_topic, started_at, fetch_timing['seconds']) as span:
+            run_status = await self._process_fetched_instruction_async(instruction_state, event_by_topic)
+            if span:
+                span.set_attribute('run_status', run_status.value)
+        return run_status
+
+    async def _process_fetched_instruction_async(self, instruction_state: BlueprintInstructionState,
+                                                 event_by_topic: Dict[str, Event]) -> ExecutorRunStatus:
+        run_status, events = self._check_conditions(instruction_state, event_by_topic)
+        if not run_status:
+            try:
+                with LeaseHeartbeat(self.execution_store, instruction_state):
+                    await self._execute_outcome_async(instruction_state, events)
+            except Exception as e:
+                run_status = self._outcome_failure_run_status(e)
+            else:
+                run_status = ExecutorRunStatus.OUTCOME_ACTION_SUCCESS
+        with self._timed_phase(PHASE_ACK, instruction_state):
+            await self._acknowledge(self.async_execution_store, instruction_state, run_status)
+        return run_status
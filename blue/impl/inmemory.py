@@ -1,54 +1,332 @@
+import heapq
+import itertools
 import logging
 import random
-from typing import Dict, Optional
+import threading
+import time
+from collections import OrderedDict, Counter, deque
+from typing import Dict, Optional, List
 
-from blue.base import BlueprintInstructionExecutionStore, EventBus, InstructionStatus, BlueprintInstructionState, BlueprintExecution
+from blue.base import BlueError, BlueprintInstructionExecutionStore, EventBus, InstructionStatus, BlueprintInstructionState, BlueprintExecution, Event, Blueprint, \
+    TERMINAL_INSTRUCTION_STATUSES
+from blue.util import LRUCache
 
 log = logging.getLogger(__name__)
 
 
-class InMemoryBlueprintInstructionExecutionStore(BlueprintInstructionExecutionStore):
+class _FifoInstructionQueue:
+
+    def __init__(self):
+        self._ids = OrderedDict()
+
+    def add(self, instruction_id):
+        self._ids[instruction_id] = None
+
+    def discard(self, instruction_id):
+        self._ids.pop(instruction_id, None)
+
+    def pop(self):
+        return self._ids.popitem(last=False)[0]
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class _RandomInstructionQueue:
+
+    def __init__(self):
+        self._ids = []
+        self._position_by_id = {}
+
+    def add(self, instruction_id):
+        if instruction_id in self._position_by_id:
+            return
+        self._position_by_id[instruction_id] = len(self._ids)
+        self._ids.append(instruction_id)
+
+    def discard(self, instruction_id):
+        # Swap-remove keeps removal O(1) at the cost of ordering, which a random queue does not need
+        position = self._position_by_id.pop(instruction_id, None)
+        if position is None:
+            return
+        last_id = self._ids.pop()
+        if position < len(self._ids):
+            self._ids[position] = last_id
+            self._position_by_id[last_id] = position
+
+    def pop(self):
+        instruction_id = self._ids[random.randrange(len(self._ids))]
+        self.discard(instruction_id)
+        return instruction_id
+
+    def __len__(self):
+        return len(self._ids)
 
 
+class InMemoryBlueprintInstructionExecutionStore(BlueprintInstructionExecutionStore):
+    FAIRNESS_RANDOM = 'random'
+    FAIRNESS_FIFO = 'fifo'
 
     def __init__(self, manager, config):
         super().__init__(manager, config)
+        config = config or {}
+        fairness = config.get('fairness', self.FAIRNESS_RANDOM)
+        if fairness not in (self.FAIRNESS_RANDOM, self.FAIRNESS_FIFO):
+            raise BlueError(f"Unknown fairness {fairness}. Must be one of {self.FAIRNESS_RANDOM}, {self.FAIRNESS_FIFO}")
+        self.evict_finished_executions = config.get('evict_finished_executions', True)
         self._stored_blueprint_executions = {}
         self._stored_instruction_states = {}
+        self._instruction_ids_by_execution_id = {}
+        self._active_instruction_count_by_execution_id = Counter()
+        # Lazy instructions not materialized yet count as active, or an execution would be evicted before the topic they wait for is published
+        self._pending_instruction_indexes_by_execution_id = {}
+        # Wakeup index: instructions only become dequeueable once the EventBus has published all their conditions
+        self._published_topics_by_execution_id = {}
+        self._waiting_instruction_ids_by_execution_id_by_topic = {}
+        self._ready_instruction_ids = _FifoInstructionQueue() if fairness == self.FAIRNESS_FIFO else _RandomInstructionQueue()
+        self._count_by_status = Counter()
+        # Requeued instructions with a delay wait in a heap of (not_before, instruction_id) until they are due
+        self._not_before_by_instruction_id = {}
+        self._delayed_instruction_ids = []
+        self._clock = time.monotonic
+        self._lock = threading.RLock()
 
     def _store_blueprint_execution(self, blueprint_execution: BlueprintExecution):
-        self._stored_blueprint_executions[blueprint_execution.execution_id] = blueprint_execution
+        with self._lock:
+            self._stored_blueprint_executions[blueprint_execution.execution_id] = blueprint_execution
+            pending_instruction_indexes = self.manager.get_dependency_graph(blueprint_execution.blueprint).pending_instruction_indexes
+            if pending_instruction_indexes:
+                self._pending_instruction_indexes_by_execution_id[blueprint_execution.execution_id] = set(pending_instruction_indexes)
+                self._active_instruction_count_by_execution_id[blueprint_execution.execution_id] += len(pending_instruction_indexes)
 
     def _store_instruction_state(self, instruction_state: BlueprintInstructionState):
-        self._stored_instruction_states[instruction_state.id_] = instruction_state
+        with self._lock:
+            self._stored_instruction_states[instruction_state.id_] = instruction_state
+            self._instruction_ids_by_execution_id.setdefault(instruction_state.blueprint_execution_id, set()).add(instruction_state.id_)
+            if instruction_state.status not in TERMINAL_INSTRUCTION_STATUSES:
+                self._active_instruction_count_by_execution_id[instruction_state.blueprint_execution_id] += 1
+            self._count_by_status[instruction_state.status] += 1
+            self._schedule(instruction_state)
 
-    def _get_instruction_to_process(self, worker_id) -> Optional[BlueprintInstructionState]:
-        all_idle_ids = [k.id_ for k in self._stored_instruction_states.values() if k.status == InstructionStatus.IDLE]
-        if not all_idle_ids:
+    def materialize(self, instruction_states: List[BlueprintInstructionState]):
+        with self._lock:
+            instruction_states = [each for each in instruction_states if each.blueprint_execution_id in self._stored_blueprint_executions
+                                  and each.id_ not in self._stored_instruction_states]
+            for instruction_state in instruction_states:
+                pending_instruction_indexes = self._pending_instruction_indexes_by_execution_id.get(instruction_state.blueprint_execution_id, set())
+                if instruction_state.instruction_index in pending_instruction_indexes:
+                    pending_instruction_indexes.discard(instruction_state.instruction_index)
+                    self._active_instruction_count_by_execution_id[instruction_state.blueprint_execution_id] -= 1
+            self._store_instruction_states(instruction_states)
+
+    def get_execution_blueprint(self, blueprint_execution_id) -> Optional[Blueprint]:
+        blueprint_execution = self._stored_blueprint_executions.get(blueprint_execution_id)
+        return blueprint_execution.blueprint if blueprint_execution else None
+
+    def _evict_execution(self, blueprint_execution_id):
+        log.info(f"All instructions of execution {blueprint_execution_id} are terminal. Evicting it.")
+        self._stored_blueprint_executions.pop(blueprint_execution_id, None)
+        self._published_topics_by_execution_id.pop(blueprint_execution_id, None)
+        self._active_instruction_count_by_execution_id.pop(blueprint_execution_id, None)
+        self._pending_instruction_indexes_by_execution_id.pop(blueprint_execution_id, None)
+        for instruction_id in self._instruction_ids_by_execution_id.pop(blueprint_execution_id, set()):
+            instruction_state = self._stored_instruction_states.pop(instruction_id)
+            self._not_before_by_instruction_id.pop(instruction_id, None)
+            self._count_by_status[instruction_state.status] -= 1
+            self._ready_instruction_ids.discard(instruction_id)
+            instruction = instruction_state.instruction
+            for topic in set(instruction.conditions) | set(instruction.termination_conditions):
+                waiting_by_execution_id = self._waiting_instruction_ids_by_execution_id_by_topic.get(topic)
+                if waiting_by_execution_id is None:
+                    continue
+                waiting_by_execution_id.pop(blueprint_execution_id, None)
+                if not waiting_by_execution_id:
+                    del self._waiting_instruction_ids_by_execution_id_by_topic[topic]
+
+    def _is_ready(self, instruction_state: BlueprintInstructionState) -> bool:
+        published_topics = self._published_topics_by_execution_id.get(instruction_state.blueprint_execution_id, set())
+        instruction = instruction_state.instruction
+        if set(instruction.conditions) <= published_topics:
+            return True
+        return bool(instruction.termination_conditions) and set(instruction.termination_conditions) <= published_topics
+
+    def _schedule(self, instruction_state: BlueprintInstructionState):
+        if instruction_state.status != InstructionStatus.IDLE:
+            return
+        if self._is_ready(instruction_state):
+            self._mark_ready(instruction_state.id_)
             return
-        instruction_id = random.choice(all_idle_ids)
-        instruction_state = self._stored_instruction_states[instruction_id]
+        published_topics = self._published_topics_by_execution_id.get(instruction_state.blueprint_execution_id, set())
+        instruction = instruction_state.instruction
+        for topic in set(instruction.conditions) | set(instruction.termination_conditions):
+            if topic in published_topics:
+                continue
+            waiting_by_execution_id = self._waiting_instruction_ids_by_execution_id_by_topic.setdefault(topic, {})
+            waiting_by_execution_id.setdefault(instruction_state.blueprint_execution_id, set()).add(instruction_state.id_)
+
+    def _mark_ready(self, instruction_id):
+        not_before = self._not_before_by_instruction_id.get(instruction_id)
+        if not_before is not None and not_before > self._clock():
+            heapq.heappush(self._delayed_instruction_ids, (not_before, instruction_id))
+            return
+        self._not_before_by_instruction_id.pop(instruction_id, None)
+        self._ready_instruction_ids.add(instruction_id)
+
+    def _promote_due_instructions(self):
+        now = self._clock()
+        while self._delayed_instruction_ids and self._delayed_instruction_ids[0][0] <= now:
+            not_before, instruction_id = heapq.heappop(self._delayed_instruction_ids)
+            instruction_state = self._stored_instruction_states.get(instruction_id)
+            if not instruction_state or instruction_state.status != InstructionStatus.IDLE:
+                continue
+            if self._not_before_by_instruction_id.get(instruction_id) != not_before:
+                continue
+            self._mark_ready(instruction_id)
+
+    def on_event_published(self, event: Event):
+        with self._lock:
+            blueprint_execution_id = event.metadata.get('blueprint_execution_id')
+            if blueprint_execution_id not in self._stored_blueprint_executions:
+                return
+            self._published_topics_by_execution_id.setdefault(blueprint_execution_id, set()).add(event.topic)
+            waiting_by_execution_id = self._waiting_instruction_ids_by_execution_id_by_topic.get(event.topic, {})
+            waiting_ids = waiting_by_execution_id.pop(blueprint_execution_id, set())
+            if not waiting_by_execution_id:
+                self._waiting_instruction_ids_by_execution_id_by_topic.pop(event.topic, None)
+            for instruction_id in waiting_ids:
+                instruction_state = self._stored_instruction_states.get(instruction_id)
+                if not instruction_state or instruction_state.status != InstructionStatus.IDLE:
+                    continue
+                if self._is_ready(instruction_state):
+                    self._mark_ready(instruction_id)
+
+    def _pop_ready_instruction(self) -> BlueprintInstructionState:
+        instruction_state = self._stored_instruction_states[self._ready_instruction_ids.pop()]
+        instruction_state.attempts += 1
         return instruction_state
 
+    def _get_instruction_to_process(self, worker_id) -> Optional[BlueprintInstructionState]:
+        with self._lock:
+            self._promote_due_instructions()
+            if not self._ready_instruction_ids:
+                return
+            return self._pop_ready_instruction()
+
+    def _get_instructions_to_process(self, worker_id, max_count) -> List[BlueprintInstructionState]:
+        with self._lock:
+            self._promote_due_instructions()
+            count = min(max_count, len(self._ready_instruction_ids))
+            return [self._pop_ready_instruction() for _ in range(count)]
+
+    def _requeue_instruction(self, instruction_state: BlueprintInstructionState, delay: float):
+        with self._lock:
+            if delay:
+                self._not_before_by_instruction_id[instruction_state.id_] = self._clock() + delay
+            super()._requeue_instruction(instruction_state, delay)
+
+    def get_instruction_to_process(self, worker_id=None) -> Optional[BlueprintInstructionState]:
+        # Dequeue and the PROCESSING transition must be atomic, or a concurrent publish could mark the instruction ready again
+        with self._lock:
+            return super().get_instruction_to_process(worker_id)
+
+    def get_instructions_to_process(self, worker_id=None, max_count=1) -> List[BlueprintInstructionState]:
+        with self._lock:
+            return super().get_instructions_to_process(worker_id, max_count)
+
     def _set_status_for_instruction(self, instruction_state: BlueprintInstructionState, status: InstructionStatus):
-        stored_instruction_state = self._stored_instruction_states[instruction_state.id_]
-        stored_instruction_state.status = status
+        finished_execution_id = None
+        with self._lock:
+            stored_instruction_state = self._stored_instruction_states[instruction_state.id_]
+            blueprint_execution_id = stored_instruction_state.blueprint_execution_id
+            if stored_instruction_state.status not in TERMINAL_INSTRUCTION_STATUSES and status in TERMINAL_INSTRUCTION_STATUSES:
+                self._active_instruction_count_by_execution_id[blueprint_execution_id] -= 1
+                if not self._active_instruction_count_by_execution_id[blueprint_execution_id]:
+                    finished_execution_id = blueprint_execution_id
+            self._count_by_status[stored_instruction_state.status] -= 1
+            self._count_by_status[status] += 1
+            stored_instruction_state.status = status
+            if status == InstructionStatus.IDLE:
+                self._schedule(stored_instruction_state)
+            else:
+                self._ready_instruction_ids.discard(stored_instruction_state.id_)
+            if finished_execution_id and self.evict_finished_executions:
+                self._evict_execution(finished_execution_id)
+        if finished_execution_id and self.evict_finished_executions:
+            self._notify_execution_finished(finished_execution_id)
         return stored_instruction_state
 
+    def count_by_status(self) -> Dict[InstructionStatus, int]:
+        with self._lock:
+            return {status: self._count_by_status[status] for status in InstructionStatus}
+
+    def count_ready(self) -> int:
+        return len(self._ready_instruction_ids)
+
     def get_execution_context_from_id(self, blueprint_execution_id) -> Dict:
         return self._stored_blueprint_executions.get(blueprint_execution_id).execution_context
 
 
 class InMemoryEventBus(EventBus):
+    DEFAULT_HISTORY_LIMIT = 1
+    DEFAULT_FORGOTTEN_EXECUTION_LIMIT = 100000
 
     def __init__(self, config):
         super().__init__(config)
-        self.event_by_blueprint_execution_id_by_topic = {}
+        config = config or {}
+        # Only the last history_limit events per (topic, execution) are retained. The deques drop older ones as new ones are appended.
+        self.history_limit = config.get('event_history', {}).get('limit', self.DEFAULT_HISTORY_LIMIT)
+        if self.history_limit is not None and self.history_limit < 1:
+            raise BlueError(f"Event history limit must be at least 1, got {self.history_limit}")
+        self.events_by_blueprint_execution_id_by_topic = {}
+        self._topics_by_execution_id = {}
+        self._sequence = itertools.count(1)
+        # Tombstones of forgotten executions, so that events published for them later are not kept forever. Bounded, oldest dropped first.
+        self._forgotten_execution_ids = LRUCache(config.get('forgotten_execution_limit', self.DEFAULT_FORGOTTEN_EXECUTION_LIMIT))
+        self._lock = threading.Lock()
 
     def publish(self, event):
-        if event.topic not in self.event_by_blueprint_execution_id_by_topic:
-            self.event_by_blueprint_execution_id_by_topic[event.topic] = {}
-        self.event_by_blueprint_execution_id_by_topic[event.topic][event.metadata.get('blueprint_execution_id', 'notfound')] = event
+        blueprint_execution_id = event.metadata.get('blueprint_execution_id', 'notfound')
+        with self._lock:
+            event.sequence = next(self._sequence)
+            if self._forgotten_execution_ids.get(blueprint_execution_id):
+                log.info(f"Dropping event {event.topic} for forgotten execution {blueprint_execution_id}")
+                return
+            events_by_blueprint_execution_id = self.events_by_blueprint_execution_id_by_topic.setdefault(event.topic, {})
+            if blueprint_execution_id not in events_by_blueprint_execution_id:
+                events_by_blueprint_execution_id[blueprint_execution_id] = deque(maxlen=self.history_limit)
+            events_by_blueprint_execution_id[blueprint_execution_id].append(event)
+            self._topics_by_execution_id.setdefault(blueprint_execution_id, set()).add(event.topic)
+        self._notify_listeners(event)
+
+    @property
+    def event_by_blueprint_execution_id_by_topic(self) -> Dict[str, Dict[str, Event]]:
+        # Read-only snapshot in the shape this attribute had before history was kept: the latest event per (topic, execution)
+        with self._lock:
+            return {topic: {blueprint_execution_id: events[-1] for blueprint_execution_id, events in events_by_blueprint_execution_id.items()}
+                    for topic, events_by_blueprint_execution_id in self.events_by_blueprint_execution_id_by_topic.items()}
+
+    def forget_execution(self, blueprint_execution_id):
+        with self._lock:
+            self._forgotten_execution_ids.put(blueprint_execution_id, True)
+            for topic in self._topics_by_execution_id.pop(blueprint_execution_id, set()):
+                events_by_blueprint_execution_id = self.events_by_blueprint_execution_id_by_topic[topic]
+                del events_by_blueprint_execution_id[blueprint_execution_id]
+                if not events_by_blueprint_execution_id:
+                    del self.events_by_blueprint_execution_id_by_topic[topic]
 
     def get_event(self, topic, blueprint_execution_id):
-        return self.event_by_blueprint_execution_id_by_topic.get(topic, {}).get(blueprint_execution_id)
+        events = self.events_by_blueprint_execution_id_by_topic.get(topic, {}).get(blueprint_execution_id)
+        return events[-1] if events else None
+
+    def get_events(self, topics, blueprint_execution_id) -> Dict[str, Event]:
+        event_by_topic = {}
+        for topic in topics:
+            events = self.events_by_blueprint_execution_id_by_topic.get(topic, {}).get(blueprint_execution_id)
+            if events:
+                event_by_topic[topic] = events[-1]
+        return event_by_topic
+
+    def get_event_history(self, topic, blueprint_execution_id, limit=None) -> List[Event]:
+        with self._lock:
+            events = list(self.events_by_blueprint_execution_id_by_topic.get(topic, {}).get(blueprint_execution_id, ()))
+        return events[-limit:] if limit else events
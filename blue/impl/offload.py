@@ -0,0 +1,78 @@
+import asyncio
+import contextlib
+import functools
+import logging
+from concurrent import futures
+from typing import Dict, List
+
+from blue.base import AsyncEventBus, AsyncBlueprintInstructionExecutionStore, EventBus, BlueprintInstructionExecutionStore, Event, \
+    BlueprintInstructionState
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 32
+
+
+class _Offloader:
+    def __init__(self, max_workers=None, worker_context=None):
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers or DEFAULT_MAX_WORKERS)
+        # e.g. a store's worker_context, so that each offloaded call uses and returns its own database connection
+        self._worker_context = worker_context or contextlib.nullcontext
+
+    def _in_worker_context(self, fn, *args, **kwargs):
+        with self._worker_context():
+            return fn(*args, **kwargs)
+
+    async def _offload(self, fn, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(self._in_worker_context, fn, *args, **kwargs))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class OffloadedEventBus(_Offloader, AsyncEventBus):
+
+    def __init__(self, event_bus: EventBus, max_workers=None, worker_context=None):
+        super().__init__(max_workers, worker_context)
+        self.event_bus = event_bus
+
+    async def publish(self, event: Event):
+        return await self._offload(self.event_bus.publish, event)
+
+    async def publish_many(self, events: List[Event]):
+        return await self._offload(self.event_bus.publish_many, events)
+
+    async def get_event(self, topic, blueprint_execution_id) -> Event:
+        return await self._offload(self.event_bus.get_event, topic, blueprint_execution_id)
+
+    async def get_events(self, topics: List[str], blueprint_execution_id) -> Dict[str, Event]:
+        return await self._offload(self.event_bus.get_events, topics, blueprint_execution_id)
+
+    async def get_event_history(self, topic, blueprint_execution_id, limit=None) -> List[Event]:
+        return await self._offload(self.event_bus.get_event_history, topic, blueprint_execution_id, limit)
+
+
+class OffloadedBlueprintInstructionExecutionStore(_Offloader, AsyncBlueprintInstructionExecutionStore):
+
+    def __init__(self, execution_store: BlueprintInstructionExecutionStore, max_workers=None):
+        super().__init__(max_workers, execution_store.worker_context)
+        self.execution_store = execution_store
+
+    async def get_instructions_to_process(self, worker_id=None, max_count=1) -> List[BlueprintInstructionState]:
+        return await self._offload(self.execution_store.get_instructions_to_process, worker_id, max_count)
+
+    async def acknowledge_success(self, instruction_state: BlueprintInstructionState):
+        return await self._offload(self.execution_store.acknowledge_success, instruction_state)
+
+    async def requeue(self, instruction_state: BlueprintInstructionState, delay: float = None):
+        return await self._offload(self.execution_store.requeue, instruction_state, delay)
+
+    async def report_failure(self, instruction_state: BlueprintInstructionState):
+        return await self._offload(self.execution_store.report_failure, instruction_state)
+
+    async def end(self, instruction_state: BlueprintInstructionState):
+        return await self._offload(self.execution_store.end, instruction_state)
+
+    async def get_execution_context_from_id(self, blueprint_execution_id) -> Dict:
+        return await self._offload(self.execution_store.get_execution_context_from_id, blueprint_execution_id)
@@ -1,21 +1,56 @@
+import datetime
 import json
 import logging
-from typing import Dict, Optional
+import math
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, List
 
 import boto3
-from dataclasses import asdict
-from peewee import Model, CharField, Proxy, DoesNotExist
-from playhouse.postgres_ext import PostgresqlExtDatabase, JSONField
+from peewee import Model, CharField, Proxy, DoesNotExist, IntegerField, DateTimeField, fn
+from playhouse.migrate import PostgresqlMigrator, migrate
+from playhouse.pool import PooledPostgresqlExtDatabase
+from playhouse.postgres_ext import JSONField
 
-from blue.base import BlueprintInstructionExecutionStore, BlueprintExecution, BlueprintInstructionState, InstructionStatus, EventBus, \
-    Event
-from blue.blueprint import BlueprintManager
-from blue.util import blue_json_dumps, superjson
+from blue.base import BlueError, BlueprintInstructionExecutionStore, BlueprintExecution, BlueprintInstructionState, InstructionStatus, EventBus, \
+    Event, BlueprintInstruction, Blueprint, Lease, TERMINAL_INSTRUCTION_STATUSES
+from blue.blueprint import BlueprintManager, UnknownBlueprintVersion
+from blue.serialization import Serializer, SerializationError, get_codec
+from blue.util import blue_json_dumps, chunks, LRUCache, generate_random_id
 
 database_proxy = Proxy()  # Create a proxy for our db.
 
 log = logging.getLogger(__name__)
 
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_STALE_TIMEOUT = 300
+
+_database_by_key = {}
+_database_lock = threading.Lock()
+
+
+def create_database(config) -> PooledPostgresqlExtDatabase:
+    """
+    Builds a connection pool from config['db'] (connection parameters) and config['db_pool']
+    (max_connections, stale_timeout, timeout).
+    """
+    pool_config = config.get('db_pool', {})
+    return PooledPostgresqlExtDatabase(
+        max_connections=pool_config.get('max_connections', DEFAULT_MAX_CONNECTIONS),
+        stale_timeout=pool_config.get('stale_timeout', DEFAULT_STALE_TIMEOUT),
+        timeout=pool_config.get('timeout'),
+        **config['db']
+    )
+
+
+def get_database(config) -> PooledPostgresqlExtDatabase:
+    # Event bus, store and archiver built from the same config share one pool, and with it database_proxy
+    key = json.dumps([config['db'], config.get('db_pool', {})], sort_keys=True)
+    with _database_lock:
+        if key not in _database_by_key:
+            _database_by_key[key] = create_database(config)
+        return _database_by_key[key]
+
 
 class BaseModel(Model):
     class Meta:
@@ -26,59 +61,242 @@ class BlueprintExecutionModel(BaseModel):
     execution_id = CharField(unique=True)
     execution_context = JSONField()
     blueprint = JSONField(dumps=blue_json_dumps)
+    # Indexes of lazy instructions not materialized yet. The execution is not finished while any remain. NULL once none are left.
+    pending_instruction_indexes = JSONField(null=True)
 
 
 class BlueprintInstructionStateModel(BaseModel):
     instruction_state_id = CharField(unique=True)
     blueprint_execution_id = CharField()
-    instruction = JSONField(dumps=blue_json_dumps)
+    # Either a reference into a blueprint version known to BlueprintManager or, for legacy rows, the full instruction
+    blueprint_name = CharField(null=True)
+    blueprint_version = CharField(null=True)
+    instruction_index = IntegerField(null=True)
+    instruction = JSONField(dumps=blue_json_dumps, null=True)
     status = CharField()
+    # Only used by PostgresQueueBlueprintInstructionExecutionStore, which claims rows directly instead of going through SQS
+    available_at = DateTimeField(null=True)
+    lease_expires_at = DateTimeField(null=True)
+    leased_by = CharField(null=True)
+    attempts = IntegerField(default=0)
 
 
 class EventModel(BaseModel):
     topic = CharField()
+    blueprint_execution_id = CharField(null=True)
     metadata = JSONField(dumps=blue_json_dumps)
     body = JSONField(dumps=blue_json_dumps)
 
+    class Meta:
+        # Append-only: every publish is a new row, and the latest event per (topic, execution) is the one with the highest id
+        indexes = (
+            (('topic', 'blueprint_execution_id', 'id'), False),
+        )
+
+    @property
+    def sequence(self):
+        return self.id
+
+
+class BlueprintExecutionArchiveModel(BlueprintExecutionModel):
+    pass
+
+
+class BlueprintInstructionStateArchiveModel(BlueprintInstructionStateModel):
+    pass
+
+
+class EventArchiveModel(EventModel):
+    class Meta:
+        indexes = (
+            (('blueprint_execution_id',), False),
+        )
+
+
+@contextmanager
+def _borrowed_connection(db):
+    # Hands a connection opened only for setup back to the pool instead of pinning it to the constructing thread
+    if not db.is_closed():
+        yield
+        return
+    with db.connection_context():
+        yield
+
+
+def _add_missing_columns(db, model, field_names) -> List[str]:
+    table_name = model._meta.table_name
+    if not db.table_exists(table_name):
+        return []
+    existing_columns = {column.name for column in db.get_columns(table_name)}
+    missing_field_names = [field_name for field_name in field_names if model._meta.fields[field_name].column_name not in existing_columns]
+    if missing_field_names:
+        log.info(f"Migrating {table_name}: adding columns {missing_field_names}")
+        migrator = PostgresqlMigrator(db)
+        migrate(*[migrator.add_column(table_name, model._meta.fields[field_name].column_name, model._meta.fields[field_name])
+                  for field_name in missing_field_names])
+    return missing_field_names
+
+
+QUEUE_FIELD_NAMES = ['available_at', 'lease_expires_at', 'leased_by', 'attempts']
+
 
 class PersistentEventBus(EventBus):
-    def __init__(self, config):
+    MAX_INSERT_BATCH_SIZE = 1000
+    # Index that made (topic, blueprint_execution_id) unique while publish was an upsert
+    UPSERT_INDEX_NAME = 'eventmodel_topic_blueprint_execution_id'
+
+    def __init__(self, config, database=None):
         super().__init__(config)
-        self.db = PostgresqlExtDatabase(**config['db'])
+        self.db = database or get_database(config)
         database_proxy.initialize(self.db)
-        self._migrations()
+        with _borrowed_connection(self.db):
+            self._migrations()
 
     def _migrations(self):
+        table_name = EventModel._meta.table_name
+        if self.db.table_exists(table_name):
+            columns = {column.name for column in self.db.get_columns(table_name)}
+            if 'blueprint_execution_id' not in columns:
+                self._migrate_blueprint_execution_id_column()
+            self.db.execute_sql(f'DROP INDEX IF EXISTS "{self.UPSERT_INDEX_NAME}"')
         self.db.create_tables([EventModel], safe=True)
 
+    def _migrate_blueprint_execution_id_column(self):
+        # Promotes metadata->>'blueprint_execution_id' to an indexed column
+        table_name = EventModel._meta.table_name
+        log.info(f"Migrating {table_name}: adding blueprint_execution_id column")
+        migrator = PostgresqlMigrator(self.db)
+        with self.db.atomic():
+            migrate(migrator.add_column(table_name, 'blueprint_execution_id', EventModel.blueprint_execution_id))
+            EventModel.update(blueprint_execution_id=EventModel.metadata['blueprint_execution_id']).execute()
+
+    @staticmethod
+    def _event_row(event: Event) -> Dict:
+        return dict(topic=event.topic, blueprint_execution_id=event.metadata['blueprint_execution_id'], body=event.body, metadata=event.metadata)
+
+    def _append(self, events: List[Event]):
+        # Plain inserts never wait on each other, unlike an upsert of the same (topic, execution) row
+        rows = [self._event_row(event) for event in events]
+        with self.db.atomic():
+            for batch_events, batch_rows in zip(chunks(events, self.MAX_INSERT_BATCH_SIZE), chunks(rows, self.MAX_INSERT_BATCH_SIZE)):
+                for event, (sequence,) in zip(batch_events, EventModel.insert_many(batch_rows).returning(EventModel.id).tuples().execute()):
+                    event.sequence = sequence
+
     def publish(self, event: Event):
-        exec_id = event.metadata['blueprint_execution_id']
-        existing_event = self.get_event(event.topic, exec_id)
-        if not existing_event:
-            newevent = EventModel(topic=event.topic, body=event.body, metadata=event.metadata)
-            newevent.save()
-        else:
-            existing_event.body = event.body
-            existing_event.metadata = event.metadata
-            existing_event.save()
+        self._append([event])
+        self._notify_listeners(event)
+
+    def publish_many(self, events: List[Event]):
+        self._append(events)
+        for event in events:
+            self._notify_listeners(event)
 
     def get_event(self, topic: str, blueprint_execution_id: str):
-        try:
-            eventmodel = EventModel.get((EventModel.topic == topic) & (EventModel.metadata['blueprint_execution_id'] == blueprint_execution_id))
-            return eventmodel
-        except DoesNotExist as e:
-            return
+        return EventModel.select().where((EventModel.topic == topic) & (EventModel.blueprint_execution_id == blueprint_execution_id)).order_by(
+            EventModel.id.desc()).first()
+
+    def get_events(self, topics: List[str], blueprint_execution_id: str) -> Dict[str, Event]:
+        if not topics:
+            return {}
+        eventmodels = EventModel.select().where(
+            (EventModel.topic.in_(list(topics))) & (EventModel.blueprint_execution_id == blueprint_execution_id)
+        ).distinct(EventModel.topic).order_by(EventModel.topic, EventModel.id.desc())
+        return {eventmodel.topic: eventmodel for eventmodel in eventmodels}
+
+    def get_event_history(self, topic, blueprint_execution_id, limit=None) -> List[Event]:
+        query = EventModel.select().where((EventModel.topic == topic) & (EventModel.blueprint_execution_id == blueprint_execution_id)).order_by(
+            EventModel.id.desc())
+        if limit:
+            query = query.limit(limit)
+        return list(reversed(list(query)))
+
+
+MAX_EVENT_ID = 2 ** 63 - 1
+
+
+class PersistentEventCompactor:
+    """
+    Deletes all but the latest config['event_history']['limit'] events per (topic, execution), since PersistentEventBus only ever appends.
+    """
+    DEFAULT_HISTORY_LIMIT = 1
+    DEFAULT_BATCH_SIZE = 5000
+    DEFAULT_INTERVAL = 60
+
+    def __init__(self, config, database=None):
+        history_config = config.get('event_history', {})
+        self.history_limit = history_config.get('limit', self.DEFAULT_HISTORY_LIMIT)
+        if self.history_limit < 1:
+            raise BlueError(f"Event history limit must be at least 1, got {self.history_limit}")
+        self.batch_size = history_config.get('batch_size', self.DEFAULT_BATCH_SIZE)
+        self.interval = history_config.get('interval', self.DEFAULT_INTERVAL)
+        self.db = database or get_database(config)
+        database_proxy.initialize(self.db)
+        self._stop_requested = threading.Event()
+
+    def _compact_range(self, lower, upper) -> int:
+        # Only rows with lower < id <= upper are inspected; the EXISTS probe walks the (topic, execution, id) index of each one
+        table = EventModel._meta.table_name
+        cursor = self.db.execute_sql(
+            f'DELETE FROM "{table}" WHERE "id" IN ('
+            f'SELECT e."id" FROM "{table}" AS e WHERE e."id" > %s AND e."id" <= %s AND EXISTS ('
+            f'SELECT 1 FROM "{table}" AS n WHERE n."topic" = e."topic" AND n."blueprint_execution_id" = e."blueprint_execution_id" '
+            f'AND n."id" > e."id" ORDER BY n."id" OFFSET %s LIMIT 1))',
+            (lower, upper, self.history_limit - 1))
+        return cursor.rowcount
+
+    def compact(self) -> int:
+        deleted_count = 0
+        lower = 0
+        while not self._stop_requested.is_set():
+            upper = EventModel.select(EventModel.id).where(EventModel.id > lower).order_by(EventModel.id) \
+                .offset(self.batch_size - 1).limit(1).scalar()
+            deleted_count += self._compact_range(lower, upper if upper is not None else MAX_EVENT_ID)
+            if upper is None:
+                break
+            lower = upper
+        if deleted_count:
+            log.info(f"Compacted {deleted_count} superseded events")
+        return deleted_count
+
+    def run(self, max_iteration_count=None):
+        log.info('Starting PersistentEventCompactor')
+        iteration_count = 0
+        while not self._stop_requested.is_set():
+            iteration_count += 1
+            self.compact()
+            if max_iteration_count and iteration_count >= max_iteration_count:
+                break
+            self._stop_requested.wait(self.interval)
+
+    def stop(self):
+        self._stop_requested.set()
 
 
 class PersistentBlueprintInstructionExecutionStore(BlueprintInstructionExecutionStore):
-
-    def __init__(self, manager: BlueprintManager, config):
+    MAX_RECEIVE_BATCH_SIZE = 10
+    MAX_SEND_BATCH_SIZE = 10
+    MAX_INSERT_BATCH_SIZE = 1000
+    MAX_VISIBILITY_TIMEOUT = 43200
+    DEFAULT_WAIT_TIME_SECONDS = 20
+    DEFAULT_VISIBILITY_TIMEOUT = 30
+    DEFAULT_EXECUTION_CONTEXT_CACHE_SIZE = 10000
+
+    def __init__(self, manager: BlueprintManager, config, database=None):
         super().__init__(manager, config)
         self.config = config
-        self.db = PostgresqlExtDatabase(**config['db'])
+        self.db = database or get_database(config)
+        self.lease_timeout = self._configured_lease_timeout(config)
         self._initialize()
-        self._migrations()
-        self.receipthandle_by_instructionstateid = dict()
+        with _borrowed_connection(self.db):
+            self._migrations()
+        self._wait_time_seconds = config.get('sqs', {}).get('wait_time_seconds', self.DEFAULT_WAIT_TIME_SECONDS)
+        cache_config = config.get('execution_context_cache', {})
+        self.serializer = Serializer(get_codec(config.get('serialization', {}).get('codec', 'auto')))
+        self.execution_context_cache = LRUCache(cache_config.get('max_size', self.DEFAULT_EXECUTION_CONTEXT_CACHE_SIZE), ttl=cache_config.get('ttl'))
+        self.blueprint_reference_cache = LRUCache(cache_config.get('max_size', self.DEFAULT_EXECUTION_CONTEXT_CACHE_SIZE))
+
+    def _configured_lease_timeout(self, config):
+        return config.get('sqs', {}).get('visibility_timeout', self.DEFAULT_VISIBILITY_TIMEOUT)
 
     def remove_effects(self):
         self.sqs.delete_queue(QueueUrl=self._queue_url)
@@ -86,8 +304,9 @@ class PersistentBlueprintInstructionExecutionStore(BlueprintInstructionExecution
 
     def _initialize(self):
         database_proxy.initialize(self.db)
-        sqs_region = self.config.get('sqs', {}).get('region_name')
-        kwargs = {} if not sqs_region else dict(region_name=sqs_region)
+        sqs_config = self.config.get('sqs', {})
+        # endpoint_url points the store at a local SQS stand-in such as ElasticMQ or moto_server
+        kwargs = {key: sqs_config[key] for key in ('region_name', 'endpoint_url') if sqs_config.get(key)}
         self.sqs = boto3.client('sqs', **kwargs)
 
     def _get_queue_name(self):
@@ -104,73 +323,425 @@ class PersistentBlueprintInstructionExecutionStore(BlueprintInstructionExecution
             return False
 
         queue_name = self._get_queue_name()
-        self.db.create_tables([BlueprintExecutionModel, BlueprintInstructionStateModel], safe=True)
+        self._migrate_tables()
         if not does_queue_exist(queue_name):
-            response = self.sqs.create_queue(QueueName=queue_name)
+            response = self.sqs.create_queue(QueueName=queue_name, Attributes=dict(VisibilityTimeout=str(int(self.lease_timeout))))
             self._queue_url = response['QueueUrl']
 
+    def _migrate_tables(self):
+        with self.db.atomic():
+            if _add_missing_columns(self.db, BlueprintInstructionStateModel, ['blueprint_name', 'blueprint_version', 'instruction_index']):
+                migrate(PostgresqlMigrator(self.db).drop_not_null(BlueprintInstructionStateModel._meta.table_name, 'instruction'))
+            _add_missing_columns(self.db, BlueprintInstructionStateModel, QUEUE_FIELD_NAMES)
+            _add_missing_columns(self.db, BlueprintExecutionModel, ['pending_instruction_indexes'])
+        self.db.create_tables([BlueprintExecutionModel, BlueprintInstructionStateModel], safe=True)
+
     def _store_blueprint_execution(self, blueprint_execution: BlueprintExecution):
-        bem = BlueprintExecutionModel(execution_id=blueprint_execution.execution_id, execution_context=blueprint_execution.execution_context,
-                                      blueprint=asdict(blueprint_execution.blueprint))
-        bem.save()
+        self._insert_blueprint_executions([blueprint_execution])
+
+    def _insert_blueprint_executions(self, blueprint_executions: List[BlueprintExecution]):
+        blueprint_definition_by_id = {}
+        pending_instruction_indexes_by_id = {}
+        rows = []
+        for blueprint_execution in blueprint_executions:
+            blueprint = blueprint_execution.blueprint
+            if id(blueprint) not in blueprint_definition_by_id:
+                blueprint_definition_by_id[id(blueprint)] = Serializer.encode_blueprint(blueprint)
+                pending_instruction_indexes_by_id[id(blueprint)] = self.manager.get_dependency_graph(blueprint).pending_instruction_indexes or None
+            rows.append(dict(execution_id=blueprint_execution.execution_id, execution_context=blueprint_execution.execution_context,
+                             blueprint=blueprint_definition_by_id[id(blueprint)],
+                             pending_instruction_indexes=pending_instruction_indexes_by_id[id(blueprint)]))
+        for batch in chunks(rows, self.MAX_INSERT_BATCH_SIZE):
+            BlueprintExecutionModel.insert_many(batch).execute()
+
+    @staticmethod
+    def _instruction_state_row(instruction_state: BlueprintInstructionState) -> Dict:
+        row = dict(instruction_state_id=instruction_state.id_, blueprint_execution_id=instruction_state.blueprint_execution_id,
+                   status=instruction_state.status.value, blueprint_name=instruction_state.blueprint_name,
+                   blueprint_version=instruction_state.blueprint_version, instruction_index=instruction_state.instruction_index, instruction=None)
+        if not instruction_state.instruction_reference:
+            row['instruction'] = Serializer.encode_instruction(instruction_state.instruction)
+        return row
+
+    def _message_body(self, instruction_state: BlueprintInstructionState) -> str:
+        return self.serializer.dumps(instruction_state)
+
+    def _insert_instruction_states(self, instruction_states: List[BlueprintInstructionState]):
+        rows = [self._instruction_state_row(each) for each in instruction_states]
+        for batch in chunks(rows, self.MAX_INSERT_BATCH_SIZE):
+            BlueprintInstructionStateModel.insert_many(batch).execute()
+
+    def _enqueue(self, instruction_states: List[BlueprintInstructionState]):
+        for batch in chunks(instruction_states, self.MAX_SEND_BATCH_SIZE):
+            response = self.sqs.send_message_batch(
+                QueueUrl=self._queue_url,
+                Entries=[dict(Id=str(i), MessageBody=self._message_body(instruction_state)) for i, instruction_state in enumerate(batch)]
+            )
+            for failure in response.get('Failed', []):
+                instruction_state = batch[int(failure['Id'])]
+                log.warning(f"Batch enqueue failed for instruction_state {instruction_state.id_}: {failure}. Retrying individually.")
+                self.sqs.send_message(
+                    QueueUrl=self._queue_url,
+                    MessageBody=self._message_body(instruction_state)
+                )
 
     def _store_instruction_state(self, instruction_state: BlueprintInstructionState):
-        instruction_definition = asdict(instruction_state.instruction)
-        instr_state_model = BlueprintInstructionStateModel(instruction_state_id=instruction_state.id_,
-                                                           blueprint_execution_id=instruction_state.blueprint_execution_id, instruction=instruction_definition,
-                                                           status=instruction_state.status.value)
-        instr_state_model.save()
-        self.sqs.send_message(
-            QueueUrl=self._queue_url,
-            MessageBody=superjson(instruction_state)
-        )
+        self._store_instruction_states([instruction_state])
 
-    def _get_instruction_to_process(self, worker_id) -> Optional[BlueprintInstructionState]:
-        response = self.sqs.receive_message(QueueUrl=self._queue_url, MaxNumberOfMessages=1)
-        messages = response.get('Messages')
-        if not messages:
-            return
-        b = json.loads(messages[0]['Body'])
-        self.receipthandle_by_instructionstateid[b['id_']] = messages[0]['ReceiptHandle']
+    def _store_instruction_states(self, instruction_states: List[BlueprintInstructionState]):
+        with self.db.atomic():
+            self._insert_instruction_states(instruction_states)
+        self._enqueue(instruction_states)
 
+    def store(self, blueprint_execution: BlueprintExecution):
+        self.store_many([blueprint_execution])
+
+    def store_many(self, blueprint_executions: List[BlueprintExecution]):
+        # Messages are only sent once the rows are committed, so a worker can never receive an instruction it cannot lock
+        instruction_states = [each for blueprint_execution in blueprint_executions for each in blueprint_execution.instructions_states]
+        with self.db.atomic():
+            self._insert_blueprint_executions(blueprint_executions)
+            self._insert_instruction_states(instruction_states)
+        for blueprint_execution in blueprint_executions:
+            self.execution_context_cache.put(blueprint_execution.execution_id, dict(blueprint_execution.execution_context))
+            self.blueprint_reference_cache.put(blueprint_execution.execution_id, (blueprint_execution.blueprint.name, blueprint_execution.blueprint.version))
+        self._enqueue(instruction_states)
+
+    def materialize(self, instruction_states: List[BlueprintInstructionState]):
+        # Several workers may see the same upstream topic published, so only the worker whose insert wins enqueues the instruction
+        with self.db.atomic():
+            # The execution row lock keeps PersistentExecutionArchiver from archiving the execution while instructions are added to it
+            pending_instruction_indexes_by_execution_id = {model.execution_id: model.pending_instruction_indexes for model in BlueprintExecutionModel.select(
+                BlueprintExecutionModel.execution_id, BlueprintExecutionModel.pending_instruction_indexes).where(
+                BlueprintExecutionModel.execution_id.in_({each.blueprint_execution_id for each in instruction_states})).order_by(
+                BlueprintExecutionModel.execution_id).for_update()}
+            instruction_states = [each for each in instruction_states if each.blueprint_execution_id in pending_instruction_indexes_by_execution_id]
+            if not instruction_states:
+                return
+            inserted = BlueprintInstructionStateModel.insert_many([self._instruction_state_row(each) for each in instruction_states]).on_conflict_ignore(
+            ).returning(BlueprintInstructionStateModel.instruction_state_id).execute()
+            inserted_ids = {model.instruction_state_id for model in inserted}
+            instruction_states = [each for each in instruction_states if each.id_ in inserted_ids]
+            for blueprint_execution_id, pending_instruction_indexes in pending_instruction_indexes_by_execution_id.items():
+                materialized_indexes = {each.instruction_index for each in instruction_states if each.blueprint_execution_id == blueprint_execution_id}
+                if not pending_instruction_indexes or not materialized_indexes & set(pending_instruction_indexes):
+                    continue
+                remaining_indexes = [index for index in pending_instruction_indexes if index not in materialized_indexes]
+                BlueprintExecutionModel.update(pending_instruction_indexes=remaining_indexes or None).where(
+                    BlueprintExecutionModel.execution_id == blueprint_execution_id).execute()
+        self._enqueue(instruction_states)
+
+    def get_execution_blueprint(self, blueprint_execution_id) -> Optional[Blueprint]:
+        reference = self.blueprint_reference_cache.get(blueprint_execution_id)
+        if reference is None:
+            model: BlueprintExecutionModel = BlueprintExecutionModel.select(BlueprintExecutionModel.blueprint).where(
+                BlueprintExecutionModel.execution_id == blueprint_execution_id).first()
+            # Executions stored before blueprints were versioned materialized all their instructions up front
+            if not model or not model.blueprint.get('version'):
+                return
+            reference = (model.blueprint['name'], model.blueprint['version'])
+            self.blueprint_reference_cache.put(blueprint_execution_id, reference)
+        return self._resolve_blueprint(blueprint_execution_id, *reference)
+
+    def _receive_messages(self, max_count) -> List[Dict]:
+        # Long polling returns as soon as a message arrives, instead of an empty response that the executor has to sleep on
+        response = self.sqs.receive_message(QueueUrl=self._queue_url, MaxNumberOfMessages=min(max_count, self.MAX_RECEIVE_BATCH_SIZE),
+                                            WaitTimeSeconds=self._wait_time_seconds, AttributeNames=['ApproximateReceiveCount'])
+        return response.get('Messages', [])
+
+    def _resolve_blueprint(self, blueprint_execution_id, blueprint_name, blueprint_version) -> Blueprint:
         try:
-            instruction_state_model = BlueprintInstructionStateModel.select().for_update().where(
-                (BlueprintInstructionStateModel.instruction_state_id == b['id_']) & (BlueprintInstructionStateModel.status == InstructionStatus.IDLE.value)).get()
-        except DoesNotExist:
-            instruction_state_model = None
+            return self.manager.get_blueprint(blueprint_name, blueprint_version)
+        except UnknownBlueprintVersion:
+            # Instruction was enqueued by a different deploy. The execution row holds the blueprint it was started with.
+            model: BlueprintExecutionModel = BlueprintExecutionModel.select(BlueprintExecutionModel.blueprint).where(
+                BlueprintExecutionModel.execution_id == blueprint_execution_id).get()
+            log.info(f"Loading blueprint {blueprint_name} version {blueprint_version} from execution {blueprint_execution_id}")
+            return self.manager.add_blueprint_version(model.blueprint, blueprint_version)
+
+    def _resolve_instruction(self, blueprint_execution_id, blueprint_name, blueprint_version, instruction_index) -> BlueprintInstruction:
+        return self._resolve_blueprint(blueprint_execution_id, blueprint_name, blueprint_version).instructions[instruction_index]
+
+    def _instruction_state_from_message_body(self, b) -> BlueprintInstructionState:
+        if 'ref' not in b:
+            return self.serializer.decode_instruction_state(b, self.manager.objectify_instruction(b['instruction']))
+        blueprint_name, blueprint_version, instruction_index = b['ref']
+        instruction = self._resolve_instruction(b['blueprint_execution_id'], blueprint_name, blueprint_version, instruction_index)
+        return self.serializer.decode_instruction_state(b, instruction)
+
+    def _get_instructions_to_process(self, worker_id, max_count) -> List[BlueprintInstructionState]:
+        messages = self._receive_messages(max_count)
+        if not messages:
+            return []
+
+        bodies = []
+        receipthandle_by_instructionstateid = {}
+        attempts_by_instructionstateid = {}
+        for message in messages:
+            try:
+                b = self.serializer.loads(message['Body'])
+            except SerializationError:
+                # Left on the queue, so it is redelivered after the visibility timeout and eventually moved to a dead letter queue
+                log.exception(f"Skipping undecodable message {message['MessageId']}")
+                continue
+            receipthandle_by_instructionstateid[b['id_']] = message['ReceiptHandle']
+            attempts_by_instructionstateid[b['id_']] = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+            bodies.append(b)
+
+        locked_models = BlueprintInstructionStateModel.select(BlueprintInstructionStateModel.instruction_state_id).for_update().where(
+            (BlueprintInstructionStateModel.instruction_state_id.in_([b['id_'] for b in bodies])) &
+            (BlueprintInstructionStateModel.status == InstructionStatus.IDLE.value))
+        locked_ids = {model.instruction_state_id for model in locked_models}
+
+        instruction_states = []
+        for b in bodies:
+            if b['id_'] not in locked_ids:
+                log.info(f"Got message with body {b} but did not get corresponding row in table. Might be a race condition.")
+                continue
+            locked_ids.discard(b['id_'])
+            instruction_state = self._instruction_state_from_message_body(b)
+            instruction_state.attempts = attempts_by_instructionstateid[b['id_']]
+            instruction_state.lease = Lease(token=receipthandle_by_instructionstateid[b['id_']])
+            instruction_states.append(instruction_state)
+        return instruction_states
 
-        if not instruction_state_model:
-            log.info("Got message with body {b} but did not get corresponding row in table. Might be a race condition.")
+    def _get_instruction_to_process(self, worker_id) -> Optional[BlueprintInstructionState]:
+        instruction_states = self._get_instructions_to_process(worker_id, 1)
+        if not instruction_states:
             return
-
-        return BlueprintInstructionState(
-            instruction=self.manager.objectify_instruction(b['instruction']),
-            blueprint_execution_id=b['blueprint_execution_id'],
-            status=InstructionStatus(b['status']),
-            id_=b['id_']
-        )
+        return instruction_states[0]
 
     def _remove_from_queue(self, instruction_state: BlueprintInstructionState):
         self.sqs.delete_message(
             QueueUrl=self._queue_url,
-            ReceiptHandle=self.receipthandle_by_instructionstateid[instruction_state.id_]
+            ReceiptHandle=instruction_state.lease.token
         )
 
+    def _change_visibility(self, instruction_state: BlueprintInstructionState, timeout: float):
+        # SQS takes whole seconds. Rounding up keeps a sub-second delay from making the message visible right away.
+        self.sqs.change_message_visibility(QueueUrl=self._queue_url, ReceiptHandle=instruction_state.lease.token,
+                                           VisibilityTimeout=min(math.ceil(timeout), self.MAX_VISIBILITY_TIMEOUT))
+
+    def extend_lease(self, instruction_state: BlueprintInstructionState):
+        if instruction_state.lease:
+            self._change_visibility(instruction_state, self.lease_timeout)
+
+    def _requeue_instruction(self, instruction_state: BlueprintInstructionState, delay: float):
+        self._set_status_for_instruction(instruction_state, InstructionStatus.IDLE)
+        # Without a delay the message becomes visible again once the current visibility timeout runs out
+        if delay:
+            self._change_visibility(instruction_state, delay)
+
+    def worker_context(self):
+        # Each executor thread talks to Postgres over its own connection
+        return self.db.connection_context()
+
     def _set_status_for_instruction(self, instruction_state: BlueprintInstructionState, status: InstructionStatus):
         log.info(f"Setting instruction_state {instruction_state.id_}'s status to be {status}")
-        terminal_states = [InstructionStatus.SUCCESS, InstructionStatus.FAILED, InstructionStatus.END]
         instruction_state.status = status
         BlueprintInstructionStateModel.update(status=status.value).where(BlueprintInstructionStateModel.instruction_state_id == instruction_state.id_).execute()
-        if instruction_state.status in terminal_states:
+        if instruction_state.status in TERMINAL_INSTRUCTION_STATUSES:
             self._remove_from_queue(instruction_state)
         else:
             # We're relying on the visibility timeout to retry
             pass
 
     def get_execution_context_from_id(self, blueprint_execution_id) -> Dict:
-        model: BlueprintExecutionModel = BlueprintExecutionModel.select().where(BlueprintExecutionModel.execution_id == blueprint_execution_id).get()
-        return dict(model.execution_context)
+        # execution_context never changes after start_execution, so it is safe to serve from cache
+        execution_context = self.execution_context_cache.get(blueprint_execution_id)
+        if execution_context is None:
+            model: BlueprintExecutionModel = BlueprintExecutionModel.select().where(BlueprintExecutionModel.execution_id == blueprint_execution_id).get()
+            execution_context = dict(model.execution_context)
+            self.execution_context_cache.put(blueprint_execution_id, execution_context)
+        return dict(execution_context)
 
     def get_instruction_to_process(self, worker_id=None) -> Optional[BlueprintInstructionState]:
         with self.db.atomic():
-            return super().get_instruction_to_process(worker_id)
\ No newline at end of file
+            return super().get_instruction_to_process(worker_id)
+
+    def get_instructions_to_process(self, worker_id=None, max_count=1) -> List[BlueprintInstructionState]:
+        with self.db.atomic():
+            return super().get_instructions_to_process(worker_id, max_count)
+
+
+class PostgresQueueBlueprintInstructionExecutionStore(PersistentBlueprintInstructionExecutionStore):
+    """
+    Uses BlueprintInstructionStateModel itself as the queue. Workers claim IDLE rows with FOR UPDATE SKIP LOCKED and hold them under a
+    lease; rows whose lease expired without a status change (e.g. the worker died) can be claimed again.
+    """
+    DEFAULT_LEASE_TIMEOUT = 300
+
+    def _configured_lease_timeout(self, config):
+        return config.get('queue', {}).get('lease_timeout', self.DEFAULT_LEASE_TIMEOUT)
+
+    def remove_effects(self):
+        self.db.drop_tables([BlueprintExecutionModel, BlueprintInstructionStateModel], safe=True)
+
+    def _initialize(self):
+        database_proxy.initialize(self.db)
+
+    def _migrations(self):
+        self._migrate_tables()
+        table_name = BlueprintInstructionStateModel._meta.table_name
+        # Rows written before the queue columns existed, or by the SQS backed store, have no available_at yet
+        BlueprintInstructionStateModel.update(available_at=fn.now()).where(
+            (BlueprintInstructionStateModel.status == InstructionStatus.IDLE.value) & (BlueprintInstructionStateModel.available_at.is_null())).execute()
+        self.db.execute_sql(f'CREATE INDEX IF NOT EXISTS "{table_name}_idle_available_at" ON "{table_name}" (available_at) '
+                            f"WHERE status = '{InstructionStatus.IDLE.value}'")
+        self.db.execute_sql(f'CREATE INDEX IF NOT EXISTS "{table_name}_processing_lease_expires_at" ON "{table_name}" (lease_expires_at) '
+                            f"WHERE status = '{InstructionStatus.PROCESSING.value}'")
+
+    def _instruction_state_row(self, instruction_state: BlueprintInstructionState) -> Dict:
+        row = super()._instruction_state_row(instruction_state)
+        row['available_at'] = fn.now()
+        return row
+
+    def _enqueue(self, instruction_states: List[BlueprintInstructionState]):
+        # The committed row is the queue entry
+        pass
+
+    def _instruction_state_from_model(self, model: BlueprintInstructionStateModel) -> BlueprintInstructionState:
+        if model.instruction_index is None:
+            instruction = self.manager.objectify_instruction(model.instruction)
+        else:
+            instruction = self._resolve_instruction(model.blueprint_execution_id, model.blueprint_name, model.blueprint_version, model.instruction_index)
+        return BlueprintInstructionState(
+            instruction=instruction,
+            blueprint_execution_id=model.blueprint_execution_id,
+            status=InstructionStatus(model.status),
+            id_=model.instruction_state_id,
+            blueprint_name=model.blueprint_name,
+            blueprint_version=model.blueprint_version,
+            instruction_index=model.instruction_index,
+            attempts=model.attempts
+        )
+
+    def _claim(self, worker_id, max_count) -> List[BlueprintInstructionState]:
+        claimable = BlueprintInstructionStateModel.select(BlueprintInstructionStateModel.id).where(
+            ((BlueprintInstructionStateModel.status == InstructionStatus.IDLE.value) &
+             (BlueprintInstructionStateModel.available_at.is_null() | (BlueprintInstructionStateModel.available_at <= fn.now()))) |
+            ((BlueprintInstructionStateModel.status == InstructionStatus.PROCESSING.value) & (BlueprintInstructionStateModel.lease_expires_at < fn.now()))
+        ).order_by(BlueprintInstructionStateModel.available_at.asc(nulls='first')).limit(max_count).for_update('FOR UPDATE SKIP LOCKED')
+        # A fresh token per claim, so a worker whose lease expired cannot act on a row that another claim has taken over since
+        lease_token = f'{worker_id}:{generate_random_id()}'
+        claimed_models = BlueprintInstructionStateModel.update(
+            status=InstructionStatus.PROCESSING.value,
+            leased_by=lease_token,
+            lease_expires_at=fn.now() + datetime.timedelta(seconds=self.lease_timeout),
+            attempts=BlueprintInstructionStateModel.attempts + 1
+        ).where(BlueprintInstructionStateModel.id.in_(claimable)).returning(BlueprintInstructionStateModel).execute()
+        instruction_states = []
+        for model in claimed_models:
+            instruction_state = self._instruction_state_from_model(model)
+            instruction_state.lease = Lease(token=model.leased_by)
+            instruction_states.append(instruction_state)
+        return instruction_states
+
+    def _get_instructions_to_process(self, worker_id, max_count) -> List[BlueprintInstructionState]:
+        return self._claim(worker_id, max_count)
+
+    def get_instruction_to_process(self, worker_id=None) -> Optional[BlueprintInstructionState]:
+        instruction_states = self.get_instructions_to_process(worker_id, 1)
+        if not instruction_states:
+            return
+        return instruction_states[0]
+
+    def get_instructions_to_process(self, worker_id=None, max_count=1) -> List[BlueprintInstructionState]:
+        # Claimed rows are already PROCESSING, so there is no separate status update
+        with self.db.atomic():
+            return self._claim(worker_id, max_count)
+
+    @staticmethod
+    def _leased(instruction_state: BlueprintInstructionState):
+        where = BlueprintInstructionStateModel.instruction_state_id == instruction_state.id_
+        if instruction_state.lease:
+            where &= BlueprintInstructionStateModel.leased_by == instruction_state.lease.token
+        return where
+
+    def _update_leased(self, instruction_state: BlueprintInstructionState, **values) -> bool:
+        if BlueprintInstructionStateModel.update(**values).where(self._leased(instruction_state)).execute():
+            return True
+        log.warning(f"Lease on instruction_state {instruction_state.id_} was lost to another claim. Dropping update {values}.")
+        return False
+
+    def extend_lease(self, instruction_state: BlueprintInstructionState):
+        if instruction_state.lease:
+            self._update_leased(instruction_state, lease_expires_at=fn.now() + datetime.timedelta(seconds=self.lease_timeout))
+
+    def _requeue_instruction(self, instruction_state: BlueprintInstructionState, delay: float):
+        log.info(f"Requeueing instruction_state {instruction_state.id_} with a delay of {delay} seconds")
+        if self._update_leased(instruction_state, status=InstructionStatus.IDLE.value, leased_by=None, lease_expires_at=None,
+                               available_at=fn.now() + datetime.timedelta(seconds=delay)):
+            instruction_state.status = InstructionStatus.IDLE
+
+    def _set_status_for_instruction(self, instruction_state: BlueprintInstructionState, status: InstructionStatus):
+        log.info(f"Setting instruction_state {instruction_state.id_}'s status to be {status}")
+        if self._update_leased(instruction_state, status=status.value, leased_by=None, lease_expires_at=None):
+            instruction_state.status = status
+
+
+class PersistentExecutionArchiver:
+    DEFAULT_BATCH_SIZE = 500
+    DEFAULT_INTERVAL = 60
+    archive_model_by_model = {
+        BlueprintExecutionModel: BlueprintExecutionArchiveModel,
+        BlueprintInstructionStateModel: BlueprintInstructionStateArchiveModel,
+        EventModel: EventArchiveModel,
+    }
+
+    def __init__(self, config, database=None):
+        self.config = config
+        retention_config = config.get('retention', {})
+        self.batch_size = retention_config.get('batch_size', self.DEFAULT_BATCH_SIZE)
+        self.interval = retention_config.get('interval', self.DEFAULT_INTERVAL)
+        self.db = database or get_database(config)
+        database_proxy.initialize(self.db)
+        with _borrowed_connection(self.db):
+            self._migrations()
+        self._stop_requested = threading.Event()
+
+    def _migrations(self):
+        _add_missing_columns(self.db, BlueprintInstructionStateArchiveModel, QUEUE_FIELD_NAMES)
+        _add_missing_columns(self.db, BlueprintExecutionArchiveModel, ['pending_instruction_indexes'])
+        self.db.create_tables(list(self.archive_model_by_model.values()), safe=True)
+
+    def remove_effects(self):
+        self.db.drop_tables(list(self.archive_model_by_model.values()), safe=True)
+
+    def _move_rows(self, model, where):
+        archive_model = self.archive_model_by_model[model]
+        field_names = [field.name for field in model._meta.sorted_fields if field is not model._meta.primary_key]
+        rows = model.select(*[getattr(model, field_name) for field_name in field_names]).where(where)
+        archive_model.insert_from(rows, [getattr(archive_model, field_name) for field_name in field_names]).execute()
+        return model.delete().where(where).execute()
+
+    def archive_finished_executions(self) -> int:
+        # An execution is finished once none of its instruction states can run again and no lazy instruction is left to materialize
+        active_instruction_states = BlueprintInstructionStateModel.select(BlueprintInstructionStateModel.id).where(
+            (BlueprintInstructionStateModel.blueprint_execution_id == BlueprintExecutionModel.execution_id) &
+            (BlueprintInstructionStateModel.status.not_in([status.value for status in TERMINAL_INSTRUCTION_STATUSES])))
+        with self.db.atomic():
+            finished_executions = BlueprintExecutionModel.select(BlueprintExecutionModel.execution_id).where(
+                BlueprintExecutionModel.pending_instruction_indexes.is_null() & ~fn.EXISTS(active_instruction_states)).limit(self.batch_size).for_update('FOR UPDATE SKIP LOCKED')
+            execution_ids = [each.execution_id for each in finished_executions]
+            if not execution_ids:
+                return 0
+            self._move_rows(BlueprintExecutionModel, BlueprintExecutionModel.execution_id.in_(execution_ids))
+            self._move_rows(BlueprintInstructionStateModel, BlueprintInstructionStateModel.blueprint_execution_id.in_(execution_ids))
+            self._move_rows(EventModel, EventModel.blueprint_execution_id.in_(execution_ids))
+        log.info(f"Archived {len(execution_ids)} finished executions")
+        return len(execution_ids)
+
+    def run(self, max_iteration_count=None):
+        log.info('Starting PersistentExecutionArchiver')
+        iteration_count = 0
+        while not self._stop_requested.is_set():
+            iteration_count += 1
+            while self.archive_finished_executions() == self.batch_size and not self._stop_requested.is_set():
+                pass
+            if max_iteration_count and iteration_count >= max_iteration_count:
+                break
+            self._stop_requested.wait(self.interval)
+
+    def stop(self):
+        self._stop_requested.set()
@@ -0,0 +1,142 @@
+import bisect
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class MetricsSink(ABC):
+    @abstractmethod
+    def observe(self, name: str, value: float, labels: Dict[str, str]):
+        pass
+
+    @abstractmethod
+    def increment(self, name: str, labels: Dict[str, str], amount: float = 1):
+        pass
+
+
+class NullMetricsSink(MetricsSink):
+    def observe(self, name: str, value: float, labels: Dict[str, str]):
+        pass
+
+    def increment(self, name: str, labels: Dict[str, str], amount: float = 1):
+        pass
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_bucket_counts(self):
+        total = 0
+        for bucket, count in zip(self.buckets, self.bucket_counts):
+            total += count
+            yield bucket, total
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+
+class InMemoryMetricsSink(MetricsSink):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms_by_name = defaultdict(dict)
+        self.counters_by_name = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, labels: Dict[str, str]):
+        key = _label_key(labels)
+        with self._lock:
+            histograms = self.histograms_by_name[name]
+            if key not in histograms:
+                histograms[key] = Histogram(self.buckets)
+            histograms[key].observe(value)
+
+    def increment(self, name: str, labels: Dict[str, str], amount: float = 1):
+        key = _label_key(labels)
+        with self._lock:
+            counters = self.counters_by_name[name]
+            counters[key] = counters.get(key, 0) + amount
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        return self.histograms_by_name.get(name, {}).get(_label_key(labels))
+
+    def counter(self, name: str, **labels) -> float:
+        return self.counters_by_name.get(name, {}).get(_label_key(labels), 0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key: Tuple, **extra) -> str:
+    items = list(key) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in items) + '}'
+
+
+class PrometheusExporter:
+    """
+    Renders an InMemoryMetricsSink in the Prometheus text exposition format, optionally over HTTP.
+    """
+
+    def __init__(self, sink: InMemoryMetricsSink):
+        self.sink = sink
+        self._server = None
+
+    def render(self) -> str:
+        lines = []
+        with self.sink._lock:
+            for name, histograms in sorted(self.sink.histograms_by_name.items()):
+                lines.append(f'# TYPE {name} histogram')
+                for key, histogram in sorted(histograms.items()):
+                    for bucket, count in histogram.cumulative_bucket_counts():
+                        lines.append(f'{name}_bucket{_format_labels(key, le=bucket)} {count}')
+                    lines.append(f'{name}_bucket{_format_labels(key, le="+Inf")} {histogram.count}')
+                    lines.append(f'{name}_sum{_format_labels(key)} {histogram.sum}')
+                    lines.append(f'{name}_count{_format_labels(key)} {histogram.count}')
+            for name, counters in sorted(self.sink.counters_by_name.items()):
+                lines.append(f'# TYPE {name} counter')
+                for key, value in sorted(counters.items()):
+                    lines.append(f'{name}{_format_labels(key)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, address=''):
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((address, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name='prometheus-exporter', daemon=True).start()
+        return self._server
+
+    def shutdown(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
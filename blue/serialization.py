@@ -0,0 +1,168 @@
+import inspect
+import json
+from typing import Dict
+
+from blue.base import BlueError, BlueprintInstruction, BlueprintInstructionState, Event, BlueprintExecution, Blueprint, InstructionStatus
+
+# Bump whenever the shape of a serialized object changes. Bodies without a version tag predate it and are read as version 0.
+WIRE_FORMAT_VERSION = 1
+VERSION_KEY = 'v'
+
+
+class SerializationError(BlueError):
+    pass
+
+
+def _component_name(component) -> str:
+    return component.__name__ if inspect.isclass(component) else component
+
+
+def _default(obj):
+    if inspect.isclass(obj):
+        return obj.__name__
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class JsonCodec:
+    name = 'json'
+
+    def dumps(self, obj) -> str:
+        return json.dumps(obj, separators=(',', ':'), default=_default)
+
+    def loads(self, s):
+        return json.loads(s)
+
+
+class OrjsonCodec:
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj) -> str:
+        return self._orjson.dumps(obj, default=_default).decode('utf-8')
+
+    def loads(self, s):
+        return self._orjson.loads(s)
+
+
+codec_class_by_name = {
+    JsonCodec.name: JsonCodec,
+    OrjsonCodec.name: OrjsonCodec,
+}
+
+
+def get_codec(name='auto'):
+    # Every codec writes plain JSON text, so workers using different codecs can read each other's messages
+    if name == 'auto':
+        try:
+            return OrjsonCodec()
+        except ImportError:
+            return JsonCodec()
+    if name not in codec_class_by_name:
+        raise SerializationError(f"Unknown codec {name}. Known codecs: {list(codec_class_by_name)}")
+    return codec_class_by_name[name]()
+
+
+class Serializer:
+    """
+    Encodes blue's dataclasses field by field instead of going through dataclasses.asdict, which deep-copies the whole object tree
+    and looks up every field's type on every call.
+    """
+
+    def __init__(self, codec=None):
+        self.codec = codec or get_codec()
+        self._encoder_by_type = {
+            BlueprintInstructionState: self.encode_instruction_state,
+            Event: self.encode_event,
+            BlueprintExecution: self.encode_blueprint_execution,
+            Blueprint: self.encode_blueprint,
+            BlueprintInstruction: self.encode_instruction,
+        }
+
+    @staticmethod
+    def encode_instruction(instruction: BlueprintInstruction) -> Dict:
+        outcome = instruction.outcome
+        return {
+            'conditions': list(instruction.conditions),
+            'outcome': {'action': _component_name(outcome.action), 'adapter': _component_name(outcome.adapter)},
+            'termination_conditions': list(instruction.termination_conditions or []),
+            'emits': list(instruction.emits),
+        }
+
+    @classmethod
+    def encode_blueprint(cls, blueprint: Blueprint) -> Dict:
+        return {
+            'name': blueprint.name,
+            'instructions': [cls.encode_instruction(instruction) for instruction in blueprint.instructions],
+            'version': blueprint.version,
+        }
+
+    @classmethod
+    def encode_instruction_state(cls, instruction_state: BlueprintInstructionState) -> Dict:
+        encoded = {
+            VERSION_KEY: WIRE_FORMAT_VERSION,
+            'id_': instruction_state.id_,
+            'blueprint_execution_id': instruction_state.blueprint_execution_id,
+            'status': instruction_state.status.value,
+        }
+        reference = instruction_state.instruction_reference
+        if reference:
+            encoded['ref'] = list(reference)
+        else:
+            encoded['instruction'] = cls.encode_instruction(instruction_state.instruction)
+        return encoded
+
+    @staticmethod
+    def encode_event(event: Event) -> Dict:
+        return {VERSION_KEY: WIRE_FORMAT_VERSION, 'topic': event.topic, 'metadata': event.metadata, 'body': event.body}
+
+    @classmethod
+    def encode_blueprint_execution(cls, blueprint_execution: BlueprintExecution) -> Dict:
+        return {
+            VERSION_KEY: WIRE_FORMAT_VERSION,
+            'execution_id': blueprint_execution.execution_id,
+            'execution_context': blueprint_execution.execution_context,
+            'blueprint': cls.encode_blueprint(blueprint_execution.blueprint),
+            'instructions_states': [cls.encode_instruction_state(each) for each in blueprint_execution.instructions_states],
+        }
+
+    @staticmethod
+    def decode_instruction_state(encoded: Dict, instruction: BlueprintInstruction) -> BlueprintInstructionState:
+        # The instruction itself is resolved by the caller, either from 'ref' or from the inline 'instruction' definition
+        blueprint_name, blueprint_version, instruction_index = encoded.get('ref') or (None, None, None)
+        return BlueprintInstructionState(
+            instruction=instruction,
+            blueprint_execution_id=encoded['blueprint_execution_id'],
+            status=InstructionStatus(encoded['status']),
+            id_=encoded['id_'],
+            blueprint_name=blueprint_name,
+            blueprint_version=blueprint_version,
+            instruction_index=instruction_index
+        )
+
+    @staticmethod
+    def decode_event(encoded: Dict) -> Event:
+        return Event(encoded['topic'], metadata=encoded.get('metadata') or {}, body=encoded.get('body') or {})
+
+    def encode(self, obj) -> Dict:
+        encoder = self._encoder_by_type.get(type(obj))
+        if encoder is None:
+            raise SerializationError(f"Cannot serialize {type(obj).__name__}")
+        return encoder(obj)
+
+    def dumps(self, obj) -> str:
+        return self.codec.dumps(self.encode(obj))
+
+    def loads(self, s) -> Dict:
+        try:
+            decoded = self.codec.loads(s)
+        except ValueError as e:
+            raise SerializationError(f"Cannot decode {s!r}: {e}") from e
+        if not isinstance(decoded, dict):
+            raise SerializationError(f"Expected an object, got {type(decoded).__name__}")
+        version = decoded.get(VERSION_KEY, 0)
+        if version > WIRE_FORMAT_VERSION:
+            raise SerializationError(f"Wire format version {version} is newer than supported version {WIRE_FORMAT_VERSION}")
+        return decoded
@@ -0,0 +1,169 @@
+import contextvars
+import json
+import random
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+from dataclasses import dataclass, field
+
+from blue.base import EventBus, Event
+
+TRACE_METADATA_KEY = 'trace'
+
+_current_span = contextvars.ContextVar('blue_current_span', default=None)
+
+
+@dataclass(frozen=True)
+class SpanContext:
+    trace_id: str
+    span_id: str
+    sampled: bool = True
+
+    def to_metadata(self) -> Dict:
+        return dict(trace_id=self.trace_id, span_id=self.span_id, sampled=self.sampled)
+
+    @classmethod
+    def from_metadata(cls, metadata: Optional[Dict]) -> Optional['SpanContext']:
+        trace = (metadata or {}).get(TRACE_METADATA_KEY)
+        if not trace:
+            return
+        return cls(trace['trace_id'], trace['span_id'], trace.get('sampled', True))
+
+
+@dataclass
+class Span:
+    name: str
+    context: SpanContext
+    parent_id: Optional[str] = None
+    start_time: float = field(default_factory=time.time)
+    end_time: Optional[float] = None
+    attributes: Dict = field(default_factory=dict)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self) -> Dict:
+        return dict(name=self.name, trace_id=self.context.trace_id, span_id=self.context.span_id, parent_id=self.parent_id,
+                    start_time=self.start_time, duration_ms=round((self.end_time - self.start_time) * 1000, 3), attributes=self.attributes)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def _new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class SpanExporter(ABC):
+    @abstractmethod
+    def export(self, span: Span):
+        pass
+
+
+class InMemorySpanExporter(SpanExporter):
+    def __init__(self):
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+
+class FileSpanExporter(SpanExporter):
+    # One JSON object per line, so spans from many workers can be appended to and grepped from the same file
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+
+class Tracer:
+    def __init__(self, exporter: SpanExporter, sample_rate=1.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def start_trace(self, name, attributes: Dict = None) -> Span:
+        context = SpanContext(uuid.uuid4().hex, _new_id(), random.random() < self.sample_rate)
+        return Span(name, context, attributes=dict(attributes or {}))
+
+    def start_span(self, name, parent: Optional[SpanContext], start_time: float = None, attributes: Dict = None) -> Span:
+        # Without a propagated parent, e.g. for executions started before tracing was enabled, the span starts a new trace
+        if parent is None:
+            span = self.start_trace(name, attributes)
+        else:
+            span = Span(name, SpanContext(parent.trace_id, _new_id(), parent.sampled), parent_id=parent.span_id,
+                        attributes=dict(attributes or {}))
+        if start_time is not None:
+            span.start_time = start_time
+        return span
+
+    def finish(self, span: Span):
+        span.end_time = time.time()
+        if span.context.sampled:
+            self.exporter.export(span)
+
+    def activate(self, span: Span):
+        return _current_span.set(span)
+
+    @staticmethod
+    def deactivate(token):
+        _current_span.reset(token)
+
+
+def inject(event: Event, span_context: SpanContext):
+    # published_at lets the consuming instruction pick the event that arrived last, i.e. the one on the critical path
+    event.metadata.setdefault(TRACE_METADATA_KEY, dict(span_context.to_metadata(), published_at=time.time()))
+
+
+def latest_span_context(events) -> Optional[SpanContext]:
+    latest_event = None
+    for event in events:
+        trace = (event.metadata or {}).get(TRACE_METADATA_KEY)
+        if trace and (latest_event is None or trace.get('published_at', 0) > latest_event.metadata[TRACE_METADATA_KEY].get('published_at', 0)):
+            latest_event = event
+    return SpanContext.from_metadata(latest_event.metadata) if latest_event else None
+
+
+class TracingEventBus(EventBus):
+    """
+    Handed to Actions in place of the real event bus so that every event they publish carries the trace context of the instruction
+    that published it.
+    """
+
+    def __init__(self, event_bus: EventBus, span_context: SpanContext):
+        super().__init__(dict())
+        self.event_bus = event_bus
+        self.span_context = span_context
+
+    def add_listener(self, listener):
+        self.event_bus.add_listener(listener)
+
+    def publish(self, event: Event):
+        inject(event, self.span_context)
+        self.event_bus.publish(event)
+
+    def publish_many(self, events: List[Event]):
+        for event in events:
+            inject(event, self.span_context)
+        self.event_bus.publish_many(events)
+
+    def forget_execution(self, blueprint_execution_id):
+        self.event_bus.forget_execution(blueprint_execution_id)
+
+    def get_event(self, topic, blueprint_execution_id) -> Event:
+        return self.event_bus.get_event(topic, blueprint_execution_id)
+
+    def get_events(self, topics: List[str], blueprint_execution_id) -> Dict[str, Event]:
+        return self.event_bus.get_events(topics, blueprint_execution_id)
+
+    def get_event_history(self, topic, blueprint_execution_id, limit=None) -> List[Event]:
+        return self.event_bus.get_event_history(topic, blueprint_execution_id, limit)
@@ -3,7 +3,10 @@ import inspect
 import json
 import random
 import string
+import threading
+import time
 import uuid
+from collections import OrderedDict
 from enum import Enum
 from json import JSONEncoder
 
@@ -15,6 +18,11 @@ def generate_random_id():
     return str(uuid.uuid4())
 
 
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 def superjson(obj) -> str:
     return json.dumps(obj, default=_serialize_all)
 
@@ -30,6 +38,57 @@ def _serialize_all(obj):
         return str(obj)
 
 
+class LRUCache:
+    _missing = object()
+
+    def __init__(self, max_size, ttl=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._value_and_expiry_by_key = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, expires_at = self._value_and_expiry_by_key.get(key, (self._missing, None))
+            if value is not self._missing and expires_at is not None and expires_at <= self._clock():
+                del self._value_and_expiry_by_key[key]
+                self.expirations += 1
+                value = self._missing
+            if value is self._missing:
+                self.misses += 1
+                return default
+            self._value_and_expiry_by_key.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            expires_at = self._clock() + self.ttl if self.ttl else None
+            self._value_and_expiry_by_key[key] = (value, expires_at)
+            self._value_and_expiry_by_key.move_to_end(key)
+            while len(self._value_and_expiry_by_key) > self.max_size:
+                self._value_and_expiry_by_key.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            self._value_and_expiry_by_key.pop(key, None)
+
+    def stats(self):
+        return dict(size=len(self), max_size=self.max_size, hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    expirations=self.expirations)
+
+    def __len__(self):
+        return len(self._value_and_expiry_by_key)
+
+
 class AutoNameEnum(Enum):
     def _generate_next_value_(name, start, count, last_values):
         return name
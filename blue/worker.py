@@ -0,0 +1,176 @@
+import argparse
+import collections
+import importlib
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from typing import Dict
+
+from blue.base import BlueError
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RESTART_DELAY = 1
+DEFAULT_DRAIN_TIMEOUT = 60
+DEFAULT_REPORT_INTERVAL = 60
+
+
+class WorkerConfigError(BlueError):
+    pass
+
+
+def load_config_module(config_module_name):
+    config_module = importlib.import_module(config_module_name)
+    if not hasattr(config_module, 'create_executor'):
+        raise WorkerConfigError(f"Config module {config_module_name} must define create_executor(worker_id, rundata_callback)")
+    return config_module
+
+
+def _run_worker(config_module_name, worker_id, rundata_queue):
+    # The forked process inherits the supervisor's handlers. Until the executor exists, SIGTERM only records the request.
+    stop_requested = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    config_module = load_config_module(config_module_name)
+
+    def report(rundata):
+        rundata_queue.put(dict(worker_id=rundata['worker_id'], run_status=rundata['run_status'], isotime=rundata['isotime']))
+
+    executor = config_module.create_executor(worker_id, report)
+    signal.signal(signal.SIGTERM, lambda signum, frame: executor.stop())
+    if stop_requested.is_set():
+        log.info(f"Worker {worker_id} was asked to stop while starting up")
+        return
+    executor.run()
+
+
+class WorkerSupervisor:
+
+    def __init__(self, config_module_name, worker_count=None, worker_id_prefix=None, restart_delay=DEFAULT_RESTART_DELAY,
+                 drain_timeout=DEFAULT_DRAIN_TIMEOUT, report_interval=DEFAULT_REPORT_INTERVAL):
+        self.config_module_name = config_module_name
+        self.worker_count = worker_count or os.cpu_count()
+        self.worker_id_prefix = worker_id_prefix or f"{os.uname().nodename}-{os.getpid()}"
+        self.restart_delay = restart_delay
+        self.drain_timeout = drain_timeout
+        self.report_interval = report_interval
+        self.rundata_queue = multiprocessing.Queue()
+        self.process_by_worker_id: Dict[str, multiprocessing.Process] = {}
+        self.restart_count_by_worker_id = collections.Counter()
+        self.run_status_counts_by_worker_id = collections.defaultdict(collections.Counter)
+        self._shutting_down = False
+
+    def _worker_ids(self):
+        return [f"{self.worker_id_prefix}-{i}" for i in range(self.worker_count)]
+
+    def _start_worker(self, worker_id):
+        process = multiprocessing.Process(target=_run_worker, args=(self.config_module_name, worker_id, self.rundata_queue), name=worker_id)
+        process.start()
+        log.info(f"Started worker {worker_id} with pid {process.pid}")
+        self.process_by_worker_id[worker_id] = process
+
+    def _request_shutdown(self, signum, frame):
+        if self._shutting_down:
+            return
+        log.info(f"Received signal {signum}. Draining workers.")
+        self._shutting_down = True
+        for process in self.process_by_worker_id.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    def _collect_rundata(self, timeout):
+        try:
+            rundata = self.rundata_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while rundata:
+            self.run_status_counts_by_worker_id[rundata['worker_id']][rundata['run_status']] += 1
+            try:
+                rundata = self.rundata_queue.get_nowait()
+            except queue.Empty:
+                rundata = None
+
+    def _supervise_workers(self):
+        for worker_id, process in list(self.process_by_worker_id.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            if self._shutting_down or process.exitcode == 0:
+                log.info(f"Worker {worker_id} exited with code {process.exitcode}")
+                del self.process_by_worker_id[worker_id]
+                continue
+            self.restart_count_by_worker_id[worker_id] += 1
+            log.error(f"Worker {worker_id} crashed with code {process.exitcode}. Restarting in {self.restart_delay} seconds.")
+            time.sleep(self.restart_delay)
+            self._start_worker(worker_id)
+
+    def rundata_summary(self) -> Dict:
+        return {
+            'workers': {worker_id: dict(counts) for worker_id, counts in self.run_status_counts_by_worker_id.items()},
+            'total': dict(sum(self.run_status_counts_by_worker_id.values(), collections.Counter())),
+            'restarts': dict(self.restart_count_by_worker_id),
+        }
+
+    def run(self):
+        previous_handlers = {signum: signal.signal(signum, self._request_shutdown) for signum in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            return self._run()
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def _run(self):
+        for worker_id in self._worker_ids():
+            self._start_worker(worker_id)
+
+        last_report_time = time.monotonic()
+        shutdown_started_at = None
+        killed_worker_ids = set()
+        while self.process_by_worker_id:
+            self._collect_rundata(timeout=0.5)
+            self._supervise_workers()
+
+            if self._shutting_down:
+                shutdown_started_at = shutdown_started_at or time.monotonic()
+                if time.monotonic() - shutdown_started_at > self.drain_timeout:
+                    for worker_id, process in self.process_by_worker_id.items():
+                        if worker_id in killed_worker_ids:
+                            continue
+                        log.warning(f"Worker {worker_id} did not drain within {self.drain_timeout} seconds. Killing it.")
+                        os.kill(process.pid, signal.SIGKILL)
+                        killed_worker_ids.add(worker_id)
+
+            if time.monotonic() - last_report_time >= self.report_interval:
+                log.info(f"WorkerSupervisor RUNDATA={self.rundata_summary()}")
+                last_report_time = time.monotonic()
+
+        self._collect_rundata(timeout=0)
+        log.info(f"WorkerSupervisor RUNDATA={self.rundata_summary()}")
+        return self.rundata_summary()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='blue-worker', description='Run BlueprintExecutors across multiple processes')
+    parser.add_argument('config_module', help='Importable module defining create_executor(worker_id, rundata_callback)')
+    parser.add_argument('-n', '--workers', type=int, default=None, help='Number of worker processes (default: number of cores)')
+    parser.add_argument('--worker-id-prefix', default=None, help='Prefix for worker ids (default: <hostname>-<pid>)')
+    parser.add_argument('--restart-delay', type=float, default=DEFAULT_RESTART_DELAY)
+    parser.add_argument('--drain-timeout', type=float, default=DEFAULT_DRAIN_TIMEOUT)
+    parser.add_argument('--report-interval', type=float, default=DEFAULT_REPORT_INTERVAL)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    sys.path.insert(0, os.getcwd())
+    load_config_module(args.config_module)
+    supervisor = WorkerSupervisor(args.config_module, worker_count=args.workers, worker_id_prefix=args.worker_id_prefix,
+                                  restart_delay=args.restart_delay, drain_timeout=args.drain_timeout, report_interval=args.report_interval)
+    supervisor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,10 +6,18 @@ setup(
     author='Coinswitch',
     author_email='dev@coinswitch.co',
     description='dummy description',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
+    python_requires='>=3.7',
     install_requires=[
-        'dataclasses>=0.6',
         'peewee>=3.9.2',
         'boto3>=1.7'
-    ]
+    ],
+    extras_require={
+        'orjson': ['orjson'],
+    },
+    entry_points={
+        'console_scripts': [
+            'blue-worker=blue.worker:main',
+        ]
+    }
 )
\ No newline at end of file
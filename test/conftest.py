@@ -112,7 +112,8 @@ _data_sample_execution_store_config = {
         'password': 'postgres'
     },
     'sqs': {
-        'prefix': queue_prefix
+        'prefix': queue_prefix,
+        'wait_time_seconds': 0
     }
 }
 
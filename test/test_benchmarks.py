@@ -0,0 +1,13 @@
+import json
+
+from benchmarks import executor
+
+
+def test_executor_benchmark_completes_and_compares(tmp_path):
+    baseline_path = str(tmp_path / 'baseline.json')
+    executor.main(['--executions', '3', '--instructions', '2', '--conditions', '2', '--save', baseline_path])
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    assert [result['scenario'] for result in baseline['results']] == ['inmemory/e3/i2/c2']
+    assert baseline['results'][0]['completed'] and baseline['results'][0]['steps'] == 6
+    assert executor.compare(baseline['results'], baseline, tolerance=0.2) == []
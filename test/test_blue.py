@@ -1,9 +1,22 @@
+import asyncio
 import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
 
-from blue.base import Action, Adapter, Event
-from blue.blueprint import BlueprintManager
-from blue.execution import BlueprintExecutionManager, BlueprintExecutor
+import pytest
+
+from blue.base import Action, Adapter, Event, InstructionStatus, Lease
+from blue.blueprint import BlueprintManager, InvalidBlueprintDefinition
+from blue.execution import BlueprintExecutionManager, BlueprintExecutor, ThreadedBlueprintExecutor, AsyncBlueprintExecutor, BackoffIdleStrategy, \
+    FixedIntervalIdleStrategy, RequeueBackoff, NoActionRequired
 from blue.impl.inmemory import InMemoryEventBus, InMemoryBlueprintInstructionExecutionStore
+from blue.metrics import InMemoryMetricsSink
+from blue.worker import WorkerSupervisor, _run_worker
+from conftest import BasicAdapter, CheckForDeposit
+import worker_config
 
 log = logging.getLogger(__name__)
 
@@ -69,3 +82,480 @@ def test_blueprint_executor_with_run_query_log(sample_namespace_config, sample_b
     bex = BlueprintExecutor(bem, bm, 'worker-testrunner', 1, rundata_callback=f.go)
     bex.run()
     assert len(f.datas) == 1
+
+
+def test_inmemory_store_only_dequeues_ready_instructions(sample_namespace_config, sample_blueprint_definition):
+    bem, bm = basic_initialize_execution_manager(sample_namespace_config, sample_blueprint_definition)
+    store = bem.execution_store
+    execution_id = next(iter(store._stored_blueprint_executions))
+
+    instruction_state = store.get_instruction_to_process()
+    assert instruction_state.instruction.conditions == ['new_order']
+    store.acknowledge_success(instruction_state)
+    assert store.get_instruction_to_process() is None
+
+    bem.event_bus.publish(Event('deposit_status', metadata=dict(blueprint_execution_id=execution_id)))
+    instruction_state = store.get_instruction_to_process()
+    assert instruction_state.instruction.conditions == ['deposit_status']
+
+
+def test_blueprint_executor_batch(sample_namespace_config, sample_blueprint_definition):
+    rundatas = []
+    bem, bm = basic_initialize_execution_manager(sample_namespace_config, sample_blueprint_definition)
+    execution_id = next(iter(bem.execution_store._stored_blueprint_executions))
+    bem.event_bus.publish(Event('deposit_status', metadata=dict(blueprint_execution_id=execution_id)))
+
+    bex = BlueprintExecutor(bem, bm, 'worker-testrunner', 1, True, rundata_callback=rundatas.append, batch_size=10)
+    bex.run()
+    assert [rundata['run_status'] for rundata in rundatas] == ['OUTCOME_ACTION_SUCCESS', 'OUTCOME_ACTION_SUCCESS']
+
+
+def test_blueprint_execution_manager_start_executions(sample_namespace_config, sample_blueprint_definition):
+    bm = BlueprintManager(sample_namespace_config)
+    bm.add_blueprint(sample_blueprint_definition)
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), InMemoryBlueprintInstructionExecutionStore(bm, dict()))
+
+    boot_events_with_contexts = [(Event('new_order'), {'order_id': i}) for i in range(5)]
+    blueprint_executions = bem.start_executions(bm.live_blueprints_by_name['test_blueprint_1'], boot_events_with_contexts)
+    assert len({each.execution_id for each in blueprint_executions}) == 5
+    assert len(bem.execution_store.get_instructions_to_process(max_count=10)) == 5
+
+
+def test_threaded_blueprint_executor(sample_namespace_config, sample_blueprint_definition):
+    rundatas = []
+    bem, bm = basic_initialize_execution_manager(sample_namespace_config, sample_blueprint_definition)
+    execution_id = next(iter(bem.execution_store._stored_blueprint_executions))
+    bem.event_bus.publish(Event('deposit_status', metadata=dict(blueprint_execution_id=execution_id)))
+
+    bex = ThreadedBlueprintExecutor(bem, bm, 'worker-testrunner', 1, True, rundata_callback=rundatas.append, max_workers=4)
+    bex.run()
+    assert sorted(rundata['run_status'] for rundata in rundatas) == ['OUTCOME_ACTION_SUCCESS', 'OUTCOME_ACTION_SUCCESS']
+
+
+class AsyncCheckForDeposit(Action):
+    async def act(self, input):
+        await asyncio.sleep(0.01)
+        return input
+
+
+class AsyncBasicAdapter(Adapter):
+    async def adapt(self, context, events):
+        return dict(foo='bar')
+
+
+def test_async_blueprint_executor():
+    bm = BlueprintManager({'namespace': {'action': [AsyncCheckForDeposit], 'adapter': [AsyncBasicAdapter]}})
+    bm.add_blueprint({'name': 'async_blueprint', 'instructions': [
+        {'conditions': ['new_order'], 'outcome': {'action': 'AsyncCheckForDeposit', 'adapter': 'AsyncBasicAdapter'}}
+    ]})
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), InMemoryBlueprintInstructionExecutionStore(bm, dict()))
+    bem.start_executions(bm.live_blueprints_by_name['async_blueprint'], [(Event('new_order'), {'order_id': i}) for i in range(20)])
+
+    rundatas = []
+    bex = AsyncBlueprintExecutor(bem, bm, 'worker-testrunner', 1, True, rundata_callback=rundatas.append, max_concurrency=50)
+    bex.run()
+    assert [rundata['run_status'] for rundata in rundatas] == ['OUTCOME_ACTION_SUCCESS'] * 20
+
+
+class RejectingAdapter(Adapter):
+    def adapt(self, context, events):
+        raise NoActionRequired()
+
+
+class FailingAction(Action):
+    def act(self, input):
+        raise ValueError('exchange unavailable')
+
+
+@pytest.mark.parametrize('executor_class', [BlueprintExecutor, AsyncBlueprintExecutor])
+def test_executors_acknowledge_each_run_status_alike(executor_class):
+    bm = BlueprintManager({'namespace': {'action': [CheckForDeposit, FailingAction], 'adapter': [BasicAdapter, RejectingAdapter]}})
+    bm.add_blueprint({'name': 'mixed_outcomes_blueprint', 'instructions': [
+        {'conditions': ['new_order'], 'outcome': {'action': 'CheckForDeposit', 'adapter': 'RejectingAdapter'}},
+        {'conditions': ['new_order'], 'outcome': {'action': 'FailingAction', 'adapter': 'BasicAdapter'}},
+        {'conditions': ['deposit_status'], 'termination_conditions': ['new_order'], 'outcome': {'action': 'CheckForDeposit', 'adapter': 'BasicAdapter'}},
+    ]})
+    store = InMemoryBlueprintInstructionExecutionStore(bm, dict())
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), store)
+    bem.start_execution(bm.live_blueprints_by_name['mixed_outcomes_blueprint'], Event('new_order'), {})
+
+    rundatas = []
+    executor_class(bem, bm, 'worker-testrunner', 3, True, rundata_callback=rundatas.append).run()
+    assert sorted(rundata['run_status'] for rundata in rundatas if rundata['instruction_state']) == [
+        'OUTCOME_ACTION_FAILED', 'OUTCOME_ADAPTER_REJECT', 'TERMINATION_CONDITIONS_MET']
+    count_by_status = store.count_by_status()
+    assert (count_by_status[InstructionStatus.IDLE], count_by_status[InstructionStatus.FAILED], count_by_status[InstructionStatus.END]) == (1, 1, 1)
+
+
+def test_async_blueprint_executor_stops_during_idle_backoff():
+    bm = BlueprintManager({'namespace': {'action': [AsyncCheckForDeposit], 'adapter': [AsyncBasicAdapter]}})
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), InMemoryBlueprintInstructionExecutionStore(bm, dict()))
+    bex = AsyncBlueprintExecutor(bem, bm, 'worker-testrunner', idle_strategy=FixedIntervalIdleStrategy(60))
+    thread = threading.Thread(target=bex.run)
+    thread.start()
+    time.sleep(0.2)
+    bex.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert bex.async_event_bus._executor._shutdown and bex.async_execution_store._executor._shutdown
+
+
+def test_worker_supervisor_aggregates_rundata():
+    supervisor = WorkerSupervisor('worker_config', worker_count=2, worker_id_prefix='worker-testrunner')
+    summary = supervisor.run()
+    assert sorted(summary['workers']) == ['worker-testrunner-0', 'worker-testrunner-1']
+    assert summary['total'] == {'OUTCOME_ACTION_SUCCESS': 2, 'NO_INSTRUCTION': 2}
+
+
+def test_worker_supervisor_restarts_crashed_worker(monkeypatch, tmp_path):
+    monkeypatch.setenv(worker_config.WORKER_MODE_ENV, 'crash_once')
+    monkeypatch.setenv(worker_config.CRASH_MARKER_ENV, str(tmp_path / 'crashed'))
+    supervisor = WorkerSupervisor('worker_config', worker_count=1, worker_id_prefix='worker-testrunner', restart_delay=0)
+    summary = supervisor.run()
+    assert summary['restarts'] == {'worker-testrunner-0': 1}
+    assert summary['total'] == {'OUTCOME_ACTION_SUCCESS': 1, 'NO_INSTRUCTION': 1}
+
+
+def test_worker_supervisor_drains_workers_on_sigterm(monkeypatch):
+    monkeypatch.setenv(worker_config.WORKER_MODE_ENV, 'run_until_stopped')
+    supervisor = WorkerSupervisor('worker_config', worker_count=2, worker_id_prefix='worker-testrunner', drain_timeout=30)
+    timer = threading.Timer(1, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+    started_at = time.monotonic()
+    summary = supervisor.run()
+    timer.join()
+    assert time.monotonic() - started_at < 30
+    assert summary['restarts'] == {}
+    assert summary['total']['OUTCOME_ACTION_SUCCESS'] == 2
+
+
+def test_worker_stops_when_sigterm_arrives_during_setup(monkeypatch):
+    monkeypatch.setenv(worker_config.WORKER_MODE_ENV, 'slow_setup')
+    rundata_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_worker, args=('worker_config', 'worker-testrunner-0', rundata_queue))
+    process.start()
+    time.sleep(0.5)
+    os.kill(process.pid, signal.SIGTERM)
+    process.join(10)
+    assert process.exitcode == 0
+    assert rundata_queue.empty()
+
+
+def test_backoff_idle_strategy():
+    strategy = BackoffIdleStrategy(1, initial_interval=0.25)
+    assert [strategy.next_interval(False) for _ in range(4)] == [0.25, 0.5, 1, 1]
+    assert strategy.next_interval(True) == 0
+    assert strategy.next_interval(False) == 0.25
+
+
+def test_blueprint_executor_termination_requires_all_termination_conditions(sample_namespace_config):
+    bm = BlueprintManager(sample_namespace_config)
+    bm.add_blueprint({'name': 'multi_termination', 'instructions': [
+        {'conditions': ['new_order'], 'outcome': {'action': 'CheckForDeposit', 'adapter': 'BasicAdapter'},
+         'termination_conditions': ['deposit_timeout', 'order_cancelled']}
+    ]})
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), InMemoryBlueprintInstructionExecutionStore(bm, dict()))
+    blueprint_execution = bem.start_execution(bm.live_blueprints_by_name['multi_termination'], Event('new_order'), {})
+    bem.event_bus.publish(Event('deposit_timeout', metadata=dict(blueprint_execution_id=blueprint_execution.execution_id)))
+
+    rundatas = []
+    BlueprintExecutor(bem, bm, 'worker-testrunner', 1, True, rundata_callback=rundatas.append).run()
+    assert rundatas[0]['run_status'] == 'OUTCOME_ACTION_SUCCESS'
+
+
+def test_blueprint_manager_versions_blueprints(sample_namespace_config, sample_blueprint_definition):
+    bm = BlueprintManager(sample_namespace_config)
+    bm.add_blueprint(sample_blueprint_definition)
+    blueprint = bm.live_blueprints_by_name['test_blueprint_1']
+    assert blueprint.version == BlueprintManager.compute_blueprint_version(sample_blueprint_definition)
+    assert bm.get_instruction('test_blueprint_1', blueprint.version, 1) is blueprint.instructions[1]
+
+
+def test_inmemory_store_fifo_fairness_and_status_counts(sample_namespace_config, sample_blueprint_definition):
+    bm = BlueprintManager(sample_namespace_config)
+    bm.add_blueprint(sample_blueprint_definition)
+    store = InMemoryBlueprintInstructionExecutionStore(bm, dict(fairness='fifo'))
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), store)
+    blueprint_executions = bem.start_executions(bm.live_blueprints_by_name['test_blueprint_1'], [(Event('new_order'), {}) for _ in range(3)])
+
+    instruction_states = store.get_instructions_to_process(max_count=2)
+    assert [each.blueprint_execution_id for each in instruction_states] == [each.execution_id for each in blueprint_executions[:2]]
+    store.acknowledge_success(instruction_states[0])
+    assert store.count_by_status() == {
+        InstructionStatus.IDLE: 4, InstructionStatus.PROCESSING: 1, InstructionStatus.SUCCESS: 1, InstructionStatus.FAILED: 0, InstructionStatus.END: 0
+    }
+    assert store.count_ready() == 1
+
+
+def test_inmemory_backends_evict_finished_executions(sample_namespace_config, sample_blueprint_definition):
+    bem, bm = basic_initialize_execution_manager(sample_namespace_config, sample_blueprint_definition)
+    execution_id = next(iter(bem.execution_store._stored_blueprint_executions))
+    bem.event_bus.publish(Event('deposit_timeout', metadata=dict(blueprint_execution_id=execution_id)))
+
+    BlueprintExecutor(bem, bm, 'worker-testrunner', 1, True, batch_size=2).run()
+    assert bem.execution_store._stored_blueprint_executions == {}
+    assert bem.execution_store._stored_instruction_states == {}
+    assert bem.execution_store._waiting_instruction_ids_by_execution_id_by_topic == {}
+    assert bem.event_bus.events_by_blueprint_execution_id_by_topic == {}
+
+    bem.event_bus.publish(Event('deposit_status', metadata=dict(blueprint_execution_id=execution_id)))
+    assert bem.event_bus.events_by_blueprint_execution_id_by_topic == {}
+
+
+def test_requeue_backoff_grows_with_attempts():
+    backoff = RequeueBackoff(base_delay=1, multiplier=2, maximum_delay=5, jitter=0)
+    assert [backoff.delay_for(attempts) for attempts in (1, 2, 3, 4)] == [1, 2, 4, 5]
+
+
+def test_inmemory_store_delays_requeued_instructions(sample_namespace_config, sample_blueprint_definition):
+    bem, bm = basic_initialize_execution_manager(sample_namespace_config, sample_blueprint_definition)
+    store = bem.execution_store
+    now = [0]
+    store._clock = lambda: now[0]
+
+    instruction_state = store.get_instruction_to_process()
+    assert instruction_state.attempts == 1
+    store.requeue(instruction_state, delay=10)
+    assert store.get_instruction_to_process() is None
+
+    now[0] = 10
+    instruction_state = store.get_instruction_to_process()
+    assert instruction_state.attempts == 2
+
+
+class SlowAction(Action):
+    def act(self, input):
+        time.sleep(0.1)
+
+
+class LeasedInMemoryStore(InMemoryBlueprintInstructionExecutionStore):
+    lease_timeout = 0.03
+
+    def __init__(self, manager, config):
+        super().__init__(manager, config)
+        self.extended_lease_ids = []
+
+    def _get_instructions_to_process(self, worker_id, max_count):
+        instruction_states = super()._get_instructions_to_process(worker_id, max_count)
+        for instruction_state in instruction_states:
+            instruction_state.lease = Lease(token=worker_id)
+        return instruction_states
+
+    def extend_lease(self, instruction_state):
+        self.extended_lease_ids.append(instruction_state.id_)
+
+
+def test_blueprint_executor_heartbeats_lease_while_action_runs():
+    bm = BlueprintManager({'namespace': {'action': [SlowAction], 'adapter': [BasicAdapter]}})
+    bm.add_blueprint({'name': 'slow', 'instructions': [{'conditions': ['start'], 'outcome': {'action': 'SlowAction', 'adapter': 'BasicAdapter'}}]})
+    store = LeasedInMemoryStore(bm, dict())
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), store)
+    blueprint_execution = bem.start_execution(bm.live_blueprints_by_name['slow'], Event('start'), {})
+
+    BlueprintExecutor(bem, bm, 'worker-testrunner', 1, True).run()
+    instruction_state = blueprint_execution.instructions_states[0]
+    assert instruction_state.status == InstructionStatus.SUCCESS
+    assert instruction_state.lease is None
+    assert len(store.extended_lease_ids) >= 2
+
+
+def test_blueprint_executor_records_phase_metrics(sample_namespace_config, sample_blueprint_definition):
+    bem, bm = basic_initialize_execution_manager(sample_namespace_config, sample_blueprint_definition)
+    metrics = InMemoryMetricsSink()
+    BlueprintExecutor(bem, bm, 'worker-testrunner', 1, True, metrics=metrics).run()
+
+    labels = dict(blueprint='test_blueprint_1', action='CheckForDeposit')
+    for phase in ('event_fetch', 'termination_check', 'condition_check', 'context_fetch', 'adapter', 'action', 'ack'):
+        assert metrics.histogram('blue_executor_phase_seconds', phase=phase, **labels).count == 1
+    assert metrics.histogram('blue_executor_phase_seconds', phase='dequeue', blueprint='', action='').count == 1
+    assert metrics.counter('blue_executor_instructions_total', run_status='OUTCOME_ACTION_SUCCESS', **labels) == 1
+
+
+class ReportDepositStatus(Action):
+    def act(self, input):
+        self.event_bus.publish(Event('deposit_status', metadata=dict(blueprint_execution_id=self._metadata['blueprint_execution_id'])))
+
+
+_data_emitting_blueprint_definition = {'name': 'emitting_blueprint', 'instructions': [
+    {'conditions': ['new_order'], 'outcome': {'action': 'ReportDepositStatus', 'adapter': 'BasicAdapter'}, 'emits': ['deposit_status']},
+    {'conditions': ['deposit_status'], 'outcome': {'action': 'ReportDepositStatus', 'adapter': 'BasicAdapter'}},
+]}
+
+
+def test_lazy_instructions_are_materialized_when_their_topic_is_published():
+    bm = BlueprintManager({'namespace': {'action': [ReportDepositStatus], 'adapter': [BasicAdapter]}})
+    bm.add_blueprint(_data_emitting_blueprint_definition)
+    store = InMemoryBlueprintInstructionExecutionStore(bm, dict(evict_finished_executions=False))
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), store)
+    blueprint_execution = bem.start_execution(bm.live_blueprints_by_name['emitting_blueprint'], Event('new_order'), {})
+    assert [each.instruction_index for each in blueprint_execution.instructions_states] == [0]
+    assert store.count_by_status()[InstructionStatus.IDLE] == 1
+
+    rundatas = []
+    BlueprintExecutor(bem, bm, 'worker-testrunner', 3, True, rundata_callback=rundatas.append).run()
+    assert [rundata['run_status'] for rundata in rundatas] == ['OUTCOME_ACTION_SUCCESS', 'OUTCOME_ACTION_SUCCESS', 'NO_INSTRUCTION']
+    # The second instruction publishes its own trigger again, which must not materialize it a second time
+    assert store.count_by_status()[InstructionStatus.SUCCESS] == 2
+
+
+_data_late_emitting_blueprint_definition = {'name': 'late_emitting_blueprint', 'instructions': [
+    {'conditions': ['new_order'], 'outcome': {'action': 'CheckForDeposit', 'adapter': 'BasicAdapter'}, 'emits': ['deposit_status']},
+    {'conditions': ['deposit_status'], 'outcome': {'action': 'CheckForDeposit', 'adapter': 'BasicAdapter'}},
+]}
+
+
+def test_executions_with_lazy_instructions_left_are_not_evicted(sample_namespace_config):
+    bm = BlueprintManager(sample_namespace_config)
+    bm.add_blueprint(_data_late_emitting_blueprint_definition)
+    store = InMemoryBlueprintInstructionExecutionStore(bm, dict())
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), store)
+    blueprint_execution = bem.start_execution(bm.live_blueprints_by_name['late_emitting_blueprint'], Event('new_order'), {})
+
+    # The first instruction succeeds without publishing the topic it emits
+    BlueprintExecutor(bem, bm, 'worker-testrunner', 1, True).run()
+    assert store.get_execution_blueprint(blueprint_execution.execution_id) is not None
+
+    bem.event_bus.publish(Event('deposit_status', metadata=dict(blueprint_execution_id=blueprint_execution.execution_id)))
+    rundatas = []
+    BlueprintExecutor(bem, bm, 'worker-testrunner', 1, True, rundata_callback=rundatas.append).run()
+    assert [rundata['run_status'] for rundata in rundatas] == ['OUTCOME_ACTION_SUCCESS']
+    assert store.get_execution_blueprint(blueprint_execution.execution_id) is None
+
+
+def test_publishes_that_trigger_no_lazy_instruction_skip_the_store(monkeypatch):
+    bm = BlueprintManager({'namespace': {'action': [ReportDepositStatus], 'adapter': [BasicAdapter]}})
+    bm.add_blueprint(_data_emitting_blueprint_definition)
+    assert bm.lazy_trigger_topics == {'deposit_status'}
+    store = InMemoryBlueprintInstructionExecutionStore(bm, dict())
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), store)
+    blueprint_execution = bem.start_execution(bm.live_blueprints_by_name['emitting_blueprint'], Event('new_order'), {})
+
+    looked_up_execution_ids = []
+    monkeypatch.setattr(store, 'get_execution_blueprint', lambda execution_id: looked_up_execution_ids.append(execution_id))
+    bem.event_bus.publish(Event('unrelated', metadata=dict(blueprint_execution_id=blueprint_execution.execution_id)))
+    assert looked_up_execution_ids == []
+    bem.event_bus.publish(Event('deposit_status', metadata=dict(blueprint_execution_id=blueprint_execution.execution_id)))
+    assert looked_up_execution_ids == [blueprint_execution.execution_id]
+
+
+def test_dependency_graph_reports_unreachable_instructions():
+    bm = BlueprintManager({'namespace': {'action': [ReportDepositStatus], 'adapter': [BasicAdapter]}})
+    bm.add_blueprint({'name': 'cyclic_blueprint', 'instructions': [
+        {'conditions': ['new_order'], 'outcome': {'action': 'ReportDepositStatus', 'adapter': 'BasicAdapter'}, 'emits': ['deposit_status']},
+        {'conditions': ['deposit_status', 'refund_requested'], 'outcome': {'action': 'ReportDepositStatus', 'adapter': 'BasicAdapter'},
+         'emits': ['refund_approved']},
+        {'conditions': ['refund_approved'], 'outcome': {'action': 'ReportDepositStatus', 'adapter': 'BasicAdapter'}, 'emits': ['refund_requested']},
+    ]})
+    dependency_graph = bm.get_dependency_graph(bm.live_blueprints_by_name['cyclic_blueprint'])
+    assert dependency_graph.eager_instruction_indexes == [0]
+    assert dependency_graph.lazy_instruction_indexes_by_topic == {'deposit_status': [1], 'refund_requested': [1], 'refund_approved': [2]}
+    assert dependency_graph.unreachable_instruction_indexes == [1, 2]
+
+
+class ExchangeClientAction(Action):
+    instances = []
+
+    def setup(self):
+        self.calls = []
+        self.torn_down = False
+        ExchangeClientAction.instances.append(self)
+
+    def teardown(self):
+        self.torn_down = True
+
+    def act(self, input, metadata=None):
+        self.calls.append(metadata['blueprint_execution_id'])
+
+
+def _exchange_client_execution_manager(scope, execution_count, **spec):
+    ExchangeClientAction.instances = []
+    bm = BlueprintManager({'namespace': {'action': [dict(component=ExchangeClientAction, scope=scope, **spec)], 'adapter': [BasicAdapter]}})
+    bm.add_blueprint({'name': 'exchange_blueprint', 'instructions': [
+        {'conditions': ['new_order'], 'outcome': {'action': 'ExchangeClientAction', 'adapter': 'BasicAdapter'}}
+    ]})
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), InMemoryBlueprintInstructionExecutionStore(bm, dict()))
+    blueprint_executions = bem.start_executions(bm.live_blueprints_by_name['exchange_blueprint'], [(Event('new_order'), {}) for _ in range(execution_count)])
+    return bem, bm, blueprint_executions
+
+
+def test_singleton_component_is_set_up_once_and_gets_metadata_per_call():
+    bem, bm, blueprint_executions = _exchange_client_execution_manager('singleton', 3)
+    BlueprintExecutor(bem, bm, 'worker-testrunner', 1, True, batch_size=3).run()
+
+    [action] = ExchangeClientAction.instances
+    assert sorted(action.calls) == sorted(each.execution_id for each in blueprint_executions)
+    assert action.torn_down
+
+
+def test_pooled_component_is_limited_to_pool_size():
+    bem, bm, blueprint_executions = _exchange_client_execution_manager('pooled', 8, pool_size=2)
+    ThreadedBlueprintExecutor(bem, bm, 'worker-testrunner', 1, True, max_workers=4).run()
+
+    assert len(ExchangeClientAction.instances) <= 2
+    assert sum(len(each.calls) for each in ExchangeClientAction.instances) == 4
+    assert all(each.torn_down for each in ExchangeClientAction.instances)
+
+
+class ExchangeQuoteAdapter(Adapter):
+    instances = []
+
+    def setup(self):
+        self.event_buses = []
+        ExchangeQuoteAdapter.instances.append(self)
+
+    def adapt(self, context, events, metadata=None, event_bus=None):
+        self.event_buses.append(event_bus)
+        return metadata['blueprint_execution_id']
+
+
+@pytest.mark.parametrize('executor_class', [BlueprintExecutor, AsyncBlueprintExecutor])
+def test_singleton_adapter_gets_event_bus_per_call(executor_class):
+    ExchangeQuoteAdapter.instances = []
+    ExchangeClientAction.instances = []
+    bm = BlueprintManager({'namespace': {'action': [ExchangeClientAction], 'adapter': [dict(component=ExchangeQuoteAdapter, scope='singleton')]}})
+    bm.add_blueprint({'name': 'quote_blueprint', 'instructions': [
+        {'conditions': ['new_order'], 'outcome': {'action': 'ExchangeClientAction', 'adapter': 'ExchangeQuoteAdapter'}}
+    ]})
+    event_bus = InMemoryEventBus(dict())
+    bem = BlueprintExecutionManager(event_bus, InMemoryBlueprintInstructionExecutionStore(bm, dict()))
+    bem.start_executions(bm.live_blueprints_by_name['quote_blueprint'], [(Event('new_order'), {}) for _ in range(2)])
+    executor_class(bem, bm, 'worker-testrunner', 2, True).run()
+
+    [adapter] = ExchangeQuoteAdapter.instances
+    assert len(adapter.event_buses) == 2
+    assert all(each is not None for each in adapter.event_buses)
+
+
+def test_unknown_component_scope_is_rejected():
+    with pytest.raises(InvalidBlueprintDefinition):
+        BlueprintManager({'namespace': {'action': [dict(component=ExchangeClientAction, scope='per_request')], 'adapter': [BasicAdapter]}})
+
+
+class DepositHistoryAdapter(Adapter):
+    def adapt(self, context, events, metadata=None, event_bus=None):
+        return [event.body['amount'] for event in event_bus.get_event_history('deposit_status', metadata['blueprint_execution_id'])]
+
+
+class RecordDeposits(Action):
+    deposits = None
+
+    def act(self, input):
+        RecordDeposits.deposits = input
+
+
+def test_adapter_sees_bounded_event_history():
+    bm = BlueprintManager({'namespace': {'action': [RecordDeposits], 'adapter': [DepositHistoryAdapter]}})
+    bm.add_blueprint({'name': 'deposit_history', 'instructions': [
+        {'conditions': ['deposit_status'], 'outcome': {'action': 'RecordDeposits', 'adapter': 'DepositHistoryAdapter'}}
+    ]})
+    event_bus = InMemoryEventBus(dict(event_history=dict(limit=2)))
+    bem = BlueprintExecutionManager(event_bus, InMemoryBlueprintInstructionExecutionStore(bm, dict()))
+    blueprint_execution = bem.start_execution(bm.live_blueprints_by_name['deposit_history'], Event('new_order'), {})
+    deposits = [Event('deposit_status', metadata=dict(blueprint_execution_id=blueprint_execution.execution_id), body=dict(amount=n)) for n in range(3)]
+    event_bus.publish_many(deposits)
+    assert [each.sequence for each in deposits] == sorted(each.sequence for each in deposits)
+    assert event_bus.get_event('deposit_status', blueprint_execution.execution_id) is deposits[-1]
+    assert event_bus.event_by_blueprint_execution_id_by_topic['deposit_status'] == {blueprint_execution.execution_id: deposits[-1]}
+
+    BlueprintExecutor(bem, bm, 'worker-testrunner', 1, True).run()
+    assert RecordDeposits.deposits == [1, 2]
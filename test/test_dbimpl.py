@@ -2,9 +2,15 @@ from concurrent import futures
 
 import pytest
 from moto import mock_s3, mock_sqs
+from peewee import fn
 
-from blue.base import InstructionStatus, Event, BlueprintExecution, BlueprintInstructionExecutionStore
-from blue.impl.persistent import PersistentBlueprintInstructionExecutionStore, PersistentEventBus
+from blue.base import InstructionStatus, Event, BlueprintExecution, BlueprintInstructionExecutionStore, BlueprintInstructionState
+from blue.impl.persistent import PersistentBlueprintInstructionExecutionStore, PersistentEventBus, BlueprintInstructionStateModel, EventModel, \
+    BlueprintExecutionModel, PersistentExecutionArchiver, BlueprintInstructionStateArchiveModel, EventArchiveModel, \
+    PostgresQueueBlueprintInstructionExecutionStore, PersistentEventCompactor, create_database
+from blue.blueprint import BlueprintManager
+from blue.execution import BlueprintExecutionManager
+from blue.impl.inmemory import InMemoryEventBus
 from blue.util import superjson
 from conftest import get_random_string
 
@@ -27,6 +33,13 @@ def instruction_execution_store(sample_blueprint_manager, sample_execution_store
         store.remove_effects()
 
 
+@pytest.fixture()
+def postgres_queue_store(sample_blueprint_manager, sample_execution_store_config):
+    store = PostgresQueueBlueprintInstructionExecutionStore(sample_blueprint_manager, sample_execution_store_config)
+    yield store
+    store.remove_effects()
+
+
 def test_superjson(sample_blueprint_execution):
     exec = superjson(sample_blueprint_execution)
     assert isinstance(exec, str)
@@ -91,3 +104,302 @@ def test_locking_with_mistake(instruction_execution_store, sample_blueprint_exec
     results = ex.map(store.get_instruction_to_process, range(5))
     eval_results = list(results)
     assert len([x for x in eval_results if x]) == 1
+
+
+def test_get_instructions_batch(instruction_execution_store, sample_blueprint_execution):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    store = instruction_execution_store
+    store.store(sample_blueprint_execution)
+    instruction_states = store.get_instructions_to_process('testcase_worker_id', 10)
+    assert len(instruction_states) == 1
+    assert instruction_states[0].status == InstructionStatus.PROCESSING
+
+
+def test_db_store_bulk(instruction_execution_store, sample_blueprint_execution, sample_instructions):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    sample_blueprint_execution.instructions_states = [BlueprintInstructionState(instruction, sample_blueprint_execution.execution_id)
+                                                      for instruction in sample_instructions * 6]
+    store = instruction_execution_store
+    store.store(sample_blueprint_execution)
+    assert get_number_of_messages_in_queue(store) == 12
+    assert BlueprintInstructionStateModel.select().where(
+        BlueprintInstructionStateModel.blueprint_execution_id == sample_blueprint_execution.execution_id).count() == 12
+
+
+def test_event_bus_publish_many(sample_execution_store_config):
+    eventbus = PersistentEventBus(sample_execution_store_config)
+    execution_ids = [get_random_string(5) + str(i) for i in range(3)]
+    eventbus.publish_many([Event('myeventtopic', metadata=dict(blueprint_execution_id=each), body=dict(n=1)) for each in execution_ids])
+    eventbus.publish_many([Event('myeventtopic', metadata=dict(blueprint_execution_id=each), body=dict(n=2)) for each in execution_ids])
+    for each in execution_ids:
+        assert eventbus.get_event('myeventtopic', each).body == dict(n=2)
+
+
+def test_event_bus_publish_upserts(sample_execution_store_config, sample_event):
+    # The bus appends now, but readers still only see the latest event per (topic, execution)
+    sample_event.metadata['blueprint_execution_id'] += get_random_string(5)
+    eventbus = PersistentEventBus(sample_execution_store_config)
+    eventbus.publish(sample_event)
+    sample_event.body = dict(lorem='dolor')
+    eventbus.publish(sample_event)
+    assert eventbus.get_event(sample_event.topic, sample_event.metadata['blueprint_execution_id']).body == dict(lorem='dolor')
+    events = EventModel.select().where(EventModel.blueprint_execution_id == sample_event.metadata['blueprint_execution_id']).order_by(EventModel.id)
+    assert [event.body for event in events] == [dict(lorem='ipsum'), dict(lorem='dolor')]
+
+
+def test_event_bus_appends_and_compactor_bounds_history(sample_execution_store_config, sample_event):
+    execution_id = sample_event.metadata['blueprint_execution_id'] + get_random_string(5)
+    eventbus = PersistentEventBus(sample_execution_store_config)
+    eventbus.publish_many([Event(sample_event.topic, metadata=dict(blueprint_execution_id=execution_id), body=dict(n=n)) for n in range(3)])
+    assert eventbus.get_event(sample_event.topic, execution_id).body == dict(n=2)
+    assert eventbus.get_events([sample_event.topic], execution_id)[sample_event.topic].body == dict(n=2)
+    history = eventbus.get_event_history(sample_event.topic, execution_id)
+    assert [event.body for event in history] == [dict(n=0), dict(n=1), dict(n=2)]
+    assert history[0].sequence < history[1].sequence < history[2].sequence
+
+    PersistentEventCompactor(dict(sample_execution_store_config, event_history=dict(limit=2))).run(max_iteration_count=1)
+    assert [event.body for event in eventbus.get_event_history(sample_event.topic, execution_id)] == [dict(n=1), dict(n=2)]
+
+
+def test_compactor_sweeps_the_log_in_bounded_id_ranges(sample_execution_store_config):
+    execution_ids = [get_random_string(5) + str(i) for i in range(3)]
+    eventbus = PersistentEventBus(sample_execution_store_config)
+    for n in range(4):
+        eventbus.publish_many([Event('compactedtopic', metadata=dict(blueprint_execution_id=each), body=dict(n=n)) for each in execution_ids])
+
+    PersistentEventCompactor(dict(sample_execution_store_config, event_history=dict(limit=1, batch_size=2))).compact()
+    for each in execution_ids:
+        assert [event.body for event in eventbus.get_event_history('compactedtopic', each)] == [dict(n=3)]
+
+
+def test_event_bus_get_events(sample_execution_store_config, sample_event):
+    sample_event.metadata['blueprint_execution_id'] += get_random_string(5)
+    eventbus = PersistentEventBus(sample_execution_store_config)
+    eventbus.publish(sample_event)
+    event_by_topic = eventbus.get_events([sample_event.topic, 'missingtopic'], sample_event.metadata['blueprint_execution_id'])
+    assert list(event_by_topic) == [sample_event.topic]
+
+
+def test_execution_context_cache(instruction_execution_store, sample_blueprint_execution):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    store = instruction_execution_store
+    store.store(sample_blueprint_execution)
+    store.execution_context_cache.pop(sample_blueprint_execution.execution_id)
+    for _ in range(3):
+        assert store.get_execution_context_from_id(sample_blueprint_execution.execution_id) == sample_blueprint_execution.execution_context
+    assert store.execution_context_cache.misses == 1
+    assert store.execution_context_cache.hits == 2
+
+
+def test_instruction_reference_resolves_after_redeploy(instruction_execution_store, sample_namespace_config, sample_blueprint_definition):
+    bm = BlueprintManager(sample_namespace_config)
+    bm.add_blueprint(sample_blueprint_definition)
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), instruction_execution_store)
+    blueprint_execution = bem.start_execution(bm.live_blueprints_by_name['test_blueprint_1'], Event('new_order'), {})
+
+    # A freshly deployed worker that has never seen this blueprint version
+    instruction_execution_store.manager = BlueprintManager(sample_namespace_config)
+    instruction_states = instruction_execution_store.get_instructions_to_process('testcase_worker_id', 10)
+    assert sorted(each.instruction_index for each in instruction_states) == [0, 1]
+    assert {each.blueprint_version for each in instruction_states} == {blueprint_execution.blueprint.version}
+    assert sorted(each.instruction.conditions for each in instruction_states) == [['deposit_status'], ['new_order']]
+
+
+def test_archiver_moves_finished_executions(instruction_execution_store, sample_blueprint_execution, sample_execution_store_config):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    execution_id = sample_blueprint_execution.execution_id
+    for instruction_state in sample_blueprint_execution.instructions_states:
+        instruction_state.blueprint_execution_id = execution_id
+    store = instruction_execution_store
+    eventbus = PersistentEventBus(sample_execution_store_config)
+    store.store(sample_blueprint_execution)
+    eventbus.publish(Event('new_order', metadata=dict(blueprint_execution_id=execution_id)))
+    archiver = PersistentExecutionArchiver(sample_execution_store_config)
+    try:
+        archiver.archive_finished_executions()
+        assert BlueprintExecutionModel.select().where(BlueprintExecutionModel.execution_id == execution_id).count() == 1
+
+        store.acknowledge_success(store.get_instruction_to_process('testcase_worker_id'))
+        archiver.run(max_iteration_count=1)
+        assert BlueprintExecutionModel.select().where(BlueprintExecutionModel.execution_id == execution_id).count() == 0
+        assert BlueprintInstructionStateArchiveModel.select().where(BlueprintInstructionStateArchiveModel.blueprint_execution_id == execution_id).count() == 1
+        assert EventArchiveModel.select().where(EventArchiveModel.blueprint_execution_id == execution_id).count() == 1
+        assert EventModel.select().where(EventModel.blueprint_execution_id == execution_id).count() == 0
+    finally:
+        archiver.remove_effects()
+
+
+def test_archiver_waits_for_lazy_instructions(sample_namespace_config, sample_execution_store_config):
+    bm = BlueprintManager(sample_namespace_config)
+    bm.add_blueprint({'name': 'late_emitting_blueprint', 'instructions': [
+        {'conditions': ['new_order'], 'outcome': {'action': 'CheckForDeposit', 'adapter': 'BasicAdapter'}, 'emits': ['deposit_status']},
+        {'conditions': ['deposit_status'], 'outcome': {'action': 'CheckForDeposit', 'adapter': 'BasicAdapter'}},
+    ]})
+    with mock_sqs():
+        store = PersistentBlueprintInstructionExecutionStore(bm, sample_execution_store_config)
+        bem = BlueprintExecutionManager(PersistentEventBus(sample_execution_store_config), store)
+        archiver = PersistentExecutionArchiver(sample_execution_store_config)
+        try:
+            execution_id = bem.start_execution(bm.live_blueprints_by_name['late_emitting_blueprint'], Event('new_order'), {}).execution_id
+            store.acknowledge_success(store.get_instruction_to_process('testcase_worker_id'))
+            archiver.archive_finished_executions()
+            assert BlueprintExecutionModel.select().where(BlueprintExecutionModel.execution_id == execution_id).count() == 1
+
+            bem.event_bus.publish(Event('deposit_status', metadata=dict(blueprint_execution_id=execution_id)))
+            instruction_state = store.get_instruction_to_process('testcase_worker_id')
+            assert instruction_state.instruction_index == 1
+            store.acknowledge_success(instruction_state)
+            archiver.archive_finished_executions()
+            assert BlueprintExecutionModel.select().where(BlueprintExecutionModel.execution_id == execution_id).count() == 0
+        finally:
+            archiver.remove_effects()
+            store.remove_effects()
+
+
+def test_requeue_with_delay_hides_message(instruction_execution_store, sample_blueprint_execution):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    store = instruction_execution_store
+    store.store(sample_blueprint_execution)
+    instruction_state = store.get_instruction_to_process('testcase_worker_id')
+    assert instruction_state.attempts == 1
+    store.requeue(instruction_state, delay=60)
+    assert instruction_state.lease is None
+    assert get_number_of_messages_in_queue(store) == 0
+    assert store.get_instruction_to_process('testcase_worker_id') is None
+
+
+def test_requeue_with_sub_second_delay_hides_message(instruction_execution_store, sample_blueprint_execution):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    store = instruction_execution_store
+    store.store(sample_blueprint_execution)
+    store.requeue(store.get_instruction_to_process('testcase_worker_id'), delay=0.5)
+    assert store.get_instruction_to_process('testcase_worker_id') is None
+
+
+def test_requeue_without_delay_waits_for_visibility_timeout(instruction_execution_store, sample_blueprint_execution):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    store = instruction_execution_store
+    store.store(sample_blueprint_execution)
+    instruction_state = store.get_instruction_to_process('testcase_worker_id')
+    store.requeue(instruction_state)
+    assert get_number_of_messages_in_queue(store) == 0
+    assert store.get_instruction_to_process('testcase_worker_id') is None
+
+
+def test_undecodable_messages_do_not_block_the_batch(instruction_execution_store, sample_blueprint_execution):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    store = instruction_execution_store
+    store.sqs.send_message(QueueUrl=store._queue_url, MessageBody='{"v": 999, "id_": "from-the-future"}')
+    store.sqs.send_message(QueueUrl=store._queue_url, MessageBody='not json')
+    store.store(sample_blueprint_execution)
+    instruction_states = store.get_instructions_to_process('testcase_worker_id', 10)
+    assert [each.id_ for each in instruction_states] == [each.id_ for each in sample_blueprint_execution.instructions_states]
+
+
+def test_postgres_queue_claims_each_instruction_once(postgres_queue_store, sample_blueprint_execution):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    store = postgres_queue_store
+    store.store(sample_blueprint_execution)
+    ex = futures.ThreadPoolExecutor(max_workers=4)
+    results = list(ex.map(lambda worker_id: store.get_instructions_to_process(worker_id, 10), range(4)))
+    claimed = [instruction_state for each in results for instruction_state in each]
+    assert len(claimed) == len(sample_blueprint_execution.instructions_states)
+    assert {each.status for each in claimed} == {InstructionStatus.PROCESSING}
+    assert {each.attempts for each in claimed} == {1}
+
+
+def test_postgres_queue_requeue_delay_and_lease_expiry(postgres_queue_store, sample_blueprint_execution):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    store = postgres_queue_store
+    store.store(sample_blueprint_execution)
+    instruction_state = store.get_instruction_to_process('worker-1')
+    store.requeue(instruction_state, delay=60)
+    assert store.get_instruction_to_process('worker-1') is None
+
+    store.lease_timeout = 0
+    BlueprintInstructionStateModel.update(available_at=fn.now()).where(
+        BlueprintInstructionStateModel.instruction_state_id == instruction_state.id_).execute()
+    reclaimed = store.get_instruction_to_process('worker-1')
+    assert reclaimed.id_ == instruction_state.id_ and reclaimed.attempts == 2
+    # worker-1 let its lease expire, so another worker may take over
+    store.lease_timeout = 300
+    taken_over = store.get_instruction_to_process('worker-2')
+    assert taken_over.id_ == instruction_state.id_
+    store.acknowledge_success(taken_over)
+    assert store.get_instruction_to_process('worker-2') is None
+
+
+def test_postgres_queue_claims_rows_without_available_at(postgres_queue_store, sample_blueprint_execution):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    store = postgres_queue_store
+    store.store(sample_blueprint_execution)
+    # As written by the SQS backed store or before the queue columns were migrated in
+    BlueprintInstructionStateModel.update(available_at=None).where(
+        BlueprintInstructionStateModel.blueprint_execution_id == sample_blueprint_execution.execution_id).execute()
+    claimed = store.get_instructions_to_process('worker-1', 10)
+    assert len(claimed) == len(sample_blueprint_execution.instructions_states)
+
+
+def test_postgres_queue_rejects_outcome_of_expired_lease(postgres_queue_store, sample_blueprint_execution):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    store = postgres_queue_store
+    store.store(sample_blueprint_execution)
+    store.lease_timeout = 0
+    stale = store.get_instruction_to_process('worker-1')
+    store.lease_timeout = 300
+    current = store.get_instruction_to_process('worker-1')
+    assert current.id_ == stale.id_ and current.lease.token != stale.lease.token
+
+    store.acknowledge_success(stale)
+    model = BlueprintInstructionStateModel.get(BlueprintInstructionStateModel.instruction_state_id == current.id_)
+    assert (model.status, model.leased_by) == (InstructionStatus.PROCESSING.value, current.lease.token)
+    store.acknowledge_success(current)
+    model = BlueprintInstructionStateModel.get(BlueprintInstructionStateModel.instruction_state_id == current.id_)
+    assert (model.status, model.leased_by) == (InstructionStatus.SUCCESS.value, None)
+
+
+def test_lease_carries_receipt_handle(instruction_execution_store, sample_blueprint_execution):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    store = instruction_execution_store
+    store.store(sample_blueprint_execution)
+    instruction_state = store.get_instruction_to_process('testcase_worker_id')
+    assert instruction_state.lease.token
+    store.extend_lease(instruction_state)
+    store.acknowledge_success(instruction_state)
+    assert instruction_state.lease is None
+    assert get_number_of_messages_in_queue(store) == 0
+
+
+def test_bus_and_store_share_a_connection_pool(instruction_execution_store, sample_execution_store_config, sample_event):
+    eventbus = PersistentEventBus(sample_execution_store_config)
+    assert eventbus.db is instruction_execution_store.db
+
+    config = dict(sample_execution_store_config, db_pool=dict(max_connections=2))
+    database = create_database(config)
+    store = PostgresQueueBlueprintInstructionExecutionStore(instruction_execution_store.manager, config, database=database)
+    eventbus = PersistentEventBus(config, database=database)
+
+    def publish_in_worker(i):
+        with store.worker_context():
+            eventbus.publish(Event(sample_event.topic, metadata=dict(blueprint_execution_id=f'pool-{i}')))
+
+    list(futures.ThreadPoolExecutor(max_workers=2).map(publish_in_worker, range(10)))
+    # Connections go back to the pool when the worker context exits
+    assert len(database._in_use) == 0
+    assert len(database._connections) <= 2
+    database.close_all()
+
+
+def test_materialize_inserts_and_enqueues_each_instruction_once(instruction_execution_store, sample_blueprint_execution):
+    sample_blueprint_execution.execution_id += get_random_string(5)
+    for instruction_state in sample_blueprint_execution.instructions_states:
+        instruction_state.blueprint_execution_id = sample_blueprint_execution.execution_id
+    store = instruction_execution_store
+    eager_instruction_state = sample_blueprint_execution.instructions_states[0]
+    lazy_instruction_state = BlueprintInstructionState(eager_instruction_state.instruction, sample_blueprint_execution.execution_id)
+    store.store(sample_blueprint_execution)
+
+    store.materialize([lazy_instruction_state])
+    store.materialize([lazy_instruction_state])
+    instruction_ids = [each.id_ for each in store.get_instructions_to_process('testcase_worker_id', 10)]
+    assert sorted(instruction_ids) == sorted([eager_instruction_state.id_, lazy_instruction_state.id_])
@@ -0,0 +1,29 @@
+import urllib.request
+
+from blue.metrics import InMemoryMetricsSink, PrometheusExporter
+
+
+def test_prometheus_exporter_renders_histograms_and_counters():
+    sink = InMemoryMetricsSink(buckets=(0.1, 1))
+    sink.observe('blue_executor_phase_seconds', 0.05, dict(phase='action', action='Check"Deposit'))
+    sink.observe('blue_executor_phase_seconds', 5, dict(phase='action', action='Check"Deposit'))
+    sink.increment('blue_executor_instructions_total', dict(run_status='OUTCOME_ACTION_SUCCESS'))
+
+    exporter = PrometheusExporter(sink)
+    assert exporter.render().splitlines() == [
+        '# TYPE blue_executor_phase_seconds histogram',
+        'blue_executor_phase_seconds_bucket{action="Check\\"Deposit",phase="action",le="0.1"} 1',
+        'blue_executor_phase_seconds_bucket{action="Check\\"Deposit",phase="action",le="1"} 1',
+        'blue_executor_phase_seconds_bucket{action="Check\\"Deposit",phase="action",le="+Inf"} 2',
+        'blue_executor_phase_seconds_sum{action="Check\\"Deposit",phase="action"} 5.05',
+        'blue_executor_phase_seconds_count{action="Check\\"Deposit",phase="action"} 2',
+        '# TYPE blue_executor_instructions_total counter',
+        'blue_executor_instructions_total{run_status="OUTCOME_ACTION_SUCCESS"} 1',
+    ]
+
+    server = exporter.serve(0, '127.0.0.1')
+    try:
+        body = urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics').read().decode('utf-8')
+        assert body == exporter.render()
+    finally:
+        exporter.shutdown()
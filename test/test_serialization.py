@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+from blue.base import BlueprintInstructionState, Event, InstructionStatus
+from blue.serialization import Serializer, JsonCodec, SerializationError, WIRE_FORMAT_VERSION, get_codec
+from blue.util import superjson
+from conftest import get_data_sample_instruction_state_1, _data_sample_instruction_1
+
+
+@pytest.mark.parametrize('codec_name', ['json', 'orjson'])
+def test_instruction_state_round_trip(codec_name):
+    pytest.importorskip(codec_name)
+    serializer = Serializer(get_codec(codec_name))
+    instruction_state = BlueprintInstructionState(_data_sample_instruction_1, 'execution-1', blueprint_name='bp', blueprint_version='abc',
+                                                  instruction_index=0)
+    encoded = serializer.loads(serializer.dumps(instruction_state))
+    assert encoded == dict(v=WIRE_FORMAT_VERSION, id_=instruction_state.id_, blueprint_execution_id='execution-1', status='IDLE', ref=['bp', 'abc', 0])
+    decoded = serializer.decode_instruction_state(encoded, _data_sample_instruction_1)
+    assert decoded == instruction_state
+
+
+def test_inline_instruction_matches_superjson():
+    instruction_state = get_data_sample_instruction_state_1()
+    encoded = json.loads(Serializer(JsonCodec()).dumps(instruction_state))
+    assert encoded['instruction'] == json.loads(superjson(instruction_state))['instruction']
+    assert Serializer.decode_event(Serializer.encode_event(Event('topic', body=dict(a=1)))) == Event('topic', body=dict(a=1))
+
+
+def test_rejects_newer_wire_format():
+    with pytest.raises(SerializationError):
+        Serializer(JsonCodec()).loads(json.dumps(dict(v=WIRE_FORMAT_VERSION + 1, status=InstructionStatus.IDLE.value)))
+
+
+@pytest.mark.parametrize('payload', ['not json', '[1, 2]'])
+def test_rejects_malformed_payload(payload):
+    with pytest.raises(SerializationError):
+        Serializer(JsonCodec()).loads(payload)
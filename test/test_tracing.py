@@ -0,0 +1,56 @@
+import json
+
+from blue.base import Action, Event
+from blue.blueprint import BlueprintManager
+from blue.execution import BlueprintExecutionManager, BlueprintExecutor
+from blue.impl.inmemory import InMemoryEventBus, InMemoryBlueprintInstructionExecutionStore
+from blue.tracing import Tracer, InMemorySpanExporter, FileSpanExporter, TRACE_METADATA_KEY
+from conftest import BasicAdapter
+
+
+class PublishNext(Action):
+    def act(self, input):
+        self.event_bus.publish(Event('next', metadata=dict(blueprint_execution_id=self._metadata['blueprint_execution_id'])))
+
+
+class Finish(Action):
+    def act(self, input):
+        pass
+
+
+def run_chain(tracer):
+    bm = BlueprintManager({'namespace': {'action': [PublishNext, Finish], 'adapter': [BasicAdapter]}})
+    bm.add_blueprint({'name': 'chain', 'instructions': [
+        {'conditions': ['start'], 'outcome': {'action': 'PublishNext', 'adapter': 'BasicAdapter'}},
+        {'conditions': ['next'], 'outcome': {'action': 'Finish', 'adapter': 'BasicAdapter'}},
+    ]})
+    event_bus = InMemoryEventBus(dict())
+    bem = BlueprintExecutionManager(event_bus, InMemoryBlueprintInstructionExecutionStore(bm, dict(fairness='fifo')), tracer=tracer)
+    published = []
+    event_bus.add_listener(published.append)
+    bem.start_execution(bm.live_blueprints_by_name['chain'], Event('start'), {})
+    BlueprintExecutor(bem, bm, 'worker-testrunner', 2, True).run()
+    return published
+
+
+def test_trace_follows_events_across_instructions():
+    exporter = InMemorySpanExporter()
+    run_chain(Tracer(exporter))
+
+    root, first, second = exporter.spans
+    assert [span.name for span in exporter.spans] == ['start_execution', 'process_instruction', 'process_instruction']
+    assert {span.context.trace_id for span in exporter.spans} == {root.context.trace_id}
+    assert first.parent_id == root.context.span_id and first.attributes['action'] == 'PublishNext'
+    assert second.parent_id == first.context.span_id and second.attributes['run_status'] == 'OUTCOME_ACTION_SUCCESS'
+    assert set(second.attributes['phase_ms']) == {'event_fetch', 'termination_check', 'condition_check', 'context_fetch', 'adapter', 'action',
+                                                  'ack'}
+
+
+def test_unsampled_traces_propagate_without_exporting(tmp_path):
+    path = tmp_path / 'spans.jsonl'
+    published = run_chain(Tracer(FileSpanExporter(str(path)), sample_rate=0))
+    assert not path.exists()
+    assert {event.metadata[TRACE_METADATA_KEY]['sampled'] for event in published} == {False}
+
+    run_chain(Tracer(FileSpanExporter(str(path))))
+    assert [json.loads(line)['name'] for line in path.read_text().splitlines()] == ['start_execution', 'process_instruction', 'process_instruction']
@@ -0,0 +1,30 @@
+from blue.util import LRUCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.stats() == dict(size=2, max_size=2, hits=1, misses=1, evictions=1, expirations=0)
+
+
+def test_lru_cache_ttl():
+    clock = FakeClock()
+    cache = LRUCache(2, ttl=10, clock=clock)
+    cache.put('a', 1)
+    clock.now = 9
+    assert cache.get('a') == 1
+    clock.now = 10
+    assert cache.get('a') is None
+    assert cache.expirations == 1
@@ -0,0 +1,27 @@
+import os
+import time
+
+from blue.base import Event
+from blue.blueprint import BlueprintManager
+from blue.execution import BlueprintExecutionManager, BlueprintExecutor
+from blue.impl.inmemory import InMemoryEventBus, InMemoryBlueprintInstructionExecutionStore
+from conftest import CheckForDeposit, TransferToExchange, BasicAdapter, _data_sample_blueprint_definition
+
+# Set by tests before the supervisor forks: crash_once, slow_setup or run_until_stopped
+WORKER_MODE_ENV = 'BLUE_TEST_WORKER_MODE'
+CRASH_MARKER_ENV = 'BLUE_TEST_WORKER_CRASH_MARKER'
+
+
+def create_executor(worker_id, rundata_callback):
+    mode = os.environ.get(WORKER_MODE_ENV)
+    if mode == 'crash_once' and not os.path.exists(os.environ[CRASH_MARKER_ENV]):
+        open(os.environ[CRASH_MARKER_ENV], 'w').close()
+        os._exit(1)
+    if mode == 'slow_setup':
+        time.sleep(1)
+    bm = BlueprintManager({'namespace': {'action': [CheckForDeposit, TransferToExchange], 'adapter': [BasicAdapter]}})
+    bm.add_blueprint(_data_sample_blueprint_definition)
+    bem = BlueprintExecutionManager(InMemoryEventBus(dict()), InMemoryBlueprintInstructionExecutionStore(bm, dict()))
+    bem.start_execution(bm.live_blueprints_by_name['test_blueprint_1'], Event('new_order'), {'order_id': worker_id})
+    max_iteration_count = None if mode in ('slow_setup', 'run_until_stopped') else 2
+    return BlueprintExecutor(bem, bm, worker_id, max_iteration_count, True, rundata_callback=rundata_callback)